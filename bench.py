@@ -0,0 +1,205 @@
+'''Throughput benchmarks for the dbif interfaces, run against fakeclient.py
+so that they measure the interface and not a database:
+
+    bench.py [-D oracle -D mysql ...] [-n COMMANDS] [-r ROWS] [--stream]
+    bench.py --startup [--startup-runs N] [--startup-limit MS]
+
+For every client it times connect, runs COMMANDS one line exec_cmd calls,
+then executes a script of ROWS inserts with exec_sql_file, and reports
+commands/sec, per call latency percentiles, script output bytes/sec and
+peak memory.
+
+With --startup it times instead how long sql_user.py takes to find out
+that a recorded script has not changed, against the startup of a bare
+interpreter, and checks that none of the SLOW_IMPORTS were needed for it.
+The exit code is 1 if they were, or if it took more than --startup-limit
+ms over the bare interpreter.'''
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess as subp
+
+import dbif
+import fakeclient
+from history import HistoryManager
+
+INTERFACES = {
+    'oracle': dbif.OracleInterface,
+    'postgresql': dbif.PostgreInterface,
+    'mysql': dbif.MysqlInterface,
+    'vertica': dbif.VerticaInterface,
+}
+
+# what the skip path of sql_user.py must do without
+SLOW_IMPORTS = ['pexpect', 'dbif', 'argparse', 'logging', 'sqlite3', 'gzip', 'difflib']
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    '''values must be sorted'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def peak_memory():
+    '''(this process, largest child) peak RSS in KB'''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def make_script(rows):
+    '''A script of single row inserts, like the data loads.'''
+    fd, path = tempfile.mkstemp(suffix='.sql', prefix='bench')
+    with os.fdopen(fd, 'w') as f:
+        for i in range(rows):
+            f.write("insert into bench values (%d, 'row %d');\n" % (i, i))
+    return path
+
+def bench_dialect(dialect, commands, script, stream):
+    '''Returns a dict of measurements for one client.'''
+    logger = logging.getLogger('bench.' + dialect)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    rawdir = tempfile.mkdtemp(prefix='bench_raw')
+    rawlog = os.path.join(rawdir, 'client.log')
+    iface = fakeclient.use_fake_client(INTERFACES[dialect](logger, rawlog), dialect)
+    result = {'dialect': dialect}
+    try:
+        start = time.time()
+        if not iface.connect('bench', 'bench', 'benchdb'):
+            raise Exception('could not connect to the fake %s client' % (dialect,))
+        result['connect'] = time.time() - start
+
+        latencies = []
+        start = time.time()
+        for i in range(commands):
+            t = time.time()
+            iface.exec_cmd('select %d from dual;' % (i,))
+            latencies.append(time.time() - t)
+        elapsed = time.time() - start
+        latencies.sort()
+        result['cmds_per_sec'] = commands / elapsed
+        result['p50'] = percentile(latencies, 50)
+        result['p90'] = percentile(latencies, 90)
+        result['p99'] = percentile(latencies, 99)
+
+        size = iface._child.logfile.written
+        start = time.time()
+        iface.exec_sql_file(script, stream=stream)
+        iface._child.logfile.sync()
+        elapsed = time.time() - start
+        result['script_secs'] = elapsed
+        result['bytes_per_sec'] = (iface._child.logfile.written - size) / elapsed
+    finally:
+        iface.exit()
+        shutil.rmtree(rawdir, ignore_errors=True)
+    result['rss_self'], result['rss_child'] = peak_memory()
+    return result
+
+def bench_startup(runs):
+    '''Returns a dict of measurements of the sql_user.py skip path.'''
+    work = tempfile.mkdtemp(prefix='bench_startup')
+    try:
+        with open(os.path.join(work, 'main.sql'), 'w') as f:
+            f.write('@sub.sql\ninsert into bench values (1);\n')
+        with open(os.path.join(work, 'sub.sql'), 'w') as f:
+            f.write('insert into bench values (2);\n')
+        hist = HistoryManager('main.sql', 'benchdb', 'bench', path=os.path.join(work, 'complete'))
+        cwd = os.getcwd()
+        os.chdir(work)
+        try:
+            hist.record(['main.sql', 'sub.sql'])
+        finally:
+            os.chdir(cwd)
+
+        def timed(cmd):
+            times = []
+            for i in range(runs):
+                start = time.time()
+                subp.check_call(cmd, cwd=work, stderr=open(os.devnull, 'w'))
+                times.append(time.time() - start)
+            times.sort()
+            return percentile(times, 50)
+
+        argv = ['bench', 'benchpw', 'benchdb', 'main.sql', '-q', '-l', 'bench.log']
+        result = {'bare': timed([sys.executable, '-c', 'pass']),
+                  'skip': timed([sys.executable, os.path.join(HERE, 'sql_user.py')] + argv)}
+        check = ('import sys; sys.path.insert(0, %r); import fastskip; '
+                 'skipped = fastskip.skip(%r); '
+                 'print skipped, " ".join([m for m in %r if m in sys.modules])'
+                 % (HERE, argv, SLOW_IMPORTS))
+        out = subp.Popen([sys.executable, '-c', check], cwd=work, stdout=subp.PIPE,
+                         stderr=open(os.devnull, 'w')).communicate()[0].split()
+        result['skipped'] = out[:1] == ['True']
+        result['slow_imports'] = out[1:]
+        return result
+    finally:
+        shutil.rmtree(work)
+
+def report_startup(result, limit):
+    '''Returns the text of the report and whether the skip path is fast enough.'''
+    overhead = (result['skip'] - result['bare']) * 1000
+    lines = ['%-26s %8.1f ms' % ('bare interpreter', result['bare'] * 1000),
+             '%-26s %8.1f ms' % ('sql_user.py, not changed', result['skip'] * 1000),
+             '%-26s %8.1f ms (limit %d)' % ('overhead', overhead, limit)]
+    ok = True
+    if not result['skipped']:
+        lines.append('FAIL: the skip path did not skip the unchanged script')
+        ok = False
+    if result['slow_imports']:
+        lines.append('FAIL: the skip path imported ' + ', '.join(result['slow_imports']))
+        ok = False
+    if overhead > limit:
+        lines.append('FAIL: the skip path is over the limit')
+        ok = False
+    return '\n'.join(lines), ok
+
+def report(results):
+    lines = ['%-11s %8s %9s %8s %8s %8s %9s %10s %9s %9s' %
+             ('CLIENT', 'CONNECT', 'CMDS/S', 'P50 MS', 'P90 MS', 'P99 MS',
+              'SCRIPT S', 'KB/S', 'RSS KB', 'CHILD KB')]
+    for r in results:
+        lines.append('%-11s %8.3f %9.1f %8.2f %8.2f %8.2f %9.2f %10.1f %9d %9d' %
+                     (r['dialect'], r['connect'], r['cmds_per_sec'], r['p50'] * 1000,
+                      r['p90'] * 1000, r['p99'] * 1000, r['script_secs'],
+                      r['bytes_per_sec'] / 1024, r['rss_self'], r['rss_child']))
+    return '\n'.join(lines)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the dbif interfaces against fake clients.')
+    parser.add_argument('-D', '--dbms', action='append', choices=sorted(INTERFACES),
+                        help='Client to benchmark, can be repeated. Default is all of them.')
+    parser.add_argument('-n', '--commands', type=int, default=500,
+                        help='Number of exec_cmd calls. Default is 500.')
+    parser.add_argument('-r', '--rows', type=int, default=20000,
+                        help='Number of inserts in the script. Default is 20000.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Run the script with streamed output handling.')
+    parser.add_argument('--startup', action='store_true',
+                        help='Benchmark the startup of sql_user.py for an unchanged script instead.')
+    parser.add_argument('--startup-runs', type=int, default=20,
+                        help='How many times to start it. Default is 20.')
+    parser.add_argument('--startup-limit', metavar='MS', type=int, default=40,
+                        help='Fail if it takes this many ms more than a bare interpreter. Default is 40.')
+    return parser.parse_args(args)
+
+def main(argv):
+    args = parse_args(argv[1:])
+    if args.startup:
+        text, ok = report_startup(bench_startup(args.startup_runs), args.startup_limit)
+        print text
+        sys.exit(not ok and 1 or 0)
+    script = make_script(args.rows)
+    try:
+        results = [bench_dialect(d, args.commands, script, args.stream)
+                   for d in (args.dbms or sorted(INTERFACES))]
+    finally:
+        os.remove(script)
+    print report(results)
+
+if __name__ == '__main__':
+    main(sys.argv)
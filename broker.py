@@ -0,0 +1,387 @@
+'''A local daemon keeping database sessions logged in between sql_user.py
+runs, so that a release of many scripts pays for the client spawn and the
+login once per (dbms, user, database, host):
+
+    broker.py start /tmp/db_release_broker.sock --idle 600
+    sql_user.py --broker /tmp/db_release_broker.sock user password script.sql
+    broker.py stop /tmp/db_release_broker.sock
+
+A session is lent to one sql_user.py at a time, through
+dbif.BrokerInterface. When one is lent and none is left for the same
+credentials the next one is logged in in the background, so it is ready
+for the next script. Returned sessions are rolled back, checked with
+connected() before being lent again, and logged out after --idle secs of
+not being used. A session whose client was told to keep something for
+the statements after, like SQL*Plus DEFINEs and settings, psql
+variables or a mysql DELIMITER, is logged out instead of being lent to
+the next script with them. The broker exits by itself after
+--exit-after secs without clients, so a push that died does not leave
+it behind.'''
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+import traceback
+import SocketServer
+
+import pexpect
+
+import dbif
+import util
+from metrics import StatementProfile
+
+KEEP_IDLE = 2 # sessions kept per credentials, more are logged out on release
+CALLS = ('exec_cmd', 'exec_sql_file', 'commit', 'rollback', 'connected',
+         'dequeue_errors', 'output_tail', 'last_output', 'failure', 'define_args')
+
+_local = threading.local() # the client connection of the handler thread
+
+
+def _to_str(value):
+    '''JSON gives unicode, the sessions are fed utf-8 str.'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    return value
+
+def _to_unicode(value):
+    '''The client output is not always utf-8, JSON wants it to be.'''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_to_unicode(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, _to_unicode(v)) for k, v in value.items()])
+    return value
+
+def _leaves_state(db, method, args):
+    '''True if the call can leave something in the session for the next
+    borrower, see util.sets_session_state. Scripts are looked through,
+    with the scripts they include.'''
+    if method == 'define_args':
+        return bool(args[0])
+    if method == 'exec_cmd':
+        return _text_leaves_state(db, args[0], set())
+    if method == 'exec_sql_file':
+        # the arguments of a script are DEFINEd by sqlplus
+        return len(args) > 1 and bool(args[1]) or _script_leaves_state(db, args[0], set())
+    return False
+
+def _script_leaves_state(db, sql_file, seen):
+    path = util.script_file(os.path.join(db.cwd or '', sql_file))
+    if path in seen:
+        return False
+    seen.add(path)
+    try:
+        with open(path, 'r') as file:
+            text = file.read()
+    except IOError:
+        return False # the client does not run it either
+    return _text_leaves_state(db, text, seen)
+
+def _text_leaves_state(db, text, seen):
+    for lineno, stmt in util.split_script(text, db.dbms):
+        sub = util.match_subscript(stmt + '\n', db.dbms)
+        if sub:
+            if _script_leaves_state(db, sub, seen):
+                return True
+        elif util.sets_session_state(stmt, db.dbms):
+            return True
+    return False
+
+
+class _Relay(logging.Handler):
+    '''Sends what the sessions log to the client the session is lent to.
+    Records logged with no client, by the pre-spawn threads or while a
+    session is taken back, go to the log of the broker.'''
+    def emit(self, record):
+        send = getattr(_local, 'send', None)
+        if not send:
+            logging.getLogger('broker').handle(record)
+            return
+        try:
+            send(log=record.levelno, msg=record.getMessage())
+        except socket.error:
+            pass
+
+
+class Broker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, idle, exit_after, logger):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _Handler)
+        os.chmod(socket_path, 0600)
+        self.socket_path = socket_path
+        self.idle = idle
+        self.exit_after = exit_after
+        self.logger = logger
+        self.session_logger = logging.getLogger('broker.session')
+        self.session_logger.addHandler(_Relay())
+        self.session_logger.propagate = False
+        self.last_used = time.time()
+        self.lent = 0
+        self._pools = {}
+        self._passwords = {}
+        self._lock = threading.Lock()
+
+    def pool(self, request):
+        '''The pool of the dbms, backend, transport, directory and raw log
+        of a client. The raw logs are named as for a run without the broker,
+        see --rawlog of sql_user.py.'''
+        transport = request.get('transport', dbif.PTY)
+        rawlog = request.get('rawlog')
+        key = (request['dbms'], request['backend'], transport, request['cwd'], rawlog)
+        self._lock.acquire()
+        try:
+            if key not in self._pools:
+                self._pools[key] = dbif.SessionPool(request['dbms'], self.session_logger, rawlog,
+                                                    request['backend'], cwd=request['cwd'],
+                                                    transport=transport)
+            return self._pools[key]
+        finally:
+            self._lock.release()
+
+    def lend(self, request):
+        '''A session for the credentials of the request, or None and the
+        login errors.'''
+        request = dict([(k, _to_str(v)) for k, v in request.items()])
+        pool = self.pool(request)
+        credentials = (request['user'], request['database'], request['host'])
+        key = (pool.dbms, pool.cwd) + credentials
+        self._lock.acquire()
+        try:
+            self.last_used = time.time()
+            if self._passwords.get(key, request['password']) != request['password']:
+                # the password changed, the idle sessions are not those of the client
+                pool.discard(*credentials)
+            self._passwords[key] = request['password']
+        finally:
+            self._lock.release()
+        db = pool.acquire(request['user'], request['password'], *credentials[1:])
+        if db is None:
+            return None, pool.last_errors()
+        db.pool = pool
+        db.reusable = True # until the client leaves something in it, see _leaves_state
+        self._lock.acquire()
+        try:
+            self.lent += 1
+        finally:
+            self._lock.release()
+        if not pool.idle_count(*credentials):
+            threading.Thread(target=self.prespawn, args=(pool, request)).start()
+        return db, []
+
+    def prespawn(self, pool, request):
+        '''Log in the next session for the credentials.'''
+        db = pool.acquire(request['user'], request['password'], request['database'], request['host'])
+        if db:
+            self.logger.info('Pre-spawned a session for %s@%s %s', request['user'],
+                             request['database'], request['host'])
+            pool.release(db)
+
+    def give_back(self, db, healthy=True):
+        '''Take a session back from a client. Sessions of clients that went
+        away in the middle of something, or left something in the session,
+        are logged out.'''
+        self._lock.acquire()
+        try:
+            self.lent -= 1
+            self.last_used = time.time()
+        finally:
+            self._lock.release()
+        if not db.reusable:
+            self.logger.info('Logging out a session with the settings of its last client')
+        elif healthy and db.connected():
+            db.rollback()
+            if db.pool.idle_count(*db.session_key) < KEEP_IDLE:
+                db.pool.release(db)
+                return
+        if db.connected():
+            db.exit()
+
+    def janitor(self):
+        '''Log out the idle sessions, and stop the broker when nobody has
+        used it for exit_after secs.'''
+        while True:
+            time.sleep(min(self.idle, 10))
+            for pool in self._pools.values():
+                evicted = pool.evict(self.idle)
+                if evicted:
+                    self.logger.info('Logged out %d idle sessions', evicted)
+            if self.exit_after and not self.lent and time.time() - self.last_used > self.exit_after:
+                self.logger.info('Not used for %d secs, exiting', self.exit_after)
+                self.stop()
+                return
+
+    def status(self):
+        self._lock.acquire()
+        try:
+            idle = sum([pool.idle_total() for pool in self._pools.values()])
+            return dict(pid=os.getpid(), lent=self.lent, idle=idle,
+                        unused_secs=int(time.time() - self.last_used))
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        '''Log out every idle session and stop serving.'''
+        threading.Thread(target=self.shutdown).start()
+        for pool in self._pools.values():
+            pool.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    '''One client connection: an open, calls on the lent session, and a
+    release. Replies are one JSON object per line.'''
+    def handle(self):
+        self.db = None
+        _local.send = self.send
+        try:
+            for line in iter(self.rfile.readline, ''):
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'open':
+                    self.open(request)
+                elif op == 'call':
+                    self.call(request)
+                elif op == 'release':
+                    self.release()
+                    self.send(reply=True)
+                elif op == 'status':
+                    self.send(reply=self.server.status())
+                elif op == 'stop':
+                    self.send(reply=True)
+                    self.server.stop()
+                else:
+                    self.send(exception='ValueError', message='Unknown op %r' % (op,))
+        except socket.error:
+            pass
+        finally:
+            _local.send = None
+            if self.db:
+                self.server.logger.info('Client went away with a session, logging it out')
+                self.server.give_back(self.db, healthy=False)
+
+    def send(self, **message):
+        self.wfile.write(json.dumps(_to_unicode(message)) + '\n')
+        self.wfile.flush()
+
+    def open(self, request):
+        if self.db:
+            self.release()
+        self.db, errors = self.server.lend(request)
+        self.send(reply=self.db is not None, errors=errors)
+
+    def release(self):
+        if self.db:
+            db, self.db = self.db, None
+            _local.send = None
+            try:
+                self.server.give_back(db)
+            finally:
+                _local.send = self.send
+
+    def call(self, request):
+        method, args = request['method'], _to_str(request.get('args', []))
+        if method not in CALLS or not self.db:
+            self.send(exception='DisconnectedException', message='No session to call %s on' % (method,))
+            return
+        try:
+            if self.db.reusable and _leaves_state(self.db, method, args):
+                self.db.reusable = False
+            if method == 'exec_cmd' and args[1]:
+                args[1] = [{'EOF': pexpect.EOF, 'TIMEOUT': pexpect.TIMEOUT,
+                            'DONE': dbif.DONE}.get(p, p) for p in args[1]]
+            if method == 'exec_sql_file':
+                profile = request.get('profile') and StatementProfile() or None
+                reply = self.db.exec_sql_file(*args, profile=profile)
+                self.send(reply=reply, statements=profile and profile.statements or [])
+                return
+            self.send(reply=getattr(self.db, method)(*args))
+        except pexpect.EOF, e:
+            self.send(exception='EOF', message=str(e))
+        except dbif.DisconnectedException, e:
+            self.send(exception='DisconnectedException', message=str(e))
+        except Exception, e:
+            self.server.logger.error(traceback.format_exc())
+            self.send(exception=e.__class__.__name__, message=str(e))
+
+
+def request(socket_path, **message):
+    '''Send one request to the broker and return its reply.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall(json.dumps(message) + '\n')
+        return json.loads(sock.makefile('rb').readline())['reply']
+    finally:
+        sock.close()
+
+def start(args):
+    '''Start serving on the socket in the background. Returns when the
+    socket accepts connections.'''
+    if dbif.BrokerInterface.available(args.socket):
+        print 'A broker is already running on %s' % (args.socket,)
+        return 0
+    logger = logging.getLogger('broker')
+    handler = logging.FileHandler(args.log_file)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    server = Broker(args.socket, args.idle, args.exit_after, logger)
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    logger.info('Serving on %s, pid %d', args.socket, os.getpid())
+    janitor = threading.Thread(target=server.janitor)
+    janitor.daemon = True
+    janitor.start()
+    server.serve_forever()
+    logger.info('Stopped')
+    return 0
+
+def stop(args):
+    if not dbif.BrokerInterface.available(args.socket):
+        return 0
+    request(args.socket, op='stop')
+    return 0
+
+def status(args):
+    if not dbif.BrokerInterface.available(args.socket):
+        print 'No broker on %s' % (args.socket,)
+        return 1
+    print ', '.join(['%s: %s' % item for item in sorted(request(args.socket, op='status').items())])
+    return 0
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Keep database sessions logged in between sql_user.py runs.')
+    parser.add_argument('command', choices=['start', 'stop', 'status'])
+    parser.add_argument('socket', help='Path of the Unix socket of the broker.')
+    parser.add_argument('--idle', type=int, default=600,
+                        help='Log out sessions not used for this many secs. Default is 600.')
+    parser.add_argument('--exit-after', type=int, default=3600,
+                        help='Exit after this many secs without clients, 0 for never. Default is 3600.')
+    parser.add_argument('-l', '--log', dest='log_file', default='broker.log',
+                        help='Log file of the broker. Default is broker.log')
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv[1:])
+    sys.exit({'start': start, 'stop': stop, 'status': status}[args.command](args))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,370 @@
+'''Load data scripts through the bulk path of the client.
+
+Some scripts are nothing but INSERTs of literal values, hundreds of MB of
+them. Run through exec_sql_file every row costs a round trip to the client
+and a line of feedback. prepare() reads such a script once and writes the
+rows of every run of INSERTs into the same table and columns to a data
+file, which BulkLoad.load() then loads with one command through the
+session:
+
+    postgresql  \\copy ... from 'file' with csv
+    vertica     COPY ... FROM LOCAL 'file'
+    mysql       LOAD DATA LOCAL INFILE 'file'
+
+sqlplus cannot read data files, and sqlldr would need a login of its own
+and a control file. For oracle the rows are sent BATCH_ROWS at a time in
+INSERT ALL statements instead, which is what the conventional path of
+sqlldr does. Every row goes on a line of its own, broken after its commas
+where it is longer than sqlplus takes; a script with a value that long is
+not loaded this way.
+
+The scripts loaded this way may only have INSERTs of literals, one or
+more rows each, and COMMITs. The COMMITs are left to sql_user.py, which
+commits at the end as for any script. The rows loaded are counted from the
+feedback of the client, and a load that did not load every row is an
+error like those of the client.'''
+import os
+import re
+import shutil
+import tempfile
+
+import pexpect
+
+BATCH_ROWS = 500 # rows in one INSERT ALL for oracle
+BATCH_BYTES = 64 * 1024 # and at most this much of them
+SQLPLUS_LINE = 2499 # the longest line sqlplus takes, SP2-0027 past it
+
+_INSERT = re.compile(r'\s*insert\s+into\s+([\w$#."]+)\s*(\([^()\']*\))?\s*values\s*', re.I)
+_COMMIT = re.compile(r'\s*commit(\s+work)?\s*;\s*$', re.I)
+_NUMBER = re.compile(r'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
+_NULL = re.compile(r'null\b', re.I)
+_STRING = re.compile(r"'((?:[^']|'')*)'")
+_MYSQL_STRING = re.compile(r"'((?:[^'\\]|''|\\.)*)'", re.S)
+_MYSQL_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+# the command loading a data file, the one asking how many rows it loaded
+# if the feedback of the load does not say, and the answer. The question
+# goes right after the load, in the same exec_cmd: any statement in
+# between, like the marker of dbif, would reset what it asks for.
+_LOAD_CMDS = {
+    'postgresql': ("\\copy %(table)s%(columns)s from '%(file)s' with csv", None,
+                   re.compile(r'^COPY (\d+)', re.M)),
+    'vertica': ("COPY %(table)s%(columns)s FROM LOCAL '%(file)s' DELIMITER ',' ENCLOSED BY '\"' "
+                "ESCAPE AS '\\' NULL '' ABORT ON ERROR;", None,
+                re.compile(r'Rows Loaded\s*\n-+\s*\n\s*(\d+)')),
+    # mysql leaves the feedback out in its batch mode, see the pipe transport of dbif
+    'mysql': ("LOAD DATA LOCAL INFILE '%(file)s' INTO TABLE %(table)s FIELDS TERMINATED BY ',' "
+              "OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n'%(columns)s;",
+              "SELECT ROW_COUNT() AS dbif_loaded, @@warning_count AS dbif_warnings;",
+              re.compile(r'dbif_loaded\W+dbif_warnings\W+(\d+)\W+(\d+)')),
+}
+_ORACLE_LOADED = re.compile(r'^(\d+) rows? created', re.M)
+_ORACLE_DEFINE = re.compile(r'^define\s+(OFF|"(.)")', re.M | re.I)
+DIALECTS = sorted(_LOAD_CMDS.keys() + ['oracle'])
+
+
+class Segment:
+    '''A run of INSERTs into the same table and columns, and the file their
+    rows are in.'''
+    def __init__(self, table, columns, file):
+        self.table = table
+        self.columns = columns
+        self.file = file
+        self.rows = 0
+
+
+def parse_insert(stmt, dbms):
+    '''The table, the column list and the rows of an INSERT of literals.
+    Rows are lists of values: None for NULL, the text of numbers and
+    strings as 1-tuples. None if stmt is something else.'''
+    match = _INSERT.match(stmt)
+    if not match:
+        return None
+    string = dbms == 'mysql' and _MYSQL_STRING or _STRING
+    rows = []
+    pos = match.end()
+    while True:
+        if stmt[pos:pos + 1] != '(':
+            return None
+        row, pos = _parse_row(stmt, pos + 1, string, dbms == 'mysql')
+        if row is None:
+            return None
+        rows.append(row)
+        pos = _skip_space(stmt, pos)
+        if stmt[pos:pos + 1] == ',':
+            pos = _skip_space(stmt, pos + 1)
+            continue
+        if stmt[pos:].strip() != ';':
+            return None
+        return match.group(1), match.group(2) and ' ' + match.group(2) or '', rows
+
+def _parse_row(stmt, pos, string, backslashes):
+    '''The values of a row from just after its "(" up to and with its ")".'''
+    row = []
+    while True:
+        pos = _skip_space(stmt, pos)
+        match = string.match(stmt, pos)
+        if match:
+            row.append((_unquote(match.group(1), backslashes),))
+        else:
+            match = _NULL.match(stmt, pos)
+            if match:
+                row.append(None)
+            else:
+                match = _NUMBER.match(stmt, pos)
+                if not match:
+                    return None, pos
+                row.append(match.group(0))
+        pos = _skip_space(stmt, match.end())
+        if stmt[pos:pos + 1] == ')':
+            return row, pos + 1
+        if stmt[pos:pos + 1] != ',':
+            return None, pos
+        pos += 1
+
+def _skip_space(text, pos):
+    while pos < len(text) and text[pos].isspace():
+        pos += 1
+    return pos
+
+def _unquote(text, backslashes):
+    if backslashes:
+        return re.sub(r"\\(.)|''", lambda m: m.group(1) is None and "'"
+                      or _MYSQL_ESCAPES.get(m.group(1), m.group(1)), text)
+    return text.replace("''", "'")
+
+def _values_text(stmt, dbms):
+    '''The VALUES rows of an INSERT as they are written, one per item.'''
+    rows = []
+    string = dbms == 'mysql' and _MYSQL_STRING or _STRING
+    pos = _INSERT.match(stmt).end()
+    while stmt[pos:pos + 1] == '(':
+        end = _parse_row(stmt, pos + 1, string, dbms == 'mysql')[1]
+        rows.append(stmt[pos:end])
+        pos = _skip_space(stmt, end)
+        if stmt[pos:pos + 1] == ',':
+            pos = _skip_space(stmt, pos + 1)
+    return rows
+
+def _into(table, columns, row):
+    '''The INTO of a row in an INSERT ALL.'''
+    return 'INTO %s%s VALUES %s' % (table, columns, row)
+
+def _wrap(text, width=SQLPLUS_LINE):
+    '''The lines of text, broken after the commas outside of strings where
+    it is longer than width. None if a piece between two commas is.'''
+    if len(text) <= width:
+        return [text]
+    pieces = []
+    start = 0
+    quoted = False
+    for i, c in enumerate(text):
+        if c == "'":
+            quoted = not quoted
+        elif c == ',' and not quoted:
+            pieces.append(text[start:i + 1].strip())
+            start = i + 1
+    pieces.append(text[start:].strip())
+    lines = []
+    for piece in pieces:
+        if len(piece) > width:
+            return None
+        if lines and len(lines[-1]) + 1 + len(piece) <= width:
+            lines[-1] += ' ' + piece
+        else:
+            lines.append(piece)
+    return lines
+
+def encode_row(row, dbms):
+    '''A line of the data file loaded by the client.'''
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append(dbms == 'mysql' and '\\N' or '')
+        elif isinstance(value, tuple):
+            text = value[0]
+            if dbms == 'postgresql':
+                text = text.replace('"', '""')
+            else:
+                text = text.replace('\\', '\\\\').replace('"', '\\"')
+                if dbms == 'mysql':
+                    text = text.replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+            fields.append('"' + text + '"')
+        else:
+            fields.append(value)
+    return ','.join(fields) + '\n'
+
+def statements(file, dbms):
+    '''The statements of a script, read a line at a time. Comments and
+    blank lines between statements are dropped.'''
+    lines = []
+    for line in file:
+        if not lines and (not line.strip() or line.lstrip().startswith('--')):
+            continue
+        lines.append(line)
+        if not line.rstrip().endswith(';'):
+            continue
+        stmt = ''.join(lines)
+        quotes = dbms == 'mysql' and re.sub(r'\\.', '', stmt) or stmt
+        if quotes.count("'") % 2 == 0:
+            yield stmt
+            lines = []
+    if ''.join(lines).strip():
+        yield ''.join(lines)
+
+def prepare(sql_file, dbms, min_bytes=0, dir=None):
+    '''A BulkLoad of the script, None if it is smaller than min_bytes or
+    not only INSERTs of literals and COMMITs.'''
+    if dbms not in DIALECTS or os.path.getsize(sql_file) < min_bytes:
+        return None
+    load = BulkLoad(dbms, dir)
+    try:
+        with open(sql_file, 'r') as file:
+            for stmt in statements(file, dbms):
+                if _COMMIT.match(stmt):
+                    continue
+                if not load.add(stmt):
+                    load.close()
+                    return None
+        load.finish()
+    except Exception:
+        load.close()
+        raise
+    if not load.rows:
+        load.close()
+        return None
+    return load
+
+
+class BulkLoad:
+    def __init__(self, dbms, dir=None):
+        self.dbms = dbms
+        self.dir = tempfile.mkdtemp(prefix='bulkload.', dir=dir)
+        self.segments = []
+        self.rows = 0
+        self.errors = []
+        self._out = None
+
+    def add(self, stmt):
+        '''Add the rows of an INSERT. Returns False if it is not one that
+        can be loaded.'''
+        insert = parse_insert(stmt, self.dbms)
+        if insert is None:
+            return False
+        table, columns, rows = insert
+        if self.dbms == 'oracle':
+            lines = [r + '\n' for r in _values_text(stmt, self.dbms)]
+            if [l for l in lines if l.count('\n') > 1]:
+                return False # sqlplus would take a blank line in a string for the end of the statement
+            if [l for l in lines if _wrap(_into(table, columns, l[:-1])) is None]:
+                return False
+        else:
+            lines = [encode_row(r, self.dbms) for r in rows]
+        last = self.segments and self.segments[-1] or None
+        if not last or (last.table, last.columns) != (table, columns):
+            self.finish()
+            last = Segment(table, columns, os.path.join(self.dir, '%d.dat' % (len(self.segments) + 1,)))
+            self.segments.append(last)
+            self._out = open(last.file, 'w')
+        self._out.writelines(lines)
+        last.rows += len(rows)
+        self.rows += len(rows)
+        return True
+
+    def finish(self):
+        '''Close the data file being written.'''
+        if self._out:
+            self._out.close()
+            self._out = None
+
+    def load(self, db, fail_fast=False):
+        '''Load every segment through a connected interface. Returns False
+        if the client exited, like exec_sql_file. The errors of the client
+        and the loads that fell short are in errors. With fail_fast the
+        segments after the first one with errors are not loaded.'''
+        self.errors = []
+        try:
+            for segment in self.segments:
+                if self.dbms == 'oracle':
+                    loaded = self._insert_all(db, segment)
+                else:
+                    loaded = self._load_file(db, segment)
+                if loaded != segment.rows:
+                    self.errors.append('ERROR: bulk load of %s: %s of %d rows loaded'
+                                       % (segment.table, loaded is None and 'unknown' or loaded,
+                                          segment.rows))
+                if self.errors and fail_fast:
+                    break
+        except pexpect.EOF:
+            self.errors.extend(db.dequeue_errors())
+            return False
+        return True
+
+    def close(self):
+        '''Remove the data files.'''
+        self.finish()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _load_file(self, db, segment):
+        '''Returns how many rows the client says it loaded, None if it does
+        not say.'''
+        cmd, count_cmd, loaded = _LOAD_CMDS[self.dbms]
+        cmd = cmd % dict(table=segment.table, columns=segment.columns, file=os.path.abspath(segment.file))
+        if count_cmd:
+            cmd += '\n' + count_cmd
+        db.exec_cmd(cmd)
+        errors = db.dequeue_errors()
+        self.errors.extend(errors)
+        if errors:
+            return None
+        match = loaded.search(db.last_output())
+        if not match:
+            return None
+        if self.dbms == 'mysql':
+            # LOCAL turns the rows it could not load into warnings
+            if int(match.group(2)):
+                self.errors.append('ERROR: bulk load of %s: %s warnings' % (segment.table, match.group(2)))
+        return int(match.group(1))
+
+    def _insert_all(self, db, segment):
+        loaded = 0
+        # a & in the data would be taken for a substitution variable. The
+        # script may have turned that off itself, or use another character.
+        db.exec_cmd('show define')
+        match = _ORACLE_DEFINE.search(db.last_output())
+        define = match and (match.group(2) or 'off') or 'on'
+        db.exec_cmd('set define off')
+        try:
+            for rows in self._batches(segment):
+                lines = []
+                for row in rows:
+                    lines.extend(_wrap(_into(segment.table, segment.columns, row)))
+                db.exec_cmd('INSERT ALL\n%s\nSELECT * FROM dual;' % ('\n'.join(lines),))
+                errors = db.dequeue_errors()
+                self.errors.extend(errors)
+                match = _ORACLE_LOADED.search(db.last_output())
+                if match:
+                    loaded += int(match.group(1))
+                if errors:
+                    return loaded
+            return loaded
+        finally:
+            if db.connected():
+                db.exec_cmd('set define ' + define)
+
+    def _batches(self, segment):
+        '''The rows of the data file, BATCH_ROWS at a time, fewer if they
+        are more than BATCH_BYTES.'''
+        rows = []
+        size = 0
+        with open(segment.file, 'r') as file:
+            for line in file:
+                row = line.rstrip('\n')
+                if rows and (len(rows) == BATCH_ROWS or size + len(row) > BATCH_BYTES):
+                    yield rows
+                    rows = []
+                    size = 0
+                rows.append(row)
+                size += len(row)
+        if rows:
+            yield rows
@@ -19,7 +19,7 @@ PYTHON_BIN=
 
 function usage()
 {
-    echo "$0 -e db [-v | -V] [-l sqllogfile] [-r] [-n] [-f] [-i] [-a] [-g] [-T user_input_timeout]"
+    echo "$0 -e db [-v | -V] [-l sqllogfile] [-r] [-n] [-f] [-i] [-a] [-g] [-k] [-L] [-P] [-T user_input_timeout]"
     echo "\
           -e db[@host]     db is the db to push code into.
           [-v]             Verbose mode
@@ -35,6 +35,9 @@ function usage()
           [-T timeout]     User input timeout. Will exit with error when timeout reached. Default to 30 secs.
           [-d dbtype]      Specify type of db (oracle, vertica, mysql, postgresql). Oracle by default.
           [-B]             Disable bacgrounding mode. Should be used for interactive runs.
+          [-k]             Keep the database sessions logged in between scripts, with a session broker.
+          [-L]             Load the large scripts of only INSERTs through the bulk load of the client.
+          [-P]             Run the clients on pipes in their batch mode instead of on a terminal.
           "
           #[-S]             If specified, will pass the given flags to the SQL*Plus interaction script. Enter them in quotes like this: -S \"-d -h\"
     exit -1
@@ -72,9 +75,11 @@ cddir=""
 hist_path="complete/`hostname`"
 timeout="30"
 no_background=""
+use_broker=0
+broker_socket=""
 
 ### MAIN ####
-while getopts "e:T:l:d:r:c:v n V f i a g S: C: B" options; do
+while getopts "e:T:l:d:r:c:v n V f i a g S: C: B k L P" options; do
     case "$options" in
         e ) environment=$OPTARG
         ;;
@@ -110,6 +115,12 @@ while getopts "e:T:l:d:r:c:v n V f i a g S: C: B" options; do
         ;;
         B ) no_background=1
         ;;
+        k ) use_broker=1
+        ;;
+        L ) interact_args="--bulk $interact_args"
+        ;;
+        P ) interact_args="--transport pipe $interact_args"
+        ;;
         \? ) echo "bad arg"
         usage
         ;;
@@ -161,6 +172,15 @@ fi
 touch $sqllogfile
 echo "Detailed logs in $sqllogfile"
 
+# the broker runs in the push directory, where the scripts are
+if [ $use_broker -eq 1 ]; then
+    broker_socket="/tmp/db_release_broker.$USER.$$.sock"
+    $PYTHON_BIN $INSTALL_PATH/pyfiles/broker.py start $broker_socket -l "${sqllogfile%.log}.broker.log"
+    interact_args="$interact_args --broker $broker_socket"
+    # do not leave it logged in when the deployment is abandoned
+    trap stop_broker EXIT
+fi
+
 ##### end MAIN
 
 # some people still call that, make it empty and create a private version
@@ -202,6 +222,14 @@ function kill_child()
     kill $!
 }
 
+function stop_broker()
+{
+    if [ "$broker_socket" != "" ]; then
+        $PYTHON_BIN $INSTALL_PATH/pyfiles/broker.py stop $broker_socket
+        broker_socket=""
+    fi
+}
+
 #
 # Runs the .sql file passed as argument. Appends the content in $sqllogfile 
 # The caller can either read the return value of sqlplus from SQL_RETVAL variable
@@ -217,11 +245,13 @@ function sql_run()
         sql_args=""
     fi
     pass_args=""
+    retry_args=""
 
     pass_args="$pass_args $interact_args"
 
     if [ "$add_args" ]; then
         pass_args="$pass_args $add_args"
+        retry_args="$add_args"
         add_args=""
     fi
 
@@ -251,13 +281,13 @@ function sql_run()
         SQL_RETVAL=$?
         set -e
     else
-        trap kill_child EXIT
+        trap "kill_child; stop_broker" EXIT
         set +e
         $PYTHON_BIN $INSTALL_PATH/pyfiles/sql_user.py $dbuser $password $database $sql_file -l $sqllogfile -r $hist_path -x "$sql_args" $pass_args \
         & wait $! # without this trap will not execute
         SQL_RETVAL=$?
         set -e
-        trap - EXIT
+        trap stop_broker EXIT
     fi
 
     ret_val=$SQL_RETVAL
@@ -275,6 +305,7 @@ function sql_run()
             echo "No password given. Abandon deployment."
             exit 1
         fi
+        add_args="$retry_args"
         sql_run $sql_file $sql_args || exit $?
     elif [[ $ret_val == 0 ]]; then
         echo "$ret_val: Exited normally."
@@ -291,9 +322,46 @@ function sql_run_always()
     sql_run
 }
 
+#
+# Runs all the .sql files listed in the manifest passed as argument in
+# a single sql_user.py process, reusing the client sessions. Scripts run
+# as $dbuser unless the manifest switches users with "user NAME [PASSWORD]".
+#
+function sql_run_batch()
+{
+    manifest=$1
+    add_args="$add_args -b"
+    sql_run $manifest
+}
+
+#
+# Checks the .sql files listed in the manifest passed as argument, their
+# execution records and the login of every user on $environment, without
+# running anything. Abandons the deployment if something is wrong.
+#
+function sql_preflight()
+{
+    manifest=$1
+
+    if [ "$dbuser" != "$olddbuser" ]; then
+        olddbuser="$dbuser"
+        _get_dbpassword
+    fi
+
+    set +e
+    $PYTHON_BIN $INSTALL_PATH/pyfiles/preflight.py $dbuser $password $manifest -b -t $environment -r $hist_path ${db_type:+-D $db_type}
+    ret_val=$?
+    set -e
+    if [[ $ret_val != 0 ]]; then
+        echo "$ret_val: Pre-flight check failed."
+        echo "Abandoning deployment."
+        exit 1
+    fi
+}
+
 function end_dbpush()
 {
-    do_nothing=1
+    stop_broker
     echo " === End $0"
 }
 
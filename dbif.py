@@ -1,9 +1,33 @@
 import re
+import time
 import pexpect
 import logging
 import sys
 import unittest
 import os
+import json
+import random
+import socket
+import threading
+from collections import deque
+
+import util
+import metrics
+import sessionloop
+import sessionlog
+import pipespawn
+
+# how the clients are spawned: on a pseudo-terminal as if a user typed the
+# commands, or on pipes in their batch mode, see pipespawn
+PTY = 'pty'
+PIPE = 'pipe'
+TRANSPORTS = [PTY, PIPE]
+
+class DONE:
+    '''In the expect patterns of exec_cmd, like pexpect.EOF, the end of the
+    output of the command. Every command is followed by one printing a
+    marker made for it, the client is done with the command when the marker
+    comes back.'''
 
 
 class DisconnectedException(Exception):
@@ -17,8 +41,14 @@ class DisconnectedException(Exception):
 
 class _CommandInterface:
     PXP_LOGFILE = 'dbif_pexpect.log'
+    STREAM_CHUNK_SIZE = 65536 # bytes read at a time when streaming output
+    STREAM_TAIL_LINES = 200 # lines of streamed output kept in memory
+    FAIL_FAST_CONTEXT = 5 # lines of output before the first error reported with it
+    FAIL_FAST_DRAIN = 0.5 # secs to wait for stray output after interrupting the client
+    MARKER_WINDOW = 4096 # bytes at the end of the output searched for the marker
     def __init__(self, logger=None, rawlog='dbif_pexpect.log'):
         self.PXP_LOGFILE = rawlog
+        self.dbms = '' # the syntax of the scripts, see util
         self.SPAWN_CMD = ''
         self.SPAWN_WITH_HOST_CMD = ''
         self.SET_PROMPT_CMD = ''
@@ -27,11 +57,39 @@ class _CommandInterface:
         self.ERROR_PATTERN = ''
         self.LOGIN_ERROR = ''
         self.LOGIN_SUCCESS = ''
+        # the pipe transport: the client in its batch mode
+        self.PIPE_SPAWN_CMD = ''
+        self.PIPE_SPAWN_WITH_HOST_CMD = ''
+        # the command printing the marker, "dbif-" and a nonce, after every
+        # command. It does not have the two in one piece, as the terminal
+        # echoing it or vsql redrawing it would put the marker in the output.
+        self.MARKER_CMD = ''
+        self.MARKER_OUTPUT = 'dbif-%(nonce)s' # what the client prints for MARKER_CMD on pipes
+        self.MARKER_TTY_OUTPUT = 'dbif-%(nonce)s' # and on a pty, where it may print its prompt
+        # fail fast: commands sent before and after the script, and whether
+        # they make the client stop the script by itself on an error. If not
+        # it is interrupted with ^C.
+        self.FAIL_FAST_ON_CMDS = []
+        self.FAIL_FAST_OFF_CMDS = []
+        self.STOPS_ON_ERROR = False
 
         self.prompt = ''
         self._connected = False
         self._errors = []
+        self._tail = deque(maxlen=self.STREAM_TAIL_LINES)
         self._child = None
+        self._fail_fast = False
+        self._failure = None
+        self._output_bytes = 0
+        self._last_output = ''
+        self._profile = None
+        self.cwd = None # where the client runs, and relative script paths start
+        self.metrics = None # a metrics.RunMetrics to time the phases of the session
+        self.spool = None # a spool.OutputSpool the output of the session is also written to
+        self.rawlog_policy = sessionlog.SessionLogPolicy() # how PXP_LOGFILE is written
+        self.transport = PTY # how the client is spawned for connect, see TRANSPORTS
+        self._marker_cmd = None
+        self._done = None # the pattern of the marker of the last command
 
         if logger:
             self._logger = logger
@@ -45,7 +103,7 @@ class _CommandInterface:
     def run_manual(self, user, passwd, dbname, host='', exit=True):
         '''Spawns the sql client process in interfactive mode, returns True is
         all is well false if the client terminated.'''
-        self._child = pexpect.spawn(self._spawn_cmd(user, passwd, dbname, host))
+        self._child = pexpect.spawn(self._spawn_cmd(user, passwd, dbname, host), cwd=self.cwd)
         try:
             self._child.interact('\x1b')
         except OSError: # the user quit manualy
@@ -60,6 +118,9 @@ class _CommandInterface:
     def attach(self):
         '''Does the same thing as run_manual, but on an already connected
         interface. Returns True if the client is still running.'''
+        if self.transport == PIPE:
+            self._logger.error('A client spawned on pipes cannot be attached to, use the pty transport.')
+            return self._child.isalive()
         self._child.setecho(True)
         try:
             self._child.interact('\x1b')
@@ -75,40 +136,75 @@ class _CommandInterface:
 
     def connect(self, user, passwd, dbname, host=''):
         '''Connect to the database and return True if connected, False otherwise'''
-        self._logger.info('Spawning the following command:' + self._spawn_cmd(user, '------', dbname, host))
-        self._child = pexpect.spawn(self._spawn_cmd(user, passwd, dbname, host))
-        self._child.logfile = open(self.PXP_LOGFILE, 'w')
-        self._child.setecho(False)
-        result = self._child.expect([self.LOGIN_SUCCESS, self.LOGIN_ERROR, pexpect.EOF], timeout=10)
-        self._find_errors()
+        with self._phase('connect', user=user, database=dbname):
+            self._spawn(user, passwd, dbname, host)
+            result = self._child.expect([self.LOGIN_SUCCESS, self.LOGIN_ERROR, pexpect.EOF], timeout=10)
+            self._find_errors()
 
         if result > 0:
             return False
         self._connected = True
 
         # set_prompt also consumes all the garbage until first good prompt, except for mysql
-        self._set_prompt(user, dbname)
-        self._prepare_env()
+        with self._phase('set_prompt'):
+            self._set_prompt(user, dbname)
+        with self._phase('prepare_env'):
+            self._prepare_env()
         return True
 
     def exec_cmd(self, cmd, expect_patterns=None, timeout=None):
         '''Execute a command. If expect_patterns not specified
-        defaults to the prompt. Returns pattern index.'''
+        defaults to DONE, the end of its output. Returns pattern index.'''
         if not self._child or not self._child.isalive():
             raise DisconnectedException('Cannot send commands through an unconnected interface')
-        if not expect_patterns:
-            expect_patterns = [self.prompt]
-        self._child.sendline(cmd)
-        pat_num = self._child.expect(expect_patterns, timeout=timeout)
-        self._find_errors()
+        self._send_cmd(cmd, timeout)
+        expect_patterns = self._expect_patterns(expect_patterns)
+        pat_num = self._child.expect(expect_patterns, timeout=timeout, searchwindowsize=self.MARKER_WINDOW)
+        self._find_errors(expect_patterns[pat_num] is self._done)
         return pat_num
 
-    def exec_sql_file(self, sql_file, args=''):
+    def exec_sql_file(self, sql_file, args='', stream=False, fail_fast=False, profile=None):
         '''Execute a script file. Optionally pass arguments to it.
-        Return False EOF was hit, True otherwise.'''
+        Return False EOF was hit, True otherwise. With stream the output
+        is logged and scanned for errors as it arrives, and only its last
+        STREAM_TAIL_LINES lines are kept, see output_tail. fail_fast
+        implies stream and stops the script at its first error, see
+        failure. With a metrics.StatementProfile the script, and the ones
+        it includes, are run one statement at a time through exec_cmd and
+        every statement is added to the profile; stream is ignored then.'''
         cmd = self._script_exec_cmd(sql_file, args)
-        result = self.exec_cmd(cmd, [pexpect.EOF, self.prompt])
-        return result == 1
+        self._failure = None
+        with self._phase('script', file=sql_file):
+            if profile is not None:
+                return self._exec_statements(sql_file, args, fail_fast, profile)
+            if fail_fast:
+                return self._exec_fail_fast(cmd)
+            if stream:
+                if not self._child or not self._child.isalive():
+                    raise DisconnectedException('Cannot send commands through an unconnected interface')
+                self._send_cmd(cmd)
+                return self._stream_output()
+            result = self.exec_cmd(cmd, [pexpect.EOF, DONE])
+            return result == 1
+
+    def define_args(self, args):
+        '''Pass args to the statements sent through exec_cmd next, as
+        exec_sql_file passes them to a script.'''
+        for cmd in self._script_args_cmds(args):
+            self.exec_cmd(cmd)
+
+    def failure(self):
+        '''The first error that stopped the last fail fast script and the
+        output lines leading to it, None if it was not stopped.'''
+        return self._failure
+
+    def output_tail(self):
+        '''The last lines of output of the last streamed script.'''
+        return list(self._tail)
+
+    def last_output(self):
+        '''The output of the last command run through exec_cmd.'''
+        return self._last_output
 
     def dequeue_errors(self):
         '''Get all the errors since last expect call. If the errors
@@ -123,12 +219,14 @@ class _CommandInterface:
     def rollback(self):
         '''Rollback changes'''
         self._logger.info('# Rolling back changes.')
-        self.exec_cmd('rollback;')
+        with self._phase('rollback'):
+            self.exec_cmd('rollback;')
 
     def commit(self):
         '''Commit changes.'''
         self._logger.info('# Commiting changes.')
-        self.exec_cmd('commit;')
+        with self._phase('commit'):
+            self.exec_cmd('commit;')
 
     def exit(self):
         '''Send an exit command, if client does not exit shut it down by force'''
@@ -138,35 +236,368 @@ class _CommandInterface:
             self.exec_cmd(self.EXIT_CMD, [pexpect.EOF, pexpect.TIMEOUT], timeout=3)
             if self._child.isalive():
                 self._child.terminate(True)
+        self._close_rawlog()
+
+    def close(self):
+        '''Shut the client down by force, whether it logged in or not. After
+        a failed login there is nobody to send the exit command to, but
+        the client may still be running.'''
+        if self._child and self._child.isalive():
+            self._child.terminate(True)
+        self._connected = False
+        self._close_rawlog()
 
     def connected(self):
         '''Check if the spawned process is alive'''
         return self._child and self._child.isalive() and self._connected
 
-    def _find_errors(self):
-        '''Look at the child's "before" attribute and look at lines that have errors'''
+    # The coroutines below do what the methods of the same name without
+    # _async do, for a sessionloop.SessionLoop to run many sessions on one
+    # thread. The phases of the session are not timed.
+
+    def connect_async(self, user, passwd, dbname, host=''):
+        self._spawn(user, passwd, dbname, host)
+        # a sleep in sendline would hold up every session of the loop
+        self._child.delaybeforesend = None
+        result = yield sessionloop.Expect(self._child, [self.LOGIN_SUCCESS, self.LOGIN_ERROR, pexpect.EOF], 10)
+        self._find_errors()
+        if result > 0:
+            yield sessionloop.Return(False)
+        self._connected = True
+        for cmd in self._set_prompt_cmds(user, dbname) + self._prepare_env_cmds():
+            yield self.exec_cmd_async(cmd)
+        yield sessionloop.Return(True)
+
+    def exec_cmd_async(self, cmd, expect_patterns=None, timeout=None):
+        if not self._child or not self._child.isalive():
+            raise DisconnectedException('Cannot send commands through an unconnected interface')
+        yield self._send_cmd_async(cmd, timeout)
+        expect_patterns = self._expect_patterns(expect_patterns)
+        pat_num = yield sessionloop.Expect(self._child, expect_patterns, timeout, self.MARKER_WINDOW)
+        self._find_errors(expect_patterns[pat_num] is self._done)
+        yield sessionloop.Return(pat_num)
+
+    def exec_sql_file_async(self, sql_file, args='', stream=False, fail_fast=False):
+        '''Statement profiles are only taken by exec_sql_file.'''
+        cmd = self._script_exec_cmd(sql_file, args)
+        self._failure = None
+        if fail_fast:
+            not_eof = yield self._exec_fail_fast_async(cmd)
+        elif stream:
+            if not self._child or not self._child.isalive():
+                raise DisconnectedException('Cannot send commands through an unconnected interface')
+            yield self._send_cmd_async(cmd)
+            not_eof = yield self._stream_output_async()
+        else:
+            not_eof = (yield self.exec_cmd_async(cmd, [pexpect.EOF, DONE])) == 1
+        yield sessionloop.Return(not_eof)
+
+    def rollback_async(self):
+        self._logger.info('# Rolling back changes.')
+        yield self.exec_cmd_async('rollback;')
+
+    def commit_async(self):
+        self._logger.info('# Commiting changes.')
+        yield self.exec_cmd_async('commit;')
+
+    def exit_async(self):
+        self._logger.info('Terminating...')
+        if self._child and self._child.isalive():
+            yield self.exec_cmd_async(self.EXIT_CMD, [pexpect.EOF, pexpect.TIMEOUT], timeout=3)
+            if self._child.isalive():
+                self._child.terminate(True)
+        self._close_rawlog()
+
+    def _phase(self, name, **tags):
+        '''Context manager timing a phase of the session, if it is measured.'''
+        if self.metrics:
+            return self.metrics.phase(name, **tags)
+        return metrics.null_phase()
+
+    def _count_output(self, size, errors):
+        '''Count output bytes and error lines, if the session is measured.'''
+        self._output_bytes += size
+        if self.metrics:
+            self.metrics.count('output_bytes', size)
+            self.metrics.count('error_lines', errors)
+
+    def _path(self, file):
+        '''Path of a script file relative to the cwd of the client.'''
+        if self.cwd:
+            return os.path.join(self.cwd, file)
+        return file
+
+    def _send_cmd(self, cmd, timeout=None):
+        '''Send a command line to the client, and the marker after it.'''
+        self._send_marker(cmd)
+
+    def _send_marker(self, cmd=None, delay=True):
+        '''Send the command printing a new marker, after cmd if given. They
+        go in one write, as pexpect waits its delaybeforesend before every
+        write; without delay not even that. Returns the pattern of what the
+        client prints for the marker, also kept in _done.'''
+        nonce = '%016x' % (random.getrandbits(64),)
+        self._marker_cmd = self.MARKER_CMD % dict(nonce=nonce)
+        lines = cmd is not None and [cmd, self._marker_cmd] or [self._marker_cmd]
+        text = ''.join([line + self._child.linesep for line in lines])
+        if delay:
+            self._child.send(text)
+        else:
+            delaybeforesend, self._child.delaybeforesend = self._child.delaybeforesend, None
+            try:
+                self._child.send(text)
+            finally:
+                self._child.delaybeforesend = delaybeforesend
+        if self.transport == PIPE:
+            output = re.escape(self.MARKER_OUTPUT % dict(nonce=nonce))
+            self._done = '(?m)^' + output.replace('\\\n', '\\r?\\n') + '\\r?\\n'
+        else:
+            output = re.escape(self.MARKER_TTY_OUTPUT % dict(nonce=nonce, prompt=self.prompt))
+            # and the rest of the output of the marker command, up to the prompt
+            self._done = output.replace('\\\n', '\\r?\\n') + r'[\s\S]*?' + re.escape(self.prompt)
+        return self._done
+
+    def _expect_patterns(self, expect_patterns):
+        '''The patterns to expect after a command, DONE standing for the
+        pattern of the marker sent with it.'''
+        return [p is DONE and self._done or p for p in expect_patterns or [DONE]]
+
+    def _command_output(self, text):
+        '''The output of a command without what a client on a terminal
+        prints before the marker: the prompt after the command and the
+        echo of the marker command.'''
+        if self.transport == PIPE:
+            return text
+        prompt = text.rfind(self.prompt, max(0, len(text) - self.MARKER_WINDOW))
+        if prompt < 0:
+            return text
+        return text[:text.rfind('\n', 0, prompt) + 1]
+
+    def _send_cmd_async(self, cmd, timeout=None):
+        '''_send_cmd as a coroutine.'''
+        self._send_cmd(cmd, timeout)
+        yield sessionloop.Return()
+
+    def _exec_statements(self, sql_file, args, fail_fast, profile):
+        '''Run a script statement by statement, see exec_sql_file.'''
+        self.define_args(args)
+        errors = []
+        try:
+            self._run_statements(sql_file, fail_fast, profile, errors)
+        except pexpect.EOF:
+            self._errors = errors
+            return False
+        self._errors = errors
+        return True
+
+    def _run_statements(self, sql_file, fail_fast, profile, errors):
+        '''Returns False if fail_fast stopped the script.'''
+        with open(self._path(sql_file), 'r') as file:
+            statements = util.split_script(file.read(), self.dbms)
+        for lineno, stmt in statements:
+            sub = util.match_subscript(stmt + '\n', self.dbms)
+            if sub:
+                if not self._run_statements(sub, fail_fast, profile, errors):
+                    return False
+                continue
+            output_bytes = self._output_bytes
+            if self.spool:
+                self.spool.statement()
+            start = time.time()
+            self.exec_cmd(stmt)
+            profile.add(sql_file, lineno, stmt, time.time() - start,
+                        self._output_bytes - output_bytes, len(self._errors))
+            errors.extend(self._errors)
+            if self._errors and fail_fast:
+                self._failure = stmt.split('\n')[-self.FAIL_FAST_CONTEXT:] + \
+                    [l.rstrip('\r') for l in self._errors]
+                return False
+        return True
+
+    def _script_args_cmds(self, args):
+        '''Commands that pass args to the statements of a script run
+        one at a time. Scripts do not take arguments by default.'''
+        return []
+
+    def _exec_fail_fast(self, cmd):
+        '''Run a script command, interrupting it at the first error.'''
+        return sessionloop.run_blocking(self._exec_fail_fast_async(cmd))
+
+    def _exec_fail_fast_async(self, cmd):
+        for on_cmd in self.FAIL_FAST_ON_CMDS:
+            yield self.exec_cmd_async(on_cmd)
+        if not self._child or not self._child.isalive():
+            raise DisconnectedException('Cannot send commands through an unconnected interface')
+        self._fail_fast = True
+        try:
+            yield self._send_cmd_async(cmd)
+            not_eof = yield self._stream_output_async()
+        finally:
+            self._fail_fast = False
+        if self._failure:
+            # what the client said right after the error, like the echo of
+            # the failed statement or the cancellation
+            tail = [l.rstrip('\r') for l in self._tail]
+            if self._failure[-1] in tail:
+                after = tail.index(self._failure[-1]) + 1
+                self._failure += tail[after:after + self.FAIL_FAST_CONTEXT]
+        if not_eof and self._failure and not self.STOPS_ON_ERROR:
+            yield self._drain_async(self.FAIL_FAST_DRAIN)
+        if not_eof:
+            errors = self._errors
+            for off_cmd in self.FAIL_FAST_OFF_CMDS:
+                yield self.exec_cmd_async(off_cmd)
+            self._errors = errors
+        yield sessionloop.Return(not_eof)
+
+    def _drain(self, timeout):
+        '''Throw away output, like the extra prompts of an interrupted
+        client, until there is none for timeout secs.'''
+        sessionloop.run_blocking(self._drain_async(timeout))
+
+    def _drain_async(self, timeout):
+        try:
+            while True:
+                self._logger.debug((yield sessionloop.Read(self._child, self.STREAM_CHUNK_SIZE, timeout)))
+        except pexpect.TIMEOUT:
+            pass
+        except pexpect.EOF:
+            pass
+        self._child.buffer = ''
+
+    def _stream_output(self, timeout=None):
+        '''Read the client output a chunk at a time until the marker of
+        the command shows up. Returns False if EOF was hit, True otherwise.'''
+        return sessionloop.run_blocking(self._stream_output_async(timeout))
+
+    def _stream_output_async(self, timeout=None):
+        done = re.compile(self._done)
+        error = re.compile(self.ERROR_PATTERN)
+        self._errors = []
+        self._tail.clear()
+        pending = self._child.buffer
+        self._child.buffer = ''
+        marker = self.transport == PIPE and self.MARKER_OUTPUT or self.MARKER_TTY_OUTPUT
+        while True:
+            match = done.search(pending)
+            if match:
+                self._consume_output(self._command_output(pending[:match.start()]), error)
+                self._child.buffer = pending[match.end():]
+                yield sessionloop.Return(True)
+            # keep the last, incomplete, line around: the marker may start
+            # on it, or on the lines before when it has several. pending
+            # stays short, so is the search of the marker.
+            cut = pending.rfind('\n') + 1
+            for i in range(marker.count('\n')):
+                cut = pending.rfind('\n', 0, max(0, cut - 1)) + 1
+            if self.transport == PTY:
+                # and from the line of the prompt before the marker on
+                cut = min(cut, len(self._command_output(pending[:cut])))
+            if not cut and len(pending) > self.STREAM_CHUNK_SIZE + self.MARKER_WINDOW:
+                cut = len(pending) - self.MARKER_WINDOW
+            if cut:
+                self._consume_output(pending[:cut], error)
+                pending = pending[cut:]
+            try:
+                pending += yield sessionloop.Read(self._child, self.STREAM_CHUNK_SIZE, timeout)
+            except pexpect.EOF:
+                self._consume_output(pending, error)
+                yield sessionloop.Return(False)
+
+    def _consume_output(self, text, error):
+        '''Log a piece of streamed output and collect the errors in it.
+        In fail fast mode the first error interrupts the client.'''
+        if not text:
+            return
+        self._logger.critical(text)
+        lines = text.rstrip('\n').split('\n')
+        errors = [l for l in lines if error.match(l)]
+        if errors and self._fail_fast and not self._failure:
+            first = lines.index(errors[0])
+            self._failure = [l.rstrip('\r') for l in
+                             (list(self._tail) + lines[:first + 1])[-(self.FAIL_FAST_CONTEXT + 1):]]
+            if not self.STOPS_ON_ERROR:
+                self._logger.info('# Interrupting the script at its first error.')
+                self._child.sendintr()
+                if self.transport == PTY:
+                    # ^C throws away what is typed ahead on a terminal, the marker too
+                    self._child.sendline(self._marker_cmd)
+        self._tail.extend(lines)
+        self._errors.extend(errors)
+        self._count_output(len(text), len(errors))
+        if self.spool:
+            self.spool.write(text, errors)
+
+    def _find_errors(self, done=False):
+        '''Look at the child's "before" attribute and look at lines that have errors.
+        done says it ends at the marker of the command.'''
         before = self._child.before
+        if done:
+            before = self._command_output(before)
+        self._last_output = before
         if before:
             self._logger.critical(before)
         lines = before.split('\n')
         #print 'lines: ', lines
         #print 'after: ', self._child.after
         self._errors = [l for l in lines if re.match(self.ERROR_PATTERN, l)]
+        self._count_output(len(before), len(self._errors))
+        if self.spool:
+            self.spool.write(before, self._errors)
 
-    def _spawn_cmd(self, user, passwd, dbname, host=''):
+    def _spawn_cmd(self, user, passwd, dbname, host='', transport=PTY):
         '''Generate a command that spawns the client with the username/password'''
         if host:
-            return self.SPAWN_WITH_HOST_CMD % dict(user=user,
-                                           passwd=passwd,
-                                           dbname=dbname,
-                                           host=host)
+            cmd = transport == PIPE and self.PIPE_SPAWN_WITH_HOST_CMD or self.SPAWN_WITH_HOST_CMD
+            return cmd % dict(user=user,
+                              passwd=passwd,
+                              dbname=dbname,
+                              host=host)
         else:
-            return self.SPAWN_CMD % dict(user=user, passwd=passwd, dbname=dbname)
+            cmd = transport == PIPE and self.PIPE_SPAWN_CMD or self.SPAWN_CMD
+            return cmd % dict(user=user, passwd=passwd, dbname=dbname)
+
+    def _spawn(self, user, passwd, dbname, host=''):
+        '''Start the client, logging into the database.'''
+        self._logger.info('Spawning the following command:' +
+                          self._spawn_cmd(user, '------', dbname, host, self.transport))
+        self._prepare_spawn(user, passwd, dbname)
+        self._close_rawlog()
+        cmd = self._spawn_cmd(user, passwd, dbname, host, self.transport)
+        if self.transport == PIPE:
+            self._child = pipespawn.PipeSpawn(cmd, cwd=self.cwd)
+            self._child.logfile = self.rawlog_policy.open(self.PXP_LOGFILE)
+            # nothing to wait for before sending, the client reads its pipe when it is ready
+            self._child.delaybeforesend = None
+            # the batch modes print no banner or prompt: the client is logged
+            # in when the marker sent right away comes back
+            self.LOGIN_SUCCESS = self._send_marker()
+            return
+        self._child = pexpect.spawn(cmd, cwd=self.cwd)
+        self._child.logfile = self.rawlog_policy.open(self.PXP_LOGFILE)
+        self._child.setecho(False)
+
+    def _close_rawlog(self):
+        '''Write out and close the raw log of the client, see sessionlog.'''
+        if self._child and self._child.logfile:
+            self._child.logfile.close()
+            self._child.logfile = None
+
+    def _prepare_spawn(self, user, passwd, dbname):
+        '''Set up what the client needs before it is started.'''
+        pass
 
     def _set_prompt(self, user, dbname):
         '''Sets the tool's prompt to something meaningful'''
+        for cmd in self._set_prompt_cmds(user, dbname):
+            self.exec_cmd(cmd)
+
+    def _set_prompt_cmds(self, user, dbname):
+        '''Choose the prompt, and return the commands that make the client use it.'''
+        if self.transport == PIPE:
+            return [] # there is no prompt
         self.prompt = '%(user)s.%(dbname)s> ' % dict(user=user, dbname=dbname)
-        self.exec_cmd(self.SET_PROMPT_CMD % dict(prompt=self.prompt))
+        return [self.SET_PROMPT_CMD % dict(prompt=self.prompt)]
 
     def _script_exec_cmd(self, sql_file, args=''):
         '''Generate a command that executed a script file'''
@@ -174,7 +605,11 @@ class _CommandInterface:
 
     def _prepare_env(self):
         '''Set environment variables, to pretty up the output, etc.'''
-        pass
+        for cmd in self._prepare_env_cmds():
+            self.exec_cmd(cmd)
+
+    def _prepare_env_cmds(self):
+        return []
 
 
 #    def _escape_string(self, string):
@@ -220,6 +655,7 @@ class OracleInterface(_CommandInterface):
 
     def __init__(self, logger=None, rawlog='ora_client.log'):
         _CommandInterface.__init__(self, logger, rawlog=rawlog)
+        self.dbms = 'oracle'
         self.SPAWN_CMD = 'sqlplus %(user)s/%(passwd)s@%(dbname)s'
         # Oracle must use tnsnames
         self.SPAWN_WITH_HOST_CMD = 'sqlplus %(user)s/%(passwd)s@%(dbname)s'
@@ -229,7 +665,18 @@ class OracleInterface(_CommandInterface):
         self.ERROR_PATTERN = r'^.*(ORA|SP\d+)-\d*:.*$'
         self.LOGIN_ERROR = 'Enter user-name:'
         self.LOGIN_SUCCESS = 'Connected to:'
+        # silent, and exiting instead of asking again for a refused login
+        self.PIPE_SPAWN_CMD = 'sqlplus -S -L %(user)s/%(passwd)s@%(dbname)s'
+        self.PIPE_SPAWN_WITH_HOST_CMD = 'sqlplus -S -L %(user)s/%(passwd)s@%(dbname)s'
+        # sqlplus has nothing to join the two pieces with, it prints them on lines of their own
+        self.MARKER_CMD = 'prompt dbif-\nprompt %(nonce)s'
+        self.MARKER_OUTPUT = 'dbif-\n%(nonce)s'
+        self.MARKER_TTY_OUTPUT = 'dbif-\n%(prompt)s%(nonce)s'
         self.prompt = 'SQL> ' # we'll change this one later
+
+    def _script_args_cmds(self, args):
+        '''&1, &2, ... of the script'''
+        return ['DEFINE %d = "%s"' % (i + 1, arg) for i, arg in enumerate(args.split())]
 #    def _prepare_env(self):
 #        self.exec_cmd('SET DEFINE OFF')
 #
@@ -241,6 +688,7 @@ class PostgreInterface(_CommandInterface):
 
     def __init__(self, logger=None, rawlog='postgre_client.log'):
         _CommandInterface.__init__(self, logger, rawlog=rawlog)
+        self.dbms = 'postgresql'
         self.SPAWN_CMD = 'psql %(dbname)s %(user)s -w'
         self.SPAWN_WITH_HOST_CMD = 'psql -h %(host)s %(dbname)s %(user)s -w'
         self.SET_PROMPT_CMD = '\\set PROMPT1  \'%(prompt)s\''
@@ -249,45 +697,66 @@ class PostgreInterface(_CommandInterface):
         self.ERROR_PATTERN = r'^.*ERROR:.*$'
         self.LOGIN_ERROR = 'authentication failed'
         self.LOGIN_SUCCESS = 'Type "help" for help.'
+        # no psqlrc, and the failed statements echoed after their error
+        self.PIPE_SPAWN_CMD = 'psql -X -b %(dbname)s %(user)s -w'
+        self.PIPE_SPAWN_WITH_HOST_CMD = 'psql -X -b -h %(host)s %(dbname)s %(user)s -w'
+        self.MARKER_CMD = "\\echo 'dbif-'%(nonce)s"
+        self.FAIL_FAST_ON_CMDS = ['\\set ON_ERROR_STOP on', '\\set ECHO errors']
+        self.FAIL_FAST_OFF_CMDS = ['\\set ON_ERROR_STOP off', '\\set ECHO none']
+        self.STOPS_ON_ERROR = True
         self.prompt = 'sql=> ' # we'll change this one later
 
-    def connect(self, user, passwd, dbname, host=''):
+    def _prepare_spawn(self, user, passwd, dbname):
         os.putenv('PGPASSWORD', passwd)
-        return _CommandInterface.connect(self, user, passwd, dbname, host)
+        # -b echoes the failed statements all along on pipes
+        self.FAIL_FAST_OFF_CMDS = ['\\set ON_ERROR_STOP off',
+                                   '\\set ECHO %s' % (self.transport == PIPE and 'errors' or 'none',)]
 
-    def _prepare_env(self):
-        self.exec_cmd('\\pset pager') # turn off paging
+    def _prepare_env_cmds(self):
+        if self.transport == PIPE:
+            return [] # psql does not page without a terminal
+        return ['\\pset pager'] # turn off paging
 
 class MysqlInterface(_CommandInterface):
 
     def __init__(self, logger=None, rawlog='mysql_client.log'):
         _CommandInterface.__init__(self, logger, rawlog=rawlog)
-        self.SPAWN_CMD = 'mysql -u %(user)s -p%(passwd)s %(dbname)s'
-        self.SPAWN_WITH_HOST_CMD = 'mysql -h %(host)s -u %(user)s -p%(passwd)s %(dbname)s'
+        self.dbms = 'mysql'
+        # LOAD DATA LOCAL INFILE is refused unless the client allows it, see bulkload
+        self.SPAWN_CMD = 'mysql --local-infile=1 -u %(user)s -p%(passwd)s %(dbname)s'
+        self.SPAWN_WITH_HOST_CMD = 'mysql --local-infile=1 -h %(host)s -u %(user)s -p%(passwd)s %(dbname)s'
         self.SET_PROMPT_CMD = ''
         self.EXEC_SCRIPT_CMD = '\\. %(sql_file)s'
         self.EXIT_CMD = '\\q'
         self.ERROR_PATTERN = r'^.*ERROR \d*.*$'
         self.LOGIN_ERROR = 'ERROR 1045'
         self.LOGIN_SUCCESS = '' # set in connect
+        # going on after errors, as it does on a terminal, and writing every result right away
+        self.PIPE_SPAWN_CMD = 'mysql --local-infile=1 --batch --force --unbuffered ' \
+            '-u %(user)s -p%(passwd)s %(dbname)s'
+        self.PIPE_SPAWN_WITH_HOST_CMD = 'mysql --local-infile=1 --batch --force --unbuffered ' \
+            '-h %(host)s -u %(user)s -p%(passwd)s %(dbname)s'
+        # \g runs it whatever the DELIMITER of the script is
+        self.MARKER_CMD = "SELECT CONCAT('dbif-', '%(nonce)s') AS dbif\\g"
+        self.MARKER_OUTPUT = 'dbif\ndbif-%(nonce)s' # the column name, and the value
         self.prompt = 'sql=> ' # we'll change this one later
 
-    def connect(self, user, passwd, dbname, host=''):
+    def _prepare_spawn(self, user, passwd, dbname):
         self.prompt = '%(user)s.%(dbname)s> ' % dict(user=user, dbname=dbname)
         os.putenv('MYSQL_PS1', self.prompt)
 
         # we know the prompt ahead of time, so we can wait for it on connect
         self.LOGIN_SUCCESS = self.prompt
-        return _CommandInterface.connect(self, user, passwd, dbname, host)
 
-    def _set_prompt(self, user, dbname):
+    def _set_prompt_cmds(self, user, dbname):
         '''mysql cannot set a prompt from within the client'''
-        pass
+        return []
 
 class VerticaInterface(_CommandInterface):
 
     def __init__(self, logger=None, rawlog='vertica_client.log'):
         _CommandInterface.__init__(self, logger, rawlog=rawlog)
+        self.dbms = 'vertica'
         self.SPAWN_CMD = '/opt/vertica/bin/vsql -U %(user)s -w %(passwd)s -d %(dbname)s'
         self.SPAWN_WITH_HOST_CMD = '/opt/vertica/bin/vsql -h %(host)s -U %(user)s -w %(passwd)s -d %(dbname)s'
         self.SET_PROMPT_CMD = '\\set PROMPT1  \'%(prompt)s\''
@@ -296,33 +765,315 @@ class VerticaInterface(_CommandInterface):
         self.ERROR_PATTERN = r'^.*(ERROR|ROLLBACK):.*$'
         self.LOGIN_ERROR = 'Invalid username or password'
         self.LOGIN_SUCCESS = 'Welcome to vsql'
+        self.PIPE_SPAWN_CMD = '/opt/vertica/bin/vsql -X -U %(user)s -w %(passwd)s -d %(dbname)s'
+        self.PIPE_SPAWN_WITH_HOST_CMD = '/opt/vertica/bin/vsql -X -h %(host)s -U %(user)s -w %(passwd)s -d %(dbname)s'
+        self.MARKER_CMD = "\\echo 'dbif-'%(nonce)s"
+        self.FAIL_FAST_ON_CMDS = ['\\set ON_ERROR_STOP on']
+        self.FAIL_FAST_OFF_CMDS = ['\\set ON_ERROR_STOP off']
+        self.STOPS_ON_ERROR = True
         self.prompt = 'sql=> ' # we'll change this one later
 
-    def exec_cmd(self, cmd, expect_patterns=[], timeout=None):
-        '''Execute a command.
-
-        If expect_patterns not specified defaults to the prompt. Returns
-        pattern index. This function had to be customized for vertica, because
-        vsql constantly deletes the command line and then prints it over,
-        so prompt matches once for every character thats put in'''
-        if not self._child.isalive():
-            raise DisconnectedException('Cannot send commands through an unconnected interface')
-        if not expect_patterns:
-            expect_patterns = [self.prompt]
+    def _send_cmd(self, cmd, timeout=None):
+        '''Send the command and consume vsql redrawing it, then the marker.
+        vsql deletes the command line and prints it over for every character
+        put in, so the prompt shows up many times, the marker only once.'''
+        if self.transport == PIPE:
+            # no terminal, no redrawing
+            return _CommandInterface._send_cmd(self, cmd, timeout)
         self._child.sendline(cmd)
         # it tries to compensate for vertica doing a lot of control character work.
         # seems to work most of the time.
         self._child.expect([cmd[len(cmd) - 1] + '\n\r', pexpect.TIMEOUT], timeout=timeout)
-        pat_num = self._child.expect(expect_patterns, timeout=None)
-        self._find_errors()
-        return pat_num
+        # vsql has been waited for already
+        self._send_marker(delay=False)
+
+    def _send_cmd_async(self, cmd, timeout=None):
+        if self.transport == PIPE:
+            _CommandInterface._send_cmd(self, cmd, timeout)
+        else:
+            self._child.sendline(cmd)
+            yield sessionloop.Expect(self._child, [cmd[len(cmd) - 1] + '\n\r', pexpect.TIMEOUT], timeout)
+            self._send_marker(delay=False)
+        yield sessionloop.Return()
 
 #    def _escape_string(self, string):
 #        return '\'' + string.replace('\'', '\'\'') + '\''
 
-VALID_DBS = ['oracle', 'vertica', 'postgresql', 'mysql']
+class _BlockingAsync:
+    '''The coroutines of the interfaces that do not wait on a client's
+    output: they make the blocking call in one step, holding up the
+    other sessions of the loop meanwhile.'''
+    def connect_async(self, user, passwd, dbname, host=''):
+        yield sessionloop.Return(self.connect(user, passwd, dbname, host))
+
+    def exec_cmd_async(self, cmd, expect_patterns=None, timeout=None):
+        yield sessionloop.Return(self.exec_cmd(cmd, expect_patterns, timeout))
+
+    def exec_sql_file_async(self, sql_file, args='', stream=False, fail_fast=False):
+        yield sessionloop.Return(self.exec_sql_file(sql_file, args, stream, fail_fast))
+
+    def rollback_async(self):
+        yield sessionloop.Return(self.rollback())
+
+    def commit_async(self):
+        yield sessionloop.Return(self.commit())
+
+    def exit_async(self):
+        yield sessionloop.Return(self.exit())
+
+
+class _ScriptStopped(Exception):
+    '''Ends a DB-API script run at its first error.'''
+    pass
+
+
+class _DbApiInterface(_BlockingAsync, _CommandInterface):
+    '''Runs commands and scripts through a Python DB-API connection instead
+    of scraping a client running on a pty. Errors are the driver's
+    exceptions, reported as "ERROR: message" lines. Only SQL can be run
+    this way, client commands (SET, \\pset, ...) are not understood,
+    except for the lines that include other scripts.'''
+
+    def __init__(self, dbms, connect_fn, logger=None, rawlog=None):
+        _CommandInterface.__init__(self, logger, rawlog=rawlog or 'dbapi_client.log')
+        self.dbms = dbms
+        self.ERROR_PATTERN = r'^ERROR: .*$'
+        self._connect_fn = connect_fn
+        self._conn = None
+
+    def connect(self, user, passwd, dbname, host=''):
+        self._logger.info('Connecting through DB-API: %s@%s %s' % (user, dbname, host))
+        self._errors = []
+        if not self._connect_fn:
+            self._errors = ['ERROR: No DB-API driver is available for ' + self.dbms]
+            return False
+        try:
+            with self._phase('connect', user=user, database=dbname):
+                self._conn = self._connect_fn(user, passwd, dbname, host)
+        except Exception, e:
+            self._errors = ['ERROR: ' + str(e)]
+            return False
+        self._connected = True
+        self._begin()
+        return True
+
+    def attach(self):
+        self._logger.error('Manual control is not available on a DB-API connection.')
+        return self.connected()
+
+    def exec_cmd(self, cmd, expect_patterns=None, timeout=None):
+        '''Execute the SQL statements in cmd. Always returns 0, the index
+        of the prompt.'''
+        if not self.connected():
+            raise DisconnectedException('Cannot send commands through an unconnected interface')
+        self._errors = []
+        for stmt in self._split(cmd):
+            self._execute(stmt)
+        return 0
+
+    def exec_sql_file(self, sql_file, args='', stream=False, fail_fast=False, profile=None):
+        '''Execute a script file and the scripts it includes. The output
+        is always logged statement by statement. With fail_fast nothing
+        is run after the first failed statement, with a profile every
+        statement is added to it. Returns True, there is no client that
+        could exit.'''
+        if not self.connected():
+            raise DisconnectedException('Cannot send commands through an unconnected interface')
+        self._errors = []
+        self._tail.clear()
+        self._failure = None
+        self._fail_fast = fail_fast
+        self._profile = profile
+        with self._phase('script', file=sql_file):
+            try:
+                self._run_file(sql_file)
+            except _ScriptStopped:
+                pass
+        self._fail_fast = False
+        self._profile = None
+        return True
+
+    def rollback(self):
+        self._logger.info('# Rolling back changes.')
+        with self._phase('rollback'):
+            self._conn.rollback()
+            self._begin()
+
+    def commit(self):
+        self._logger.info('# Commiting changes.')
+        with self._phase('commit'):
+            self._conn.commit()
+            self._begin()
+
+    def exit(self):
+        self._logger.info('Terminating...')
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+        self._connected = False
+
+    def close(self):
+        self.exit()
+
+    def connected(self):
+        return self._conn is not None and self._connected
+
+    def _run_file(self, sql_file):
+        text = []
+        start = 1
+        with open(self._path(sql_file), 'r') as file:
+            for lineno, line in enumerate(file):
+                sub = util.match_subscript(line, self.dbms)
+                if sub and not ''.join(text).strip():
+                    self._run_file(sub)
+                else:
+                    if not ''.join(text).strip():
+                        start = lineno + 1
+                    text.append(line)
+                    if line.rstrip().endswith(';') and self._complete(''.join(text)):
+                        for stmt in self._split(''.join(text)):
+                            self._execute(stmt, sql_file, start)
+                        text = []
+        for stmt in self._split(''.join(text)):
+            self._execute(stmt, sql_file, start)
+
+    def _execute(self, stmt, sql_file=None, lineno=None):
+        '''Run one statement, log what it returns and collect its error.
+        sql_file and lineno say where it comes from, for the profile.'''
+        if self.spool:
+            self.spool.statement()
+        if self._profile is not None:
+            output_bytes = self._output_bytes
+            errors = len(self._errors)
+            start = time.time()
+            try:
+                self._execute_stmt(stmt)
+            finally:
+                self._profile.add(sql_file, lineno, stmt, time.time() - start,
+                                  self._output_bytes - output_bytes, len(self._errors) - errors)
+        else:
+            self._execute_stmt(stmt)
 
-def create_interface(dbms, logger=None, rawlog=None):
+    def _execute_stmt(self, stmt):
+        cursor = self._conn.cursor()
+        try:
+            try:
+                cursor.execute(stmt)
+            except Exception, e:
+                error = 'ERROR: ' + str(e).replace('\n', ' ')
+                self._output([error], is_error=True)
+                if self._fail_fast:
+                    self._failure = stmt.split('\n')[-self.FAIL_FAST_CONTEXT:] + [error]
+                    raise _ScriptStopped()
+                return
+            if cursor.description:
+                rows = cursor.fetchmany(1000)
+                while rows:
+                    self._output(['\t'.join([str(c) for c in row]) for row in rows])
+                    rows = cursor.fetchmany(1000)
+        finally:
+            cursor.close()
+
+    def _output(self, lines, is_error=False):
+        self._logger.critical('\n'.join(lines))
+        self._tail.extend(lines)
+        if is_error:
+            self._errors.extend(lines)
+        self._count_output(sum([len(l) + 1 for l in lines]), is_error and len(lines) or 0)
+        if self.spool:
+            self.spool.write('\n'.join(lines) + '\n', is_error and lines or ())
+
+    def _split(self, text):
+        '''Split text into statements.'''
+        return util.split_statements(text)
+
+    def _complete(self, text):
+        '''True if text ends with a complete statement.'''
+        # a word after the end of a complete statement is a statement of
+        # its own, after an unterminated one it is glued to it
+        return util.split_statements(text + '\nx')[-1] == 'x'
+
+    def _begin(self):
+        '''Start a transaction, if the driver does not do it by itself.'''
+        pass
+
+
+class SqliteInterface(_DbApiInterface):
+    '''The database name is the path of the SQLite file, user and
+    password are ignored. Manual control spawns the sqlite3 shell.'''
+
+    def __init__(self, logger=None, rawlog='sqlite_client.log'):
+        _DbApiInterface.__init__(self, 'sqlite', _sqlite_connect, logger, rawlog=rawlog)
+        self.SPAWN_CMD = 'sqlite3 %(dbname)s'
+        self.SPAWN_WITH_HOST_CMD = 'sqlite3 %(dbname)s'
+
+    def _split(self, text):
+        '''Let sqlite decide where statements end, so that triggers with
+        semicolons inside BEGIN ... END stay whole.'''
+        import sqlite3
+        statements = []
+        stmt = ''
+        for part in util.split_statements(text):
+            stmt += part + ';'
+            if sqlite3.complete_statement(stmt):
+                statements.append(stmt)
+                stmt = ''
+        if stmt.strip():
+            statements.append(stmt)
+        return statements
+
+    def _complete(self, text):
+        import sqlite3
+        return sqlite3.complete_statement(text)
+
+    def _begin(self):
+        # the connection is in autocommit mode, so that DDL is not
+        # committed implicitly; open the transaction ourselves
+        self._conn.execute('BEGIN')
+
+
+def _sqlite_connect(user, passwd, dbname, host=''):
+    import sqlite3
+    return sqlite3.connect(dbname, isolation_level=None, check_same_thread=False)
+
+def _psycopg2_connect(user, passwd, dbname, host=''):
+    import psycopg2
+    return psycopg2.connect(database=dbname, user=user, password=passwd, host=host or None)
+
+def _mysqldb_connect(user, passwd, dbname, host=''):
+    import MySQLdb
+    return MySQLdb.connect(db=dbname, user=user, passwd=passwd, host=host or 'localhost')
+
+def _cx_oracle_connect(user, passwd, dbname, host=''):
+    import cx_Oracle
+    return cx_Oracle.connect(user, passwd, dbname)
+
+def _vertica_python_connect(user, passwd, dbname, host=''):
+    import vertica_python
+    return vertica_python.connect(database=dbname, user=user, password=passwd,
+                                  host=host or 'localhost')
+
+# dbms -> function(user, passwd, dbname, host) returning a DB-API connection
+DBAPI_DRIVERS = {
+    'sqlite': _sqlite_connect,
+    'postgresql': _psycopg2_connect,
+    'mysql': _mysqldb_connect,
+    'oracle': _cx_oracle_connect,
+    'vertica': _vertica_python_connect,
+}
+
+def register_driver(dbms, connect_fn):
+    '''Use connect_fn(user, passwd, dbname, host), which returns a DB-API
+    connection, for the dbapi backend of dbms.'''
+    DBAPI_DRIVERS[dbms] = connect_fn
+
+VALID_DBS = ['oracle', 'vertica', 'postgresql', 'mysql', 'sqlite']
+BACKENDS = ['pexpect', 'dbapi']
+
+def create_interface(dbms, logger=None, rawlog=None, backend='pexpect'):
+    '''Returns an interface for the dbms. With the dbapi backend the
+    scripts are run through the DB-API driver in DBAPI_DRIVERS instead
+    of the command line client. sqlite always uses DB-API.'''
     if (rawlog):
         param = (logger, rawlog)
     else:
@@ -330,7 +1081,11 @@ def create_interface(dbms, logger=None, rawlog=None):
 
     if not dbms in VALID_DBS:
         return None
-    if dbms == 'oracle':
+    if dbms == 'sqlite':
+        return SqliteInterface(*param)
+    elif backend == 'dbapi':
+        return _DbApiInterface(dbms, DBAPI_DRIVERS.get(dbms), *param)
+    elif dbms == 'oracle':
         return OracleInterface(*param)
     elif dbms == 'vertica':
         return VerticaInterface(*param)
@@ -340,8 +1095,284 @@ def create_interface(dbms, logger=None, rawlog=None):
         return MysqlInterface(*param)
 
 
+class SessionPool:
+    '''Keeps connected interfaces around so that many scripts can be run
+    without paying for a client spawn and login every time. Sessions are
+    keyed by (user, dbname, host). Can be shared between threads, every
+    session is used by one thread at a time.'''
+    def __init__(self, dbms, logger=None, rawlog=None, backend='pexpect', metrics=None, cwd=None,
+                 rawlog_policy=None, transport=PTY):
+        self.dbms = dbms
+        self.metrics = metrics
+        self.cwd = cwd
+        self.rawlog_policy = rawlog_policy or sessionlog.SessionLogPolicy()
+        self.transport = transport
+        self._logger = logger
+        self._rawlog = rawlog
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._spawned = 0
+        self._login_errors = []
+
+    def acquire(self, user, passwd, dbname, host=''):
+        '''Return a connected interface for the given credentials, reusing
+        an idle one if possible. Returns None if the login failed, in which
+        case the errors are available through last_errors().'''
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((user, dbname, host), [])
+            while idle:
+                db = idle.pop()
+                if db.connected():
+                    return db
+            spawned = self._spawned
+            self._spawned += 1
+        finally:
+            self._lock.release()
+
+        db = create_interface(self.dbms, self._logger, self._rawlog, self._backend)
+        if spawned:
+            # do not let the sessions write to each others raw logs
+            root, ext = os.path.splitext(db.PXP_LOGFILE)
+            db.PXP_LOGFILE = '%s.%d%s' % (root, spawned, ext)
+        if self.cwd:
+            # next to the scripts, as when the client is run from there
+            db.PXP_LOGFILE = os.path.join(self.cwd, db.PXP_LOGFILE)
+        db.session_key = (user, dbname, host)
+        db.metrics = self.metrics
+        db.cwd = self.cwd
+        db.rawlog_policy = self.rawlog_policy
+        db.transport = self.transport
+        if not db.connect(user, passwd, dbname, host):
+            self._login_errors = db.dequeue_errors()
+            db.close()
+            return None
+        return db
+
+    def release(self, db):
+        '''Give a session back to the pool. Dead sessions are dropped.'''
+        if db.connected():
+            db.idle_since = time.time()
+            self._lock.acquire()
+            try:
+                self._idle.setdefault(db.session_key, []).append(db)
+            finally:
+                self._lock.release()
+
+    def idle_count(self, user, dbname, host=''):
+        '''How many sessions for the credentials are waiting to be used.'''
+        self._lock.acquire()
+        try:
+            return len(self._idle.get((user, dbname, host), []))
+        finally:
+            self._lock.release()
+
+    def idle_total(self):
+        '''How many sessions are waiting to be used, for all credentials.'''
+        self._lock.acquire()
+        try:
+            return sum([len(sessions) for sessions in self._idle.values()])
+        finally:
+            self._lock.release()
+
+    def evict(self, max_idle):
+        '''Exit the idle sessions that died or have not been used for
+        max_idle secs. Returns how many were dropped.'''
+        now = time.time()
+        self._lock.acquire()
+        try:
+            evicted = []
+            for key, sessions in self._idle.items():
+                keep = [db for db in sessions if now - db.idle_since < max_idle and db.connected()]
+                evicted += [db for db in sessions if db not in keep]
+                self._idle[key] = keep
+        finally:
+            self._lock.release()
+        for db in evicted:
+            if db.connected():
+                db.exit()
+        return len(evicted)
+
+    def discard(self, user, dbname, host=''):
+        '''Exit the idle sessions for the credentials.'''
+        self._lock.acquire()
+        try:
+            sessions = self._idle.pop((user, dbname, host), [])
+        finally:
+            self._lock.release()
+        for db in sessions:
+            if db.connected():
+                db.exit()
+
+    def last_errors(self):
+        '''Errors reported by the client during the last failed login.'''
+        return self._login_errors
+
+    def close(self):
+        '''Exit all the idle sessions.'''
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for sessions in idle.values():
+            for db in sessions:
+                if db.connected():
+                    db.exit()
+
+
+
+class BrokerInterface(_BlockingAsync, _CommandInterface):
+    '''Runs everything on a session kept logged in by broker.py, over its
+    Unix socket. exit() hands the session back to the broker instead of
+    ending it. What the session logs is relayed to this interface's logger.'''
+
+    def __init__(self, socket_path, dbms, logger=None, rawlog=None, backend='pexpect'):
+        _CommandInterface.__init__(self, logger, rawlog=rawlog)
+        self.dbms = dbms
+        self.backend = backend
+        self.socket_path = socket_path
+        self._sock = None
+        self._reader = None
+
+    @staticmethod
+    def available(socket_path):
+        '''True if a broker answers on the socket.'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def connect(self, user, passwd, dbname, host=''):
+        self._logger.info('Asking the broker at %s for a session: %s@%s %s' % (self.socket_path, user, dbname, host))
+        with self._phase('connect', user=user, database=dbname):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.socket_path)
+            self._reader = self._sock.makefile('rb')
+            reply = self._request(op='open', dbms=self.dbms, backend=self.backend, transport=self.transport,
+                                  user=user, password=passwd, database=dbname, host=host, cwd=os.getcwd(),
+                                  rawlog=self.PXP_LOGFILE)
+        self._errors = reply['errors']
+        self._connected = reply['reply']
+        if not self._connected:
+            self._close()
+        return self._connected
+
+    def attach(self):
+        self._logger.error('Manual control is not available on a session of the broker.')
+        return self.connected()
+
+    def exec_cmd(self, cmd, expect_patterns=None, timeout=None):
+        patterns = None
+        if expect_patterns:
+            patterns = [p is pexpect.EOF and 'EOF' or p is pexpect.TIMEOUT and 'TIMEOUT'
+                        or p is DONE and 'DONE' or p for p in expect_patterns]
+        return self._call('exec_cmd', cmd, patterns, timeout)
+
+    def exec_sql_file(self, sql_file, args='', stream=False, fail_fast=False, profile=None):
+        with self._phase('script', file=sql_file):
+            reply = self._request(op='call', method='exec_sql_file', args=[sql_file, args, stream, fail_fast],
+                                  profile=profile is not None)
+        if profile is not None:
+            profile.statements.extend(reply['statements'])
+        return reply['reply']
+
+    def output_tail(self):
+        return self._call('output_tail')
+
+    def last_output(self):
+        return self._call('last_output')
+
+    def failure(self):
+        return self._call('failure')
+
+    def define_args(self, args):
+        return self._call('define_args', args)
+
+    def dequeue_errors(self):
+        if not self._sock:
+            return _CommandInterface.dequeue_errors(self)
+        return self._call('dequeue_errors')
+
+    def rollback(self):
+        with self._phase('rollback'):
+            self._call('rollback')
+
+    def commit(self):
+        with self._phase('commit'):
+            self._call('commit')
+
+    def exit(self):
+        '''Give the session back to the broker.'''
+        if self._sock:
+            try:
+                self._request(op='release')
+            except (socket.error, DisconnectedException):
+                pass
+        self._close()
+
+    def close(self):
+        self.exit()
+
+    def connected(self):
+        return bool(self._sock and self._connected and self._call('connected'))
+
+    def _close(self):
+        if self._sock:
+            self._reader.close()
+            self._sock.close()
+        self._sock = None
+        self._reader = None
+        self._connected = False
+
+    def _call(self, method, *args):
+        return self._request(op='call', method=method, args=list(args))['reply']
+
+    def _request(self, **request):
+        '''Send a request and log what the session logs until the reply
+        comes. Exceptions raised by the session are raised here too.'''
+        if not self._sock:
+            raise DisconnectedException('Cannot send commands through an unconnected interface')
+        self._sock.sendall(json.dumps(request) + '\n')
+        while True:
+            line = self._reader.readline()
+            if not line:
+                self._close()
+                raise DisconnectedException('The broker closed the connection')
+            message = json.loads(line)
+            if 'log' in message:
+                text = message['msg'].encode('utf-8')
+                self._logger.log(message['log'], text)
+                self._count_output(len(text), 0)
+                if self.spool and message['log'] == logging.CRITICAL:
+                    # the output of the session, its errors are not known until the reply
+                    self.spool.write(text + '\n')
+            elif 'exception' in message:
+                if message['exception'] == 'EOF':
+                    raise pexpect.EOF(message['message'])
+                elif message['exception'] == 'DisconnectedException':
+                    raise DisconnectedException(message['message'])
+                raise Exception(message['message'])
+            else:
+                return message
+
 
 class _TestInterface(unittest.TestCase):
+    fake = False # run against fakeclient.py instead of a real client
+    dbname = 'db'
+
+    def _new_interface(self, iface_class, dialect):
+        iface = iface_class()
+        if self.fake:
+            import fakeclient
+            fakeclient.use_fake_client(iface, dialect)
+        return iface
+
     def setUp(self):
         self.SQL_SCRIPT_FNAME = 'sql_test_input321.sql'
         try:
@@ -363,6 +1394,61 @@ class _TestInterface(unittest.TestCase):
         errors = self.iface.dequeue_errors()
         self.assert_(errors)
 
+    def testAsync(self):
+        def check(iface):
+            connected = yield iface.connect_async('user', 'pass', self.dbname)
+            yield iface.exec_cmd_async('select none from nothing;')
+            errors = iface.dequeue_errors()
+            not_eof = yield iface.exec_sql_file_async(self.SQL_SCRIPT_FNAME, stream=True)
+            script_errors = iface.dequeue_errors()
+            yield iface.exit_async()
+            yield sessionloop.Return((connected, errors, not_eof, script_errors))
+        loop = sessionloop.SessionLoop()
+        tasks = [loop.spawn(check(self._new_interface(self.iface.__class__, self.iface.dbms)), timeout=30)
+                 for i in range(3)]
+        self.assert_(not loop.run())
+        for task in tasks:
+            connected, errors, not_eof, script_errors = task.result()
+            self.assert_(connected and errors and not_eof and script_errors)
+
+    def testPipe(self):
+        iface = self._new_interface(self.iface.__class__, self.iface.dbms)
+        iface.transport = PIPE
+        self.assert_(iface.connect('user', 'pass', self.dbname))
+        try:
+            iface.exec_cmd('select none from nothing;')
+            self.assert_(iface.dequeue_errors())
+            self.assert_(iface.exec_sql_file(self.SQL_SCRIPT_FNAME, stream=True))
+            self.assert_(iface.dequeue_errors())
+        finally:
+            iface.exit()
+        self.assert_(not iface.connected())
+
+    def testRawLogOnSigterm(self):
+        '''The raw log still buffered when SIGTERM kills the process is
+        written out.'''
+        import signal
+        import shutil
+        import tempfile
+        import subprocess
+        work = tempfile.mkdtemp(prefix='sql_test_rawlog')
+        writer = ('import sys, time, sessionlog\n'
+                  'log = sessionlog.SessionLog(sys.argv[1])\n'
+                  'log.write("x" * 1000)\n'
+                  'print log.name\n'
+                  'sys.stdout.flush()\n'
+                  'time.sleep(30)\n')
+        try:
+            child = subprocess.Popen([sys.executable, '-c', writer, os.path.join(work, 'client.log')],
+                                     stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+            name = child.stdout.readline().strip()
+            os.kill(child.pid, signal.SIGTERM)
+            self.assertEqual(child.wait(), -signal.SIGTERM)
+            with open(name) as file:
+                self.assertEqual(file.read(), 'x' * 1000)
+        finally:
+            shutil.rmtree(work, True)
+
     def tearDown(self):
         os.system('rm ' + self.SQL_SCRIPT_FNAME)
         self.iface.exit()
@@ -370,7 +1456,7 @@ class _TestInterface(unittest.TestCase):
 class _TestOracle(_TestInterface):
     def setUp(self):
         _TestInterface.setUp(self)
-        self.iface = OracleInterface()
+        self.iface = self._new_interface(OracleInterface, 'oracle')
         self.assert_(self.iface.connect('user', 'pass', 'db'))
 
     def testGoodCmd(self):
@@ -378,10 +1464,40 @@ class _TestOracle(_TestInterface):
         errors = self.iface.dequeue_errors()
         self.assert_(not errors)
 
+    def testFailedLogin(self):
+        '''sqlplus asks for another user name after a refused password,
+        close does not leave it waiting.'''
+        iface = self._new_interface(OracleInterface, 'oracle')
+        self.assert_(not iface.connect('user', 'wrong', 'db'))
+        self.assert_(not iface.connected())
+        iface.close()
+        self.assert_(not iface._child.isalive())
+
+    def testBulkLoad(self):
+        '''Rows longer than the lines sqlplus takes are loaded, and the
+        SET DEFINE of the script is kept.'''
+        import bulkload
+        long_row = ', '.join(["'%s'" % (c * 400,) for c in 'abcdefgh'])
+        with open('sql_test_load321.sql', 'w') as file:
+            file.write("insert into t values ('a & b', 1);\n")
+            file.write('insert into t values (%s);\n' % (long_row,))
+            file.write('insert into t values (%s), (%s);\n' % (long_row, long_row))
+        load = bulkload.prepare('sql_test_load321.sql', 'oracle')
+        try:
+            self.assert_(load)
+            self.iface.exec_cmd('set define off')
+            self.assert_(load.load(self.iface))
+            self.assertEqual(load.errors, [])
+            self.iface.exec_cmd('show define')
+            self.assert_('define OFF' in self.iface.last_output())
+        finally:
+            load.close()
+            os.remove('sql_test_load321.sql')
+
 class _TestVertica(_TestInterface):
     def setUp(self):
         _TestInterface.setUp(self)
-        self.iface = VerticaInterface()
+        self.iface = self._new_interface(VerticaInterface, 'vertica')
         self.assert_(self.iface.connect('user', 'pass', 'db'))
 
     def testGoodCmd(self):
@@ -392,7 +1508,7 @@ class _TestVertica(_TestInterface):
 class _TestPostgre(_TestInterface):
     def setUp(self):
         _TestInterface.setUp(self)
-        self.iface = OracleInterface()
+        self.iface = self._new_interface(PostgreInterface, 'postgresql')
         self.assert_(self.iface.connect('user', 'pass', 'db'))
 
     def testGoodCmd(self):
@@ -400,16 +1516,100 @@ class _TestPostgre(_TestInterface):
         errors = self.iface.dequeue_errors()
         self.assert_(not errors)
 
+class _TestMysql(_TestInterface):
+    def setUp(self):
+        _TestInterface.setUp(self)
+        self.iface = self._new_interface(MysqlInterface, 'mysql')
+        self.assert_(self.iface.connect('user', 'pass', 'db'))
+
+    def testGoodCmd(self):
+        self.iface.exec_cmd('select 1;')
+        errors = self.iface.dequeue_errors()
+        self.assert_(not errors)
+
+    def testDelimiter(self):
+        '''A DELIMITER sent through exec_cmd, by --profile and --resume,
+        does not keep the marker from running.'''
+        import signal
+        import shutil
+        import argparse
+        import sql_user
+        from history import HistoryManager
+        def hung(signum, frame):
+            raise AssertionError('the marker of the command never came back')
+        with open('sql_test_proc321.sql', 'w') as file:
+            file.write('\\. sql_test_sub321.sql\n'
+                       'DELIMITER //\n'
+                       'CREATE PROCEDURE p()\nBEGIN\n  SELECT 1;\nEND //\n'
+                       'DELIMITER ;\n'
+                       'CALL p();\n')
+        with open('sql_test_sub321.sql', 'w') as file:
+            file.write('select 1;\n')
+        handler = signal.signal(signal.SIGALRM, hung)
+        signal.alarm(30)
+        try:
+            profile = metrics.StatementProfile()
+            self.assert_(self.iface.exec_sql_file('sql_test_proc321.sql', profile=profile))
+            self.assert_(not self.iface.dequeue_errors())
+            self.assertEqual(len(profile.statements), 5)
+
+            hist = HistoryManager('sql_test_proc321.sql', 'db', 'user', path='sql_test_complete321')
+            args = argparse.Namespace(dbms=self.iface.dbms, stream=False, fail_fast=False)
+            self.assert_(sql_user.run_pieces(self.iface, hist, args, 'sql_test_proc321.sql'))
+            self.assert_(hist.checkpointed('sql_test_proc321.sql', 2))
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, handler)
+            os.remove('sql_test_proc321.sql')
+            os.remove('sql_test_sub321.sql')
+            shutil.rmtree('sql_test_complete321', True)
+
+class _TestSqlite(_TestInterface):
+    dbname = ':memory:'
+
+    def setUp(self):
+        _TestInterface.setUp(self)
+        self.iface = SqliteInterface()
+        self.assert_(self.iface.connect('', '', ':memory:'))
+
+    def testGoodCmd(self):
+        self.iface.exec_cmd('select 1;')
+        errors = self.iface.dequeue_errors()
+        self.assert_(not errors)
+
+    def testRollback(self):
+        self.iface.exec_cmd('create table t (a int); insert into t values (1);')
+        self.iface.rollback()
+        self.iface.exec_cmd('select * from t;')
+        self.assert_(self.iface.dequeue_errors())
+
+    def testCommit(self):
+        self.iface.exec_cmd('create table t (a int); insert into t values (1);')
+        self.iface.commit()
+        self.iface.rollback()
+        self.iface.exec_cmd('select * from t;')
+        self.assert_(not self.iface.dequeue_errors())
+
 def _oracle_suite():
     return unittest.makeSuite(_TestOracle)
 
 def _vertica_suite():
     return unittest.makeSuite(_TestVertica)
 
+def _postgre_suite():
+    return unittest.makeSuite(_TestPostgre)
+
+def _mysql_suite():
+    return unittest.makeSuite(_TestMysql)
+
+def _sqlite_suite():
+    return unittest.makeSuite(_TestSqlite)
+
 
 def main(args):
     '''Runs tests and exits with exit code 0 if all is well,
-    and 1 if a test failed. Also returns 1 if DBMS name parameter
+    and 1 if a test failed. With --fake the clients are replaced
+    by fakeclient.py. Also returns 1 if DBMS name parameter
     is missing or incorrect'''
     if len(args) < 2:
         print 'Please provide DBMS name as a test argument'
@@ -425,6 +1625,15 @@ def main(args):
         suite = _oracle_suite()
     elif dbname == 'vertica':
         suite = _vertica_suite()
+    elif dbname == 'postgresql':
+        suite = _postgre_suite()
+    elif dbname == 'mysql':
+        suite = _mysql_suite()
+    elif dbname == 'sqlite':
+        suite = _sqlite_suite()
+
+    # --fake runs the tests against fakeclient.py, no database needed
+    _TestInterface.fake = '--fake' in args
 
     verbosity = 1
     if '-v' in args:
@@ -0,0 +1,484 @@
+'''Stand-ins for sqlplus, psql, mysql and vsql, good enough to drive the
+dbif interfaces without a database:
+
+    fakeclient.py oracle user/passwd@db
+    fakeclient.py postgresql [-h host] db user -w
+    fakeclient.py mysql [-h host] -u user -ppasswd db
+    fakeclient.py vertica [-h host] -U user -w passwd -d db
+
+They print the client's login banner and prompt, understand the prompt
+setting, script execution, commit/rollback and exit commands, and answer
+every statement with the client's usual feedback. A statement that mentions
+a table whose name starts with "nothing" fails with the client's error format. vsql also
+redraws the command line the way the real one does. ^C cancels the running
+script, psql and vsql stop a script at its first error with ON_ERROR_STOP.
+The bulk loads of bulkload, \\copy, COPY FROM LOCAL, LOAD DATA LOCAL INFILE
+and INSERT ALL, answer with the number of rows in the data file or statement.
+
+Without a terminal, as the pipe transport of dbif spawns them, they behave
+like the clients in their batch mode: no banner, prompts or redrawing, psql
+and vsql exit at an error with ON_ERROR_STOP or at ^C, and so does mysql
+at any error without --force, and prints its results tab separated and no
+feedback. sqlplus is quiet with -S whether there is a terminal or not, -L
+makes it exit when the login is refused, and -b makes psql echo the failed
+statements.
+
+The environment tunes them:
+
+    FAKECLIENT_PASSWORD  the only password accepted, by default any but "wrong"
+    FAKECLIENT_ROWS      rows returned by a select, 1 by default
+    FAKECLIENT_LATENCY   seconds every statement takes, 0 by default
+'''
+import os
+import re
+import csv
+import sys
+import time
+
+ORACLE = 'oracle'
+POSTGRESQL = 'postgresql'
+MYSQL = 'mysql'
+VERTICA = 'vertica'
+DIALECTS = [ORACLE, POSTGRESQL, MYSQL, VERTICA]
+
+
+class ScriptStopped(Exception):
+    '''ON_ERROR_STOP ends the script, and the scripts that included it.'''
+    pass
+
+
+def use_fake_client(iface, dialect):
+    '''Make a dbif interface spawn this fake client instead of the real one.'''
+    fake = '%s %s %s' % (sys.executable, os.path.abspath(__file__), dialect)
+    for name in ('SPAWN_CMD', 'SPAWN_WITH_HOST_CMD', 'PIPE_SPAWN_CMD', 'PIPE_SPAWN_WITH_HOST_CMD'):
+        cmd = getattr(iface, name)
+        if cmd:
+            setattr(iface, name, fake + ' ' + cmd.split(' ', 1)[1])
+    return iface
+
+
+class FakeClient:
+    def __init__(self, dialect, argv):
+        self.dialect = dialect
+        self.rows = int(os.environ.get('FAKECLIENT_ROWS', '1'))
+        self.latency = float(os.environ.get('FAKECLIENT_LATENCY', '0'))
+        self.delimiter = ';'
+        self.define = '&' # the substitution character of sqlplus, None when SET DEFINE OFF
+        self.on_error_stop = False
+        self.echo_errors = dialect == POSTGRESQL and '-b' in argv
+        self.failed = False
+        # ROW_COUNT() and @@warning_count of mysql, which every statement resets
+        self.loaded = -1 # rows of the last statement, if it was a bulk load
+        self.warnings = 0
+        self.tty = sys.stdin.isatty()
+        self.batch = dialect == MYSQL and (not self.tty or '--batch' in argv)
+        self.force = '--force' in argv
+        self.silent = dialect == ORACLE and '-S' in argv
+        self.logon_once = dialect == ORACLE and '-L' in argv
+        # sqlplus prompts on pipes too, unless it is silent
+        self.prompting = dialect == ORACLE and not self.silent or dialect != ORACLE and self.tty
+        self.user, self.passwd, self.dbname = self._parse_login(argv)
+        if dialect == ORACLE:
+            self.prompt = 'SQL> '
+        elif dialect == MYSQL:
+            self.prompt = os.environ.get('MYSQL_PS1', 'mysql> ')
+        else:
+            self.prompt = '%s=> ' % (self.dbname,)
+
+    def _parse_login(self, argv):
+        '''Returns (user, passwd, dbname) from the client arguments.'''
+        if self.dialect == ORACLE:
+            m = re.match(r'([^/]*)/([^@]*)@(.*)', [a for a in argv if not a.startswith('-')][0])
+            return m.group(1), m.group(2), m.group(3)
+        opts = {}
+        args = []
+        i = 0
+        while i < len(argv):
+            if argv[i] in ('-h', '-u', '-U', '-w', '-d') and i + 1 < len(argv) \
+                    and not (self.dialect == POSTGRESQL and argv[i] == '-w'):
+                opts[argv[i]] = argv[i + 1]
+                i += 2
+            elif argv[i].startswith('-p'):
+                opts['-p'] = argv[i][2:]
+                i += 1
+            elif argv[i].startswith('-'):
+                i += 1
+            else:
+                args.append(argv[i])
+                i += 1
+        if self.dialect == POSTGRESQL:
+            return args[1], os.environ.get('PGPASSWORD', ''), args[0]
+        elif self.dialect == MYSQL:
+            return opts.get('-u', ''), opts.get('-p', ''), args and args[0] or ''
+        else:
+            return opts.get('-U', ''), opts.get('-w', ''), opts.get('-d', '')
+
+    def write(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def login(self):
+        '''Print the banner. Returns False if the password is refused.'''
+        expected = os.environ.get('FAKECLIENT_PASSWORD')
+        ok = expected is None and self.passwd != 'wrong' or self.passwd == expected
+        if self.dialect == ORACLE:
+            if not self.silent:
+                self.write('\nSQL*Plus: Release 10.2.0.3.0 - Production\n\n'
+                           'Copyright (c) 1982, 2006, Oracle.  All Rights Reserved.\n\n')
+            if not ok:
+                self.write('ERROR:\nORA-01017: invalid username/password; logon denied\n\n\n')
+                if self.logon_once:
+                    self.write('SP2-0751: Unable to connect to Oracle.  Exiting SQL*Plus\n')
+                else:
+                    # and waits for one to be typed in
+                    self.write('Enter user-name: ')
+                    sys.stdin.readline()
+                return False
+            if not self.silent:
+                self.write('Connected to:\nOracle Database 10g Enterprise Edition Release 10.2.0.3.0\n\n')
+        elif self.dialect == POSTGRESQL:
+            if not ok:
+                self.write('psql: FATAL:  password authentication failed for user "%s"\n' % (self.user,))
+                return False
+            if self.tty:
+                self.write('psql (9.1.3)\nType "help" for help.\n\n')
+        elif self.dialect == MYSQL:
+            if not ok:
+                self.write("ERROR 1045 (28000): Access denied for user '%s'@'localhost' "
+                           "(using password: YES)\n" % (self.user,))
+                return False
+            if not self.batch:
+                self.write('Welcome to the MySQL monitor.  Commands end with ; or \\g.\n'
+                           'Server version: 5.1.61 Source distribution\n\n'
+                           "Type 'help;' or '\\h' for help. Type '\\c' to clear the current input statement.\n\n")
+        else:
+            if not ok:
+                self.write('vsql: FATAL 3781:  Invalid username or password\n')
+                return False
+            if self.tty:
+                self.write('Welcome to vsql, the Vertica Analytic Database interactive terminal.\n\n'
+                           'Type:  \\h or \\? for help with vsql commands\n'
+                           '       \\g or terminate with semicolon to execute query\n'
+                           '       \\q to quit\n\n')
+        return True
+
+    def run(self):
+        if not self.login():
+            return 1
+        if self.dialect == VERTICA and self.tty:
+            self._raw_output()
+        buffer = []
+        self.show_prompt(self.prompt)
+        while True:
+            try:
+                line = sys.stdin.readline()
+            except KeyboardInterrupt:
+                continue
+            if not line:
+                return 0
+            line = line.rstrip('\r\n')
+            if self.dialect == ORACLE and len(line) > 2499:
+                self.write('SP2-0027: Input is too long (> 2499 characters) - line ignored\n')
+                continue
+            if self.dialect == VERTICA and self.tty:
+                # vsql redraws the line after every key stroke
+                for i in range(1, len(line) + 1):
+                    self.write('\r' + self.prompt + line[:i])
+                self.write('\n\r')
+            if not buffer and self.is_exit(line):
+                return 0
+            buffer.append(line)
+            if self.statement_done(buffer):
+                self.failed = False
+                try:
+                    self.execute('\n'.join(buffer), None)
+                except KeyboardInterrupt:
+                    self.cancelled()
+                    if not self.tty and self.dialect in (POSTGRESQL, VERTICA):
+                        return 3
+                except ScriptStopped:
+                    pass
+                buffer = []
+                if self.failed and self.exits_on_error():
+                    return self.dialect == MYSQL and 1 or 3
+            self.show_prompt(buffer and self.continuation_prompt(len(buffer) + 1) or self.prompt)
+
+    def show_prompt(self, prompt):
+        if self.prompting:
+            self.write(prompt)
+
+    def exits_on_error(self):
+        '''Whether an error ends a session without a terminal.'''
+        if self.dialect == MYSQL:
+            return self.batch and not self.force
+        if self.tty:
+            return False
+        return self.dialect != ORACLE and self.on_error_stop
+
+    def continuation_prompt(self, lineno):
+        '''Shown while a statement is being typed in.'''
+        if self.dialect == ORACLE:
+            return '%3d  ' % (lineno,)
+        elif self.dialect == MYSQL:
+            return '    -> '
+        return '%s-> ' % (self.dbname,)
+
+    def _raw_output(self):
+        '''vsql writes its own carriage returns.'''
+        try:
+            import termios
+            attrs = termios.tcgetattr(1)
+            attrs[1] &= ~termios.OPOST
+            termios.tcsetattr(1, termios.TCSANOW, attrs)
+        except Exception:
+            pass
+
+    def is_exit(self, line):
+        return line.strip().lower() in ('exit', 'quit', '\\q', 'exit;', 'quit;')
+
+    def statement_done(self, buffer):
+        '''Client commands are one line, SQL ends with the delimiter, or
+        with a "/" line for oracle, or with \\g for mysql whatever the
+        delimiter.'''
+        first = buffer[0].strip()
+        last = buffer[-1].strip()
+        if len(buffer) == 1 and self.client_command(first):
+            return True
+        if self.dialect == ORACLE and last == '/':
+            return True
+        if self.dialect == ORACLE and re.match(r'(?i)(create( or replace)?\s+(procedure|function|package|trigger|type)|declare|begin)\b', first):
+            return False
+        if self.dialect == MYSQL and last.endswith('\\g'):
+            return True
+        return last.endswith(self.delimiter)
+
+    def client_command(self, line):
+        if not line:
+            return True
+        if line.startswith('\\') or line.startswith('@'):
+            return True
+        if self.dialect == ORACLE:
+            return re.match(r'(?i)(set|prompt|define|whenever|host|show|spool|exec)\b', line) is not None
+        if self.dialect == MYSQL:
+            return re.match(r'(?i)(delimiter|source)\b', line) is not None
+        return False
+
+    def execute(self, stmt, script):
+        '''Run one statement or client command. script is the name of
+        the script it comes from, if any.'''
+        line = stmt.strip()
+        if not line:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        m = re.match(r'(?i)(?:@|\\i |\\\. |source )\s*([^\s;]+)', line)
+        if m:
+            return self.run_script(m.group(1))
+        m = re.match(r'(?i)set sqlp "(.*)"', line)
+        if self.dialect == ORACLE and m:
+            self.prompt = m.group(1)
+            return
+        m = re.match(r"\\set PROMPT1\s+'(.*)'", line)
+        if m:
+            self.prompt = m.group(1)
+            return
+        m = re.match(r'\\set (ON_ERROR_STOP|ECHO)\s+(\S+)', line)
+        if m:
+            if m.group(1) == 'ON_ERROR_STOP':
+                self.on_error_stop = m.group(2).lower() == 'on'
+            else:
+                self.echo_errors = m.group(2) == 'errors'
+            return
+        m = re.match(r'(?i)set define\s+(\S+)$', line)
+        if self.dialect == ORACLE and m:
+            value = m.group(1).strip('"')
+            self.define = {'on': '&', 'off': None}.get(value.lower(), value)
+            return
+        if self.dialect == ORACLE and re.match(r'(?i)show define$', line):
+            self.write(self.define and 'define "%s" (hex %02x)\n' % (self.define, ord(self.define))
+                       or 'define OFF\n')
+            return
+        m = re.match(r'(?i)delimiter\s+(\S+)', line)
+        if self.dialect == MYSQL and m:
+            self.delimiter = m.group(1)
+            return
+        if line.startswith('\\echo '):
+            # the quoted parts lose their quotes, and run into what is next to them
+            self.write(re.sub(r"'([^']*)'", r'\1', line.split(' ', 1)[1]) + '\n')
+            return
+        if re.match(r'(?i)prompt ', line):
+            self.write(line.split(' ', 1)[1] + '\n')
+            return
+        m = re.match(r"\\copy\s+(\S+).*\sfrom\s+'([^']*)'", line)
+        if self.dialect == POSTGRESQL and m:
+            self.load(m.group(1), m.group(2), script)
+            return
+        if line.startswith('\\pset pager'):
+            self.write('Pager usage is off.\n')
+            return
+        if self.client_command(line):
+            return
+        if self.dialect == ORACLE and line.endswith('/'):
+            line = line[:-1].strip()
+        if self.dialect == MYSQL and line.endswith('\\g'):
+            line = line[:-2].strip()
+        self.statement(line.rstrip(self.delimiter).strip(), script)
+
+    def run_script(self, sql_file):
+        if not os.path.exists(sql_file) and os.path.exists(sql_file + '.sql'):
+            sql_file += '.sql'
+        if not os.path.exists(sql_file):
+            self.error('could not open %s' % (sql_file,), script=None,
+                       oracle='SP2-0310: unable to open file "%s"' % (sql_file,))
+            return
+        buffer = []
+        for line in open(sql_file):
+            line = line.rstrip('\r\n')
+            if not buffer and (not line.strip() or line.startswith('--')):
+                continue
+            buffer.append(line)
+            if self.statement_done(buffer):
+                self.execute('\n'.join(buffer), sql_file)
+                buffer = []
+                if self.failed and self.on_error_stop:
+                    raise ScriptStopped()
+        if buffer:
+            self.execute('\n'.join(buffer), sql_file)
+
+    def statement(self, sql, script):
+        '''Answer a SQL statement.'''
+        words = sql.lower().split()
+        verb = words and words[0] or ''
+        loaded, warnings = self.loaded, self.warnings
+        self.loaded, self.warnings = -1, 0
+        missing = re.search(r'\b(nothing\w*)', sql.lower())
+        if missing:
+            self.error('relation "%s" does not exist' % (missing.group(1),), script, sql=sql,
+                       oracle='ORA-00942: table or view does not exist',
+                       mysql="ERROR 1146 (42S02): Table '%s.%s' doesn't exist" % (self.dbname, missing.group(1)))
+        elif verb in ('commit', 'rollback'):
+            self.feedback(verb, 0)
+        elif verb == 'insert' and words[1:2] == ['all']:
+            self.feedback('insert', len(re.findall(r'(?im)^\s*into\b', sql)))
+        elif verb == 'insert':
+            self.feedback('insert', 1)
+        elif self.dialect == VERTICA and verb == 'copy':
+            m = re.match(r"(?is)copy\s+(\S+).*?from\s+local\s+'([^']*)'", sql)
+            self.load(m.group(1), m.group(2), script)
+        elif self.dialect == MYSQL and verb == 'load':
+            m = re.search(r"(?i)infile\s+'([^']*)'\s+into table\s+(\S+)", sql)
+            self.load(m.group(2), m.group(1), script)
+        elif self.dialect == MYSQL and re.match(r'(?i)select row_count\(\)', sql):
+            self.values(['dbif_loaded', 'dbif_warnings'], [str(loaded), str(warnings)])
+        elif self.dialect == MYSQL and re.match(r"(?i)select (concat\((.*)\)|'[^']*') as (\w+)$", sql):
+            # a literal, or the concat of literals
+            m = re.match(r"(?i)select (concat\((.*)\)|'[^']*') as (\w+)$", sql)
+            self.values([m.group(3)], [''.join(re.findall(r"'([^']*)'", m.group(1)))])
+        elif verb == 'select':
+            self.result_set(self.rows)
+        else:
+            self.feedback(verb, 0, ' '.join(words[:2]))
+
+    def load(self, table, data_file, script):
+        '''Answer a bulk load of the rows of data_file.'''
+        if table.lower().startswith('nothing'):
+            return self.error('relation "%s" does not exist' % (table,), script,
+                              mysql="ERROR 1146 (42S02): Table '%s.%s' doesn't exist" % (self.dbname, table))
+        if not os.path.exists(data_file):
+            return self.error('could not open file "%s" for reading' % (data_file,), script,
+                              mysql="ERROR 2 (HY000): File '%s' not found" % (data_file,))
+        rows = len(list(csv.reader(open(data_file), escapechar=self.dialect != POSTGRESQL and '\\' or None)))
+        self.loaded = rows
+        if self.dialect == POSTGRESQL:
+            self.write('COPY %d\n' % (rows,))
+        elif self.batch:
+            pass
+        elif self.dialect == MYSQL:
+            self.write('Query OK, %d rows affected (0.01 sec)\n'
+                       'Records: %d  Deleted: 0  Skipped: 0  Warnings: 0\n\n' % (rows, rows))
+        else:
+            self.write(' Rows Loaded \n-------------\n %11d\n(1 row)\n\n' % (rows,))
+
+    def feedback(self, verb, count, what=''):
+        if self.dialect == ORACLE:
+            messages = {'commit': 'Commit complete.', 'rollback': 'Rollback complete.',
+                        'insert': '%d row%s created.' % (count, count != 1 and 's' or '')}
+            noun = what and what.split()[-1].capitalize() or 'Statement'
+            past = {'create': 'created', 'drop': 'dropped', 'alter': 'altered',
+                    'grant': 'succeeded', 'truncate': 'truncated'}.get(verb, 'processed')
+            self.write('\n%s\n\n' % (messages.get(verb, '%s %s.' % (noun, past)),))
+        elif self.batch:
+            pass
+        elif self.dialect == MYSQL:
+            self.write('Query OK, %d row%s affected (0.00 sec)\n\n' % (count, count != 1 and 's' or ''))
+        elif verb == 'insert':
+            if self.dialect == POSTGRESQL:
+                self.write('INSERT 0 %d\n' % (count,))
+            else:
+                self.write(' OUTPUT \n--------\n      %d\n(1 row)\n\n' % (count,))
+        else:
+            self.write('%s\n' % ((what or verb).upper(),))
+
+    def result_set(self, rows):
+        if self.dialect == ORACLE:
+            self.write('\n  COLUMN\n----------\n')
+            for i in range(rows):
+                self.write('%10d\n' % (i + 1,))
+            self.write('\n%d row%s selected.\n\n' % (rows, rows != 1 and 's' or ''))
+        elif self.batch:
+            self.write('column\n' + ''.join(['%d\n' % (i + 1,) for i in range(rows)]))
+        elif self.dialect == MYSQL:
+            self.write('+--------+\n| column |\n+--------+\n')
+            for i in range(rows):
+                self.write('| %6d |\n' % (i + 1,))
+            self.write('+--------+\n%d row%s in set (0.00 sec)\n\n' % (rows, rows != 1 and 's' or ''))
+        else:
+            self.write(' column \n--------\n')
+            for i in range(rows):
+                self.write(' %6d\n' % (i + 1,))
+            self.write('(%d row%s)\n\n' % (rows, rows != 1 and 's' or ''))
+
+    def values(self, columns, row):
+        '''A result set of one row, from mysql.'''
+        if self.batch:
+            self.write('\t'.join(columns) + '\n' + '\t'.join(row) + '\n')
+            return
+        widths = [max(len(c), len(v)) for c, v in zip(columns, row)]
+        line = '+' + '+'.join(['-' * (w + 2) for w in widths]) + '+\n'
+        self.write(line + '| %s |\n' % (' | '.join([c.ljust(w) for c, w in zip(columns, widths)]),) + line +
+                   '| %s |\n' % (' | '.join([v.ljust(w) for v, w in zip(row, widths)]),) + line +
+                   '1 row in set (0.00 sec)\n\n')
+
+    def cancelled(self):
+        '''What the client says when ^C stops a script.'''
+        if self.dialect == ORACLE:
+            self.write('\nORA-01013: user requested cancel of current operation\n\n')
+        elif self.dialect == MYSQL:
+            self.write('^C -- query aborted\nERROR 1317 (70100): Query execution was interrupted\n')
+        else:
+            self.write('Cancel request sent\nERROR:  canceling statement due to user request\n')
+
+    def error(self, message, script, sql='', oracle='', mysql=''):
+        self.failed = True
+        if self.dialect == ORACLE:
+            self.write('%s\n*\nERROR at line 1:\n%s\n\n' % (sql, oracle))
+        elif self.dialect == MYSQL:
+            self.write('%s\n' % (mysql or 'ERROR 1064 (42000): ' + message,))
+        elif script:
+            self.write('%s:%s:1: ERROR:  %s\n' % (self.dialect == POSTGRESQL and 'psql' or 'vsql',
+                                                  script, message))
+        else:
+            self.write('ERROR:  %s\n' % (message,))
+        if self.echo_errors and sql:
+            self.write('%s;\n' % (sql,))
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in DIALECTS:
+        sys.stderr.write('Usage: %s %s CLIENT_ARGS...\n' % (argv[0], '|'.join(DIALECTS)))
+        sys.exit(2)
+    sys.exit(FakeClient(argv[1], argv[2:]).run())
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,182 @@
+'''Run the same script, or manifest, against many databases at once.
+
+    fanout.py -j 8 -t db1@host1 -t db2@host2 user password release.sql -r complete -n
+
+Every target gets its own sql_user.py process and log file. Targets whose
+history says there is nothing to do are skipped without spawning anything.
+The children never ask questions: anything that would need an answer fails
+the target instead. At the end one report with the result and timing of
+every target is printed.'''
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess as subp
+import Queue
+
+import sql_user
+from history import HistoryManager
+from manifest import read_manifest
+import util
+
+PASS = 'PASS'
+FAIL = 'FAIL'
+SKIP = 'SKIP'
+LOGIN = 'LOGIN'
+
+
+class TargetResult:
+    def __init__(self, target, status, code=None, elapsed=0.0, log_file=''):
+        self.target = target
+        self.status = status
+        self.code = code
+        self.elapsed = elapsed
+        self.log_file = log_file
+
+
+def split_target(target):
+    '''"db@host" -> ("db", "host")'''
+    if '@' in target:
+        return tuple(target.split('@', 1))
+    return (target, '')
+
+def target_log_file(log_file, target):
+    '''sql_out.log -> sql_out.db@host.log'''
+    root, ext = os.path.splitext(log_file)
+    return '%s.%s%s' % (root, target, ext)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run a SQL script file on many servers at once. '
+                                     'Options not listed here are passed on to sql_user.py.')
+    parser.add_argument('username')
+    parser.add_argument('password')
+    parser.add_argument('sql_file')
+    parser.add_argument('-t', '--target', dest='targets', action='append', default=[],
+                        metavar='db[@host]', help='A database to run on. Can be repeated.')
+    parser.add_argument('--targets-file', metavar='FILE',
+                        help='File with one db[@host] target per line.')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='How many targets to run at the same time. Default is 4.')
+    args, rest = parser.parse_known_args(argv)
+    if args.targets_file:
+        with open(args.targets_file) as file:
+            args.targets.extend([l.strip() for l in file if l.strip() and not l.startswith('#')])
+    return args, rest
+
+def is_up_to_date(opts):
+    '''True if the history says the script, or every script in the
+    manifest, has not changed since it was last run on the target.'''
+    if opts.ignore_history:
+        return False
+    if opts.batch:
+        entries = read_manifest(opts.sql_file, opts.username, opts.password)
+    else:
+        entries = [None]
+    for entry in entries:
+        sql_file = entry and entry.sql_file or opts.sql_file
+        user = entry and entry.user or opts.username
+        subs = util.find_subscripts(sql_file, opts.dbms)
+        hist = sql_user.open_history(opts, sql_file, user)
+        if hist.status(sql_file, subs) != HistoryManager.NO_DIFF:
+            return False
+    return True
+
+def run_target(args, rest, target):
+    '''Run sql_user.py on one target and return a TargetResult.'''
+    database, host = split_target(target)
+    start = time.time()
+    opts = sql_user.parse_args([args.username, args.password, database, args.sql_file] + rest)
+    log_file = target_log_file(opts.logfile, target)
+    try:
+        if is_up_to_date(opts):
+            return TargetResult(target, SKIP, 0, time.time() - start, log_file)
+    except Exception:
+        # let sql_user.py report it in the target's log
+        pass
+
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql_user.py'),
+           args.username, args.password, database, args.sql_file] + rest + \
+          ['-l', log_file, '--rawlog', target_log_file('client.log', target), '-n', '--no-input']
+    if host:
+        cmd += ['-H', host]
+    if opts.metrics:
+        cmd += ['--metrics', target_log_file(opts.metrics, target)]
+    devnull = open(os.devnull, 'r+')
+    try:
+        code = subp.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    if code == sql_user.EXIT_NORMAL:
+        status = PASS
+    elif code == sql_user.EXIT_LOGIN:
+        status = LOGIN
+    else:
+        status = FAIL
+    return TargetResult(target, status, code, time.time() - start, log_file)
+
+def run_all(args, rest):
+    '''Run the targets, at most args.jobs at a time. Returns the results
+    in the order the targets were given.'''
+    todo = Queue.Queue()
+    for i, target in enumerate(args.targets):
+        todo.put((i, target))
+    results = [None] * len(args.targets)
+
+    def worker():
+        while True:
+            try:
+                i, target = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = run_target(args, rest, target)
+            except Exception:
+                results[i] = TargetResult(target, FAIL)
+            print '%-30s %s' % (target, results[i].status)
+
+    workers = [threading.Thread(target=worker) for i in range(max(1, args.jobs))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
+
+def report(results, elapsed):
+    '''Returns the text of the aggregated report.'''
+    lines = ['', '%-30s %-6s %5s %9s  %s' % ('TARGET', 'RESULT', 'CODE', 'SECONDS', 'LOG')]
+    for r in results:
+        code = r.code is None and '-' or str(r.code)
+        lines.append('%-30s %-6s %5s %9.1f  %s' % (r.target, r.status, code, r.elapsed, r.log_file))
+    counts = {}
+    for r in results:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    lines.append('')
+    lines.append('%d targets in %.1f secs: ' % (len(results), elapsed) +
+                 ', '.join(['%d %s' % (counts.get(s, 0), s) for s in (PASS, SKIP, FAIL, LOGIN)]))
+    return '\n'.join(lines)
+
+def main(argv):
+    args, rest = parse_args(argv[1:])
+    if not args.targets:
+        print 'No targets given, use -t or --targets-file.'
+        sys.exit(sql_user.EXIT_FAIL)
+    for flag in ('-s', '--show', '-m', '--manual', '-d', '--diag'):
+        if flag in rest:
+            print 'The %s option needs a user at the terminal, it cannot be used with fanout.' % (flag,)
+            sys.exit(sql_user.EXIT_FAIL)
+    databases = [split_target(t)[0] for t in args.targets]
+    if len(set(databases)) != len(databases):
+        print 'The same database is listed on more than one host, their execution records would mix.'
+        sys.exit(sql_user.EXIT_FAIL)
+
+    start = time.time()
+    results = run_all(args, rest)
+    print report(results, time.time() - start)
+    if [r for r in results if r.status not in (PASS, SKIP)]:
+        sys.exit(sql_user.EXIT_FAIL)
+    sys.exit(sql_user.EXIT_NORMAL)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
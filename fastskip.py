@@ -0,0 +1,99 @@
+'''The quick way out of sql_user.py for scripts that ran before and have
+not changed, the most common case of an incremental push. It only needs
+the history and the include graph, so it answers before pexpect, dbif,
+argparse and logging are imported and before the logging is set up.
+
+skip() only handles plain runs. For anything else, or anything it is not
+sure about, it returns False and sql_user.py goes the usual way, which
+also produces the usual errors.'''
+import sys
+import time
+import getopt
+
+from history import HistoryManager
+import util
+
+LOG_FORMAT = '@[ %(asctime)s ]>[ %(name)s ]: %(message)s'
+LOG_DATE_FORMAT = '%m-%d-%Y %H:%M'
+CONSOLE_FORMAT = 'SQLUSER: %(message)s'
+
+# the levels of the logging module, which is not imported here
+DEBUG = 10
+INFO = 20
+ERROR = 40
+CRITICAL = 50
+
+# the options of sql_user.py, see its parse_args
+SHORT_OPTIONS = 'x:qvD:l:r:dmisnbj:H:T:'
+LONG_OPTIONS = ['extra=', 'quite', 'verbose', 'dbms=', 'backend=', 'log=', 'rawlog=',
+                'rawlog-max-size=', 'rawlog-gzip', 'rawlog-keep=', 'record=',
+                'history-backend=', 'diag', 'manual', 'ignore', 'show', 'noquery', 'host=',
+                'timeout=', 'batch', 'jobs=', 'no-input', 'stream', 'fail-fast', 'resume',
+                'profile', 'profile-top=', 'bulk', 'bulk-min-size=', 'bulk-file=', 'transport=',
+                'broker=', 'log-queue', 'log-format=', 'metrics=', 'metrics-hook=']
+# options that do something else than running the script, or need the
+# full logging and metrics set up
+SLOW_OPTIONS = ['-d', '--diag', '-m', '--manual', '-i', '--ignore', '-b', '--batch',
+                '--log-format', '--metrics', '--metrics-hook']
+
+
+def skip(argv):
+    '''Returns True if the history says that the script run by the
+    sql_user.py command line argv has not changed since it was recorded,
+    after logging so as sql_user.py would have.'''
+    try:
+        opts, positional = getopt.gnu_getopt(argv, SHORT_OPTIONS, LONG_OPTIONS)
+    except getopt.GetoptError:
+        return False
+    if len(positional) != 4 or [o for o, v in opts if o in SLOW_OPTIONS]:
+        return False
+    username, password, database, sql_file = positional
+    options = {'-D': 'oracle', '-l': 'sql_out.log', '-r': 'complete', '-H': '',
+               '--history-backend': HistoryManager.FS_BACKEND}
+    verbosity = ERROR
+    for o, v in opts:
+        if o in ('-q', '--quite'):
+            verbosity = CRITICAL
+        elif o in ('-v', '--verbose'):
+            verbosity = DEBUG
+        else:
+            options[{'--dbms': '-D', '--log': '-l', '--record': '-r', '--host': '-H'}.get(o, o)] = v
+    if options['--history-backend'] not in HistoryManager.BACKENDS:
+        return False
+
+    try:
+        if not util.file_exists(sql_file):
+            return False
+        subs = util.find_subscripts(sql_file, options['-D'])
+        hist = HistoryManager(sql_file, database, username, backend=options['--history-backend'],
+                              path=options['-r'])
+        if hist.status(sql_file, subs) != HistoryManager.NO_DIFF:
+            return False
+    except Exception:
+        return False
+
+    log = Log(options['-l'], verbosity)
+    log.write('\n### SQL_USER.PY: dbname=' + database + ' user=' + username + ' sqlfile=' \
+              + sql_file + ' host=' + options['-H'] + ' ###', INFO)
+    log.write('## Checking execution record ##', INFO)
+    log.write('# The main script and subscripts have not changed since last run. Exiting.', CRITICAL)
+    log.close()
+    return True
+
+
+class Log:
+    '''Writes lines to the log file and the console as sql_user.py's 'all'
+    logger does.'''
+    def __init__(self, log_file, verbosity):
+        self.file = open(log_file, 'a')
+        self.verbosity = verbosity
+
+    def write(self, msg, level):
+        asctime = time.strftime(LOG_DATE_FORMAT)
+        for line in msg.splitlines():
+            self.file.write(LOG_FORMAT % {'asctime': asctime, 'name': 'all', 'message': line} + '\n')
+            if level >= self.verbosity:
+                sys.stderr.write(CONSOLE_FORMAT % {'message': line} + '\n')
+
+    def close(self):
+        self.file.close()
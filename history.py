@@ -1,34 +1,44 @@
 import os
+import sys
+import time
+import fcntl
 
-import subprocess as subp
-
-from util import file_exists
+from util import file_exists, file_digest
 
 class HistoryManager:
     FS_BACKEND = 'FS'
+    SQLITE_BACKEND = 'SQLITE'
+    BACKENDS = [FS_BACKEND, SQLITE_BACKEND]
     NEW = 'NEW'
     NO_DIFF = 'NO_DIFF'
     DIFF = 'DIFF'
 
     def __init__(self, script_file, dbname, schema, backend='FS', path='complete'):
+        '''path is the directory the records go in. The SQLITE backend
+        keeps all of them in path/history.db.'''
         self._writer = None
+        self._diffs = {}
         if (backend == HistoryManager.FS_BACKEND):
             self._writer = _FSWriter(script_file, dbname, schema, path)
+        elif (backend == HistoryManager.SQLITE_BACKEND):
+            self._writer = _SQLiteWriter(script_file, dbname, schema, path)
         else:
             self._writer = _FSWriter(script_file, dbname, schema, path)
 
     def status(self, script, subs):
         '''Check the file and all its subscripts, and say whether
-        anything has changed. Returns NEW, NO_DIFF or DIFF'''
-        diff = self.diff(script)
-        sub_diff = self.diff_all(subs)
-        if diff[0] == HistoryManager.NO_DIFF \
-                and not sub_diff[HistoryManager.NEW] \
-                and not sub_diff[HistoryManager.DIFF]: # nothing changed
+        anything has changed. Returns NEW, NO_DIFF or DIFF. Only compares
+        content digests, the textual diffs are computed by diff and diff_all.'''
+        for file in [script] + list(subs):
+            if not file_exists(file):
+                raise InvalidPathException('File ' + file + ' does not exist.')
+        main_status = self._writer.status(script)
+        statuses = set([main_status] + [self._writer.status(sub) for sub in subs])
+        if main_status == HistoryManager.NO_DIFF \
+                and statuses == set([HistoryManager.NO_DIFF]): # nothing changed
             return HistoryManager.NO_DIFF
-        elif diff[0] == HistoryManager.NEW \
-                and not sub_diff[HistoryManager.NO_DIFF] \
-                and not sub_diff[HistoryManager.DIFF]: # if all the files are new
+        elif main_status == HistoryManager.NEW \
+                and statuses == set([HistoryManager.NEW]): # if all the files are new
             return HistoryManager.NEW
         else: # something did change
             return HistoryManager.DIFF
@@ -38,12 +48,22 @@ class HistoryManager:
         or the results of a 'diff' command if the file have changed.'''
         if not file_exists(file):
             raise InvalidPathException('File ' + file + ' does not exist.')
-        diff = self._writer.diff(file)
+        diff = self._diff(file)
         if diff == HistoryManager.NEW or diff == HistoryManager.NO_DIFF:
             return (diff, None)
         else:
             return (HistoryManager.DIFF, diff)
 
+    def _diff(self, file):
+        '''Run the writer's diff at most once per file, and only for the
+        files whose digest has changed.'''
+        if file not in self._diffs:
+            status = self._writer.status(file)
+            if status == HistoryManager.DIFF:
+                self._diffs[file] = self._writer.diff(file)
+            else:
+                self._diffs[file] = status
+        return self._diffs[file]
 
     def diff_all(self, files):
         ''' Returns a dictionary with lists.
@@ -56,7 +76,7 @@ class HistoryManager:
         for file in files:
             if not file_exists(file):
                 raise InvalidPathException('File ' + file + ' does not exist.')
-            diff = self._writer.diff(file)
+            diff = self._diff(file)
             if diff == HistoryManager.NEW:
                 result[HistoryManager.NEW].append(file)
             elif diff == HistoryManager.NO_DIFF:
@@ -67,16 +87,50 @@ class HistoryManager:
 
     def record(self, file):
         '''Record this script file as executed. Or you can pass a list of file names'''
+        self._diffs = {}
         if type(file) is list:
             for f in file:
                 if not file_exists(f):
-                    raise InvalidPathException('File ' + file + ' does not exist.')
-                self._writer.record(f)
+                    raise InvalidPathException('File ' + f + ' does not exist.')
+            self._writer.record_all(file)
         else:
             if not file_exists(file):
                 raise InvalidPathException('File ' + file + ' does not exist.')
             self._writer.record(file)
 
+    def checkpoint(self, file, line=None):
+        '''Record that a subscript completed, and was committed, during a
+        run of the script that has not finished yet. With line, the
+        statements of file itself from that line up to its next subscript.'''
+        if not file_exists(file):
+            raise InvalidPathException('File ' + file + ' does not exist.')
+        self._writer.checkpoint(file, _checkpoint_name(file, line))
+
+    def checkpointed(self, file, line=None):
+        '''True if the subscript, or the statements from line, has a
+        checkpoint and the file has not changed since.'''
+        return self._writer.checkpointed(file, _checkpoint_name(file, line))
+
+    def clear_checkpoints(self):
+        '''Forget the checkpoints, once the whole script is recorded.'''
+        self._writer.clear_checkpoints()
+
+    def file_statuses(self, files):
+        '''Returns a list of (file, NEW, NO_DIFF or DIFF), one per file.'''
+        for file in files:
+            if not file_exists(file):
+                raise InvalidPathException('File ' + file + ' does not exist.')
+        return [(file, self._writer.status(file)) for file in files]
+
+    def add_digests(self, digests):
+        '''Use the digests in the dictionary file -> digest instead of
+        reading those files again, for callers that hashed them already.'''
+        self._writer.add_digests(digests)
+
+def _checkpoint_name(file, line):
+    '''What a checkpoint is recorded as: the file, or file:line.'''
+    return line and '%s:%d' % (file, line) or file
+
 class InvalidPathException(Exception):
     def __init__(self, value):
         self.value = value
@@ -90,33 +144,399 @@ class _HistoryWriter:
     def __init__(self, script_file, dbname, schema):
         pass
 
+    def status(self, file):
+        '''Return NEW, NO_DIFF or DIFF'''
+        pass
+
     def diff(self, file):
+        '''Return NEW, NO_DIFF or the textual diff'''
         pass
 
     def record(self, file):
         pass
 
+    def record_all(self, files):
+        for file in files:
+            self.record(file)
+
+    def checkpoint(self, file, name):
+        '''Record the checkpoint name with the digest of file.'''
+        pass
+
+    def checkpoints(self):
+        '''Return a dictionary of checkpoint name -> digest'''
+        pass
+
+    def checkpointed(self, file, name):
+        return self.checkpoints().get(name) == self._digest(file)
+
+    def clear_checkpoints(self):
+        pass
+
+    def add_digests(self, digests):
+        self._digests.update(digests)
+
 class _FSWriter(_HistoryWriter):
+    '''Keeps a manifest of the digests, sizes and mtimes of the executed
+    files in path/script/dbname/schema/.digests, and the contents in a
+    compressed object store, path/objects/, where each distinct content
+    is stored once no matter how many scripts, databases and schemas
+    recorded it. Plain copies of the files under path/script/dbname/schema/
+    made by older versions are still read. Pushes running at the same time
+    into the same directory take turns updating the manifest, under a lock.'''
+    MANIFEST = '.digests'
+    CHECKPOINTS = '.digests.checkpoints' # named so that it is not taken for a record
+    LOCK = '.digests.lock'
+    OBJECTS = 'objects'
+
     def __init__(self, script_file, dbname, schema, path):
         self.BASE_PATH = os.path.normpath(path) + '/' + os.path.basename(script_file) + '/' + dbname + '/' + schema + '/'
+        self.OBJECT_PATH = os.path.join(os.path.normpath(path), _FSWriter.OBJECTS)
+        self._manifest = None
+        self._digests = {}
+
+    def status(self, file):
+        recorded = self._recorded_digest(file)
+        if not recorded:
+            return HistoryManager.NEW
+        if recorded[1] != os.path.getsize(file):
+            return HistoryManager.DIFF
+        if recorded[0] != self._digest(file):
+            return HistoryManager.DIFF
+        return HistoryManager.NO_DIFF
 
     def diff(self, file):
-        path = self._record_path(file)
-        if not file_exists(path):
+        recorded = self._recorded_digest(file)
+        if not recorded:
             return HistoryManager.NEW
-        proc = subp.Popen(['diff', file, path], stdout=subp.PIPE)
-        diff = proc.communicate()[0]
-        if diff:
-            return diff
-        else:
-            return HistoryManager.NO_DIFF
+        return _text_diff(self._recorded_content(file, recorded[0]), file)
 
     def record(self, file):
-        dest = self._record_path(file)
-        path = os.path.split(dest)[0]
-        if not file_exists(path):
-            os.makedirs(path)
-        os.system('cp ' + file + ' ' + dest)
+        self.record_all([file])
+
+    def record_all(self, files):
+        entries = {}
+        for file in files:
+            digest = self._digest(file)
+            self._store_object(file, digest)
+            stat = os.stat(file)
+            entries[file] = (digest, stat.st_size, int(stat.st_mtime))
+        self._update_manifest(entries)
+        for file in files:
+            if os.path.exists(self._record_path(file)):
+                os.remove(self._record_path(file)) # the manifest supersedes old copies
+
+    def checkpoints(self):
+        checkpoints = {}
+        path = self.BASE_PATH + _FSWriter.CHECKPOINTS
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split(' ', 1)
+                    if len(parts) == 2:
+                        checkpoints[parts[1]] = parts[0]
+        return checkpoints
+
+    def checkpoint(self, file, name):
+        digest = file_digest(file)
+        self._digests.pop(file, None)
+        lock = self._lock()
+        try:
+            checkpoints = self.checkpoints()
+            checkpoints[name] = digest
+            path = self.BASE_PATH + _FSWriter.CHECKPOINTS
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), id(self))
+            with open(tmp, 'w') as f:
+                for name, digest in sorted(checkpoints.items()):
+                    f.write('%s %s\n' % (digest, name))
+            os.rename(tmp, path)
+        finally:
+            lock.close()
+
+    def clear_checkpoints(self):
+        path = self.BASE_PATH + _FSWriter.CHECKPOINTS
+        if os.path.exists(path):
+            os.remove(path)
+
+    def records(self):
+        '''Returns (file, digest, size, mtime, content) for every recorded file.'''
+        self._load_manifest()
+        files = set(self._manifest)
+        for dir, dirs, names in os.walk(self.BASE_PATH):
+            for name in names:
+                if not name.startswith(_FSWriter.MANIFEST):
+                    files.add(os.path.relpath(os.path.join(dir, name), self.BASE_PATH))
+        result = []
+        for file in sorted(files):
+            digest, size = self._recorded_digest(file)
+            result.append((file, digest, size, self._manifest[file][2],
+                           self._recorded_content(file, digest)))
+        return result
 
     def _record_path(self, file):
         return self.BASE_PATH + file
+
+    def _object_path(self, digest):
+        return os.path.join(self.OBJECT_PATH, digest[:2], digest[2:] + '.gz')
+
+    def _store_object(self, file, digest):
+        '''Compress the file into the object store, unless it is already there.'''
+        dest = self._object_path(digest)
+        if os.path.exists(dest):
+            return
+        if not os.path.exists(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError: # made by a concurrent push
+                pass
+        import gzip
+        import shutil
+        tmp = '%s.%d.%d.tmp' % (dest, os.getpid(), id(self))
+        src = open(file, 'rb')
+        try:
+            out = gzip.open(tmp, 'wb')
+            try:
+                shutil.copyfileobj(src, out)
+            finally:
+                out.close()
+        finally:
+            src.close()
+        os.rename(tmp, dest)
+
+    def _recorded_content(self, file, digest):
+        import gzip
+        obj = self._object_path(digest)
+        if os.path.exists(obj):
+            f = gzip.open(obj, 'rb')
+        else:
+            f = open(self._record_path(file), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _digest(self, file):
+        '''Digest of the file being checked, computed once per run.'''
+        if file not in self._digests:
+            self._digests[file] = file_digest(file)
+        return self._digests[file]
+
+    def _recorded_digest(self, file):
+        '''Returns (digest, size) of the recorded file, or None if it was
+        never recorded. Old style copies that are not in the manifest, or
+        were touched since, are hashed and added to it.'''
+        self._load_manifest()
+        entry = self._manifest.get(file)
+        path = self._record_path(file)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            if not entry or entry[1] != stat.st_size or entry[2] != int(stat.st_mtime):
+                entry = (file_digest(path), stat.st_size, int(stat.st_mtime))
+                self._update_manifest({file: entry})
+        return entry and entry[:2]
+
+    def _load_manifest(self):
+        if self._manifest is not None:
+            return
+        self._manifest = {}
+        manifest = self.BASE_PATH + _FSWriter.MANIFEST
+        if not os.path.exists(manifest):
+            return
+        with open(manifest, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split(' ', 3)
+                if len(parts) == 4:
+                    self._manifest[parts[3]] = (parts[0], int(parts[1]), int(parts[2]))
+
+    def _update_manifest(self, entries):
+        '''Add the entries, file -> (digest, size, mtime), to the manifest.
+        It is read again under the lock, so that the entries another push
+        saved since it was loaded are kept.'''
+        lock = self._lock()
+        try:
+            self._manifest = None
+            self._load_manifest()
+            self._manifest.update(entries)
+            self._save_manifest()
+        finally:
+            lock.close()
+
+    def _lock(self):
+        '''Lock the manifest and the checkpoints of the directory, until the
+        returned file is closed.'''
+        if not os.path.exists(self.BASE_PATH):
+            try:
+                os.makedirs(self.BASE_PATH)
+            except OSError: # made by a concurrent push
+                pass
+        lock = open(self.BASE_PATH + _FSWriter.LOCK, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _save_manifest(self):
+        '''Write the manifest, replacing the old one at once. Called with
+        the lock held, see _update_manifest.'''
+        manifest = self.BASE_PATH + _FSWriter.MANIFEST
+        tmp = '%s.%d.%d.tmp' % (manifest, os.getpid(), id(self))
+        with open(tmp, 'w') as f:
+            for file, (digest, size, mtime) in sorted(self._manifest.items()):
+                f.write('%s %d %d %s\n' % (digest, size, mtime, file))
+        os.rename(tmp, manifest)
+
+
+def _text_diff(recorded, file):
+    '''Unified diff between the recorded content and the file, or NO_DIFF.'''
+    import difflib
+    with open(file, 'r') as f:
+        current = f.readlines()
+    diff = ''.join(difflib.unified_diff(recorded.splitlines(True), current,
+                                        'recorded/' + file, file))
+    if diff:
+        return diff
+    else:
+        return HistoryManager.NO_DIFF
+
+
+class _SQLiteWriter(_HistoryWriter):
+    '''Keeps the records of all the scripts, databases and schemas in a
+    single SQLite file, path/history.db. The file is in WAL mode, so
+    several pushes can read and write it at the same time.'''
+    DB_FILE = 'history.db'
+    BUSY_TIMEOUT = 60 # secs to wait for another writer
+
+    def __init__(self, script_file, dbname, schema, path):
+        self._key = (os.path.basename(script_file), dbname, schema)
+        self._path = os.path.join(path, _SQLiteWriter.DB_FILE)
+        self._conn = None
+        self._records = None
+        self._digests = {}
+
+    def status(self, file):
+        record = self._load().get(file)
+        if not record:
+            return HistoryManager.NEW
+        if record[1] != os.path.getsize(file) or record[0] != self._digest(file):
+            return HistoryManager.DIFF
+        return HistoryManager.NO_DIFF
+
+    def diff(self, file):
+        if not self._load().get(file):
+            return HistoryManager.NEW
+        row = self._connect().execute('SELECT content FROM records WHERE script=? AND db=? '
+                                      'AND schema=? AND subscript=?', self._key + (file,)).fetchone()
+        return _text_diff(str(row[0]), file)
+
+    def record(self, file):
+        self.record_all([file])
+
+    def record_all(self, files):
+        import sqlite3
+        now = time.time()
+        rows = []
+        for file in files:
+            with open(file, 'rb') as f:
+                content = f.read()
+            rows.append(self._key + (file, self._digest(file), len(content),
+                                     sqlite3.Binary(content), os.path.getmtime(file), now))
+        conn = self._connect()
+        with conn: # one transaction for all of them
+            conn.executemany('INSERT OR REPLACE INTO records (script, db, schema, subscript, '
+                             'digest, size, content, mtime, recorded_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._records = None
+
+    def checkpoints(self):
+        cursor = self._connect().execute('SELECT subscript, digest FROM checkpoints '
+                                         'WHERE script=? AND db=? AND schema=?', self._key)
+        return dict(cursor.fetchall())
+
+    def checkpoint(self, file, name):
+        self._digests.pop(file, None)
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO checkpoints (script, db, schema, subscript, '
+                         'digest, done_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         self._key + (name, self._digest(file), time.time()))
+
+    def clear_checkpoints(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM checkpoints WHERE script=? AND db=? AND schema=?', self._key)
+
+    def _digest(self, file):
+        if file not in self._digests:
+            self._digests[file] = file_digest(file)
+        return self._digests[file]
+
+    def _load(self):
+        '''Read the digests of all the files recorded for this script at once.'''
+        if self._records is None:
+            self._records = {}
+            cursor = self._connect().execute('SELECT subscript, digest, size FROM records '
+                                             'WHERE script=? AND db=? AND schema=?', self._key)
+            for subscript, digest, size in cursor:
+                self._records[subscript] = (digest, size)
+        return self._records
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = connect_sqlite_history(self._path)
+        return self._conn
+
+
+def connect_sqlite_history(db_file):
+    '''Open the SQLite history file, creating it if needed.'''
+    import sqlite3
+    dir = os.path.dirname(db_file)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    conn = sqlite3.connect(db_file, timeout=_SQLiteWriter.BUSY_TIMEOUT)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                     'script TEXT NOT NULL, db TEXT NOT NULL, schema TEXT NOT NULL, '
+                     'subscript TEXT NOT NULL, digest TEXT NOT NULL, size INTEGER NOT NULL, '
+                     'content BLOB, mtime REAL, recorded_at REAL, '
+                     'PRIMARY KEY (script, db, schema, subscript))')
+        conn.execute('CREATE INDEX IF NOT EXISTS records_digest ON records (digest)')
+        conn.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                     'script TEXT NOT NULL, db TEXT NOT NULL, schema TEXT NOT NULL, '
+                     'subscript TEXT NOT NULL, digest TEXT NOT NULL, done_at REAL, '
+                     'PRIMARY KEY (script, db, schema, subscript))')
+    return conn
+
+def import_fs_history(fs_path, db_file):
+    '''Copy all the records of an FS history tree (fs_path/script/db/schema/...)
+    into a SQLite history file. Returns the number of records imported.'''
+    import sqlite3
+    rows = []
+    for script in _subdirs(fs_path):
+        if script == _FSWriter.OBJECTS:
+            continue
+        for dbname in _subdirs(os.path.join(fs_path, script)):
+            for schema in _subdirs(os.path.join(fs_path, script, dbname)):
+                writer = _FSWriter(script, dbname, schema, fs_path)
+                for file, digest, size, mtime, content in writer.records():
+                    rows.append((script, dbname, schema, file, digest, size,
+                                 sqlite3.Binary(content), mtime, mtime))
+    conn = connect_sqlite_history(db_file)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO records (script, db, schema, subscript, '
+                         'digest, size, content, mtime, recorded_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.close()
+    return len(rows)
+
+def _subdirs(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted([d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))])
+
+
+if __name__ == '__main__':
+    # history.py import FS_DIR: move the FS records of FS_DIR into FS_DIR/history.db
+    if len(sys.argv) != 3 or sys.argv[1] != 'import':
+        print 'Usage: %s import RECORD_DIR' % (sys.argv[0],)
+        sys.exit(1)
+    count = import_fs_history(sys.argv[2], os.path.join(sys.argv[2], _SQLiteWriter.DB_FILE))
+    print 'Imported %d records.' % (count,)
@@ -0,0 +1,114 @@
+'''Logging plumbing for sql_user.py: a background writer thread that does
+the file and console I/O, and the formatters of the log file.
+
+With a LogWriter the loggers only put records on a queue, so the thread
+that drains the client never waits for a disk or a terminal. Call flush()
+before asking the user anything and stop() before exiting.'''
+import json
+import time
+import logging
+import threading
+import Queue
+
+
+class LogWriter(threading.Thread):
+    '''Passes queued records on to their handlers, in order.'''
+    def __init__(self):
+        threading.Thread.__init__(self, name='LogWriter')
+        self.daemon = True
+        self._queue = Queue.Queue()
+
+    def put(self, handlers, record):
+        self._queue.put((handlers, record))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                handlers, record = item
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        '''Wait until everything queued so far has been written.'''
+        if self.isAlive():
+            self._queue.join()
+
+    def stop(self):
+        '''Write out what is queued and end the thread.'''
+        if self.isAlive():
+            self._queue.put(None)
+            self.join()
+
+
+class QueueHandler(logging.Handler):
+    '''Stands in for a group of handlers, whose work is done by a LogWriter.'''
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        try:
+            self.writer.put(self.handlers, self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        '''Render the message now, its arguments may change before it is written.'''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class ContextFilter(logging.Filter):
+    '''Stamps records with the run, file and phase they were logged in.
+    Goes on the loggers, so that it runs on the thread that logged.'''
+    def __init__(self, run_metrics):
+        logging.Filter.__init__(self)
+        self.run_metrics = run_metrics
+
+    def filter(self, record):
+        record.run_id = self.run_metrics.run_id
+        record.phase, record.sql_file = self.run_metrics.context()
+        return True
+
+
+class LineFormatter(logging.Formatter):
+    '''Formats every line of a message logged with extra={'split_lines': True}
+    as if it had been logged on its own.'''
+    def format(self, record):
+        msg = record.getMessage()
+        if not getattr(record, 'split_lines', False) or '\n' not in msg:
+            return logging.Formatter.format(self, record)
+        lines = []
+        for line in msg.split('\n'):
+            line_record = logging.makeLogRecord(record.__dict__)
+            line_record.msg = line
+            line_record.args = None
+            lines.append(logging.Formatter.format(self, line_record))
+        return '\n'.join(lines)
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record: time, run id, file, phase, logger,
+    level and message.'''
+    def format(self, record):
+        event = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                     run=getattr(record, 'run_id', None),
+                     file=getattr(record, 'sql_file', None),
+                     phase=getattr(record, 'phase', None),
+                     logger=record.name,
+                     level=record.levelname,
+                     msg=record.getMessage())
+        if record.exc_text:
+            event['exc'] = record.exc_text
+        return json.dumps(event, sort_keys=True)
@@ -0,0 +1,85 @@
+from util import file_exists, script_file
+
+
+class ManifestException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+    def __repr__(self):
+        return self.__str__()
+
+
+class ManifestEntry:
+    '''One script to run: the file, the arguments to pass to it and
+    the credentials to run it with.'''
+    def __init__(self, sql_file, args='', user='', password='', lineno=0):
+        self.sql_file = sql_file
+        self.args = args
+        self.user = user
+        self.password = password
+        self.lineno = lineno
+        self.depends = []
+
+    def __repr__(self):
+        return 'ManifestEntry(%s, user=%s, line=%d)' % (self.sql_file, self.user, self.lineno)
+
+
+def read_manifest(manifest_file, user, password):
+    '''Parse a release manifest and return a list of ManifestEntry objects
+    in the order they should run. The format is one script per line,
+    optionally followed by its arguments:
+
+        # comments and blank lines are ignored
+        user scott tiger        <- following scripts run as scott
+        tables/001_create.sql
+        data/002_load.sql arg1 arg2
+        user sync               <- password defaults to the command line one
+        depends data/002_load.sql tables/001_create.sql
+
+    A 'depends FILE DEP [DEP...]' line says FILE must not start before
+    the DEP scripts are done; it only matters when scripts run in parallel.
+    Scripts before the first 'user' line run as the user given on the
+    command line. A name is that of the .sql file if only that one exists,
+    as for the clients. Throws IOError if the manifest cannot be read and
+    ManifestException if it is malformed.'''
+    entries = []
+    depends = []
+    cur_user, cur_passwd = user, password
+    with open(manifest_file, 'r') as file:
+        for lineno, line in enumerate(file):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            words = line.split()
+            if words[0] == 'user':
+                if len(words) not in (2, 3):
+                    raise ManifestException('%s:%d: expected "user NAME [PASSWORD]"'
+                                            % (manifest_file, lineno + 1))
+                cur_user = words[1]
+                cur_passwd = len(words) == 3 and words[2] or password
+                continue
+            if words[0] == 'depends':
+                if len(words) < 3:
+                    raise ManifestException('%s:%d: expected "depends FILE DEP [DEP...]"'
+                                            % (manifest_file, lineno + 1))
+                depends.append((lineno + 1, script_file(words[1]),
+                                [script_file(w) for w in words[2:]]))
+                continue
+            sql_file = words[0]
+            if not file_exists(sql_file):
+                raise ManifestException('%s:%d: file %s does not exist'
+                                        % (manifest_file, lineno + 1, sql_file))
+            args = ' '.join(words[1:])
+            entries.append(ManifestEntry(script_file(sql_file), args, cur_user, cur_passwd, lineno + 1))
+
+    files = set([e.sql_file for e in entries])
+    for lineno, file, deps in depends:
+        for f in [file] + deps:
+            if f not in files:
+                raise ManifestException('%s:%d: %s is not listed in the manifest'
+                                        % (manifest_file, lineno, f))
+        for entry in entries:
+            if entry.sql_file == file:
+                entry.depends.extend(deps)
+    return entries
@@ -0,0 +1,153 @@
+'''Phase timings and counters of a run, written out as JSON and handed
+to any hooks that were registered:
+
+    def ship(run):             # run is the dict that goes in the JSON file
+        collector.send(run)
+    metrics.register_hook(ship)
+
+or from the command line: sql_user.py ... --metrics-hook mymodule:ship'''
+import os
+import time
+import json
+import socket
+import threading
+from contextlib import contextmanager
+
+_hooks = []
+
+
+class RunMetrics:
+    '''Collects how long each phase of a run took and counts things.
+    Safe to use from several threads.'''
+    def __init__(self, run_id=None, start=None):
+        self.start = start or time.time()
+        self.run_id = run_id or '%s-%d-%d' % (socket.gethostname(), os.getpid(), int(self.start))
+        self.info = {}
+        self.phases = []
+        self.counters = {}
+        self.statements = [] # the slowest statements of the profiled scripts
+        self._lock = threading.Lock()
+        self._local = threading.local() # the phases the thread is in
+
+    @contextmanager
+    def phase(self, name, **tags):
+        '''Time the body of a with statement as the phase name.'''
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append((name, tags.get('file')))
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start, time.time(), **tags)
+            stack.pop()
+
+    def context(self):
+        '''(phase, file) the calling thread is in. The file is that of the
+        innermost phase that has one, or the sql_file of the run.'''
+        stack = self._local.__dict__.get('stack', [])
+        files = [f for n, f in stack if f]
+        return (stack and stack[-1][0] or None,
+                files and files[-1] or self.info.get('sql_file'))
+
+    def add_phase(self, name, start, end, **tags):
+        record = dict(tags)
+        record.update(phase=name, start=round(start - self.start, 6), secs=round(end - start, 6))
+        self._lock.acquire()
+        try:
+            self.phases.append(record)
+        finally:
+            self._lock.release()
+
+    def count(self, name, value=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def to_dict(self):
+        totals = {}
+        for p in self.phases:
+            totals[p['phase']] = round(totals.get(p['phase'], 0) + p['secs'], 6)
+        result = dict(self.info)
+        result.update(run_id=self.run_id,
+                      started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+                      secs=round(time.time() - self.start, 6),
+                      phases=self.phases, totals=totals, counters=self.counters)
+        if self.statements:
+            result['statements'] = self.statements
+        return result
+
+
+class StatementProfile:
+    '''Wall time, output size and errors of the statements of scripts run
+    one statement at a time.'''
+    def __init__(self):
+        self.statements = []
+
+    def add(self, sql_file, lineno, text, secs, output_bytes, errors):
+        self.statements.append(dict(file=sql_file, line=lineno, statement=text,
+                                    secs=round(secs, 6), output_bytes=output_bytes, errors=errors))
+
+    def total(self):
+        return sum([s['secs'] for s in self.statements])
+
+    def ranked(self, top=None):
+        '''The statements, slowest first.'''
+        ranked = sorted(self.statements, key=lambda s: s['secs'], reverse=True)
+        return top and ranked[:top] or ranked
+
+    def report(self, top=20):
+        '''The text of a table of the slowest statements.'''
+        total = self.total() or 1
+        lines = ['%4s %9s %6s %9s %4s  %-30s %s' % ('RANK', 'SECS', '%', 'BYTES', 'ERR', 'WHERE', 'STATEMENT')]
+        for rank, s in enumerate(self.ranked(top)):
+            where = '%s:%s' % (s['file'], s['line'])
+            text = ' '.join(s['statement'].split())
+            lines.append('%4d %9.3f %6.1f %9d %4d  %-30s %s' % (rank + 1, s['secs'], s['secs'] * 100 / total,
+                                                               s['output_bytes'], s['errors'], where, text[:60]))
+        lines.append('%d statements in %.3f secs' % (len(self.statements), self.total()))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def null_phase():
+    '''Stands in for RunMetrics.phase when nothing is measured.'''
+    yield
+
+def register_hook(fn):
+    '''fn(run) will be called with the dict of every finished run.'''
+    _hooks.append(fn)
+
+def load_hook(spec):
+    '''Register the function named by "module:function".'''
+    module, _, name = spec.partition(':')
+    register_hook(getattr(__import__(module, fromlist=[name]), name))
+
+def emit(run_metrics, json_file=None):
+    '''Write the metrics to json_file, if given, and pass them to the
+    hooks. Returns the list of exceptions raised by the hooks, a broken
+    collector must not fail the run.'''
+    run = run_metrics.to_dict()
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(run, f, indent=1, sort_keys=True)
+    errors = []
+    for hook in _hooks:
+        try:
+            hook(run)
+        except Exception, e:
+            errors.append(e)
+    return errors
+
+def process_start_time():
+    '''When the current process was started, None if it cannot be told.'''
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name may have spaces, the fields after it do not
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as f:
+            btime = [int(l.split()[1]) for l in f if l.startswith('btime')][0]
+        return btime + float(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return None
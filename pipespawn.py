@@ -0,0 +1,130 @@
+'''A pexpect child talking to the client through pipes instead of a
+pseudo-terminal.
+
+On a pty the clients behave as if a user were typing: they echo, redraw
+the line (vsql does it for every character), print prompts, page and
+pad the output with carriage returns. On pipes they run in their batch
+mode and print the output of the statements and nothing else. PipeSpawn
+is a pexpect child like pexpect.spawn, with expect, send and logfile, so
+dbif drives both the same way:
+
+    child = PipeSpawn('sqlplus -S -L scott/tiger@db', cwd='release')
+    child.sendline('prompt done')
+    child.expect('done')
+
+stderr goes to the same pipe as stdout, the clients print some of their
+errors there. child_fd is the end the output is read from, for the select
+of sessionloop. Unlike pexpect's popen_spawn there is no reader thread.
+sendintr() sends the client a SIGINT, which is what ^C on its terminal
+does.'''
+import os
+import errno
+import time
+import shlex
+import signal
+import subprocess
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+from pexpect.utils import select_ignore_interrupts
+
+
+class PipeSpawn(SpawnBase):
+    def __init__(self, command, cwd=None, env=None, timeout=30, maxread=2000,
+                 searchwindowsize=None, logfile=None):
+        SpawnBase.__init__(self, timeout, maxread, searchwindowsize, logfile)
+        self.command = command
+        self.args = shlex.split(command)
+        # a session of its own, like pexpect.spawn: a ^C typed to us is not for the client
+        self.proc = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, cwd=cwd, env=env,
+                                     close_fds=True, preexec_fn=os.setsid)
+        self.pid = self.proc.pid
+        self.child_fd = self.proc.stdout.fileno()
+        self.closed = False
+        self.terminated = False
+        self.name = '<pipes to %s>' % (self.args[0],)
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        if self.child_fd not in select_ignore_interrupts([self.child_fd], [], [], timeout)[0]:
+            raise pexpect.TIMEOUT('Timeout exceeded.')
+        return SpawnBase.read_nonblocking(self, size)
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        try:
+            self.proc.stdin.write(s)
+            self.proc.stdin.flush()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            # the client is gone, the reader gets the EOF
+        return len(s)
+
+    def sendline(self, s=''):
+        return self.send(s + self.linesep)
+
+    def sendeof(self):
+        '''Close the input of the client.'''
+        self.proc.stdin.close()
+
+    def sendintr(self):
+        self.kill(signal.SIGINT)
+
+    def kill(self, sig):
+        if self.isalive():
+            os.kill(self.pid, sig)
+
+    def isalive(self):
+        if self.flag_eof:
+            # the output ends when the client exits, it may not have yet
+            self.proc.wait()
+        if self.proc.poll() is None:
+            return True
+        self._exited()
+        return False
+
+    def wait(self):
+        self.proc.wait()
+        self._exited()
+        return self.exitstatus
+
+    def terminate(self, force=False):
+        '''Ask the client to exit with SIGHUP and SIGINT, and with force
+        kill it if it does not. Returns True if it is gone.'''
+        signals = [signal.SIGHUP, signal.SIGCONT, signal.SIGINT]
+        if force:
+            signals.append(signal.SIGKILL)
+        for sig in signals:
+            if not self.isalive():
+                return True
+            self.kill(sig)
+            time.sleep(self.delayafterterminate)
+        return not self.isalive()
+
+    def close(self, force=True):
+        if self.closed:
+            return
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except IOError:
+                pass
+        self.terminate(force)
+        self.child_fd = -1
+        self.closed = True
+
+    def setecho(self, state):
+        '''There is no terminal to echo.'''
+        pass
+
+    def _exited(self):
+        self.terminated = True
+        status = self.proc.returncode
+        if status < 0:
+            self.exitstatus, self.signalstatus = None, -status
+        else:
+            self.exitstatus, self.signalstatus = status, None
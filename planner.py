@@ -0,0 +1,272 @@
+'''Plan a release before its window: which scripts will run on which
+databases, which will be skipped and which changed since they last ran.
+
+    planner.py -t db1 -t db2@host2 -u scott release_dir/
+    planner.py -t db1 push_script.sh --json plan.json
+
+The release is a directory of .sql files, whose top level scripts (those
+no other script includes) run in name order, a push script whose sql_run
+and sql_run_batch calls are read along with the dbuser= lines before
+them, or a manifest. Every file is hashed once, on all the cores, and the
+execution record of every script is checked on every target. The plan
+lists the scripts in the order they run with their subscripts in the
+order they are included, what will be done with them and how much SQL
+that is. The exit code is 1 if a script could not be planned.'''
+import os
+import re
+import sys
+import time
+import json
+import argparse
+import multiprocessing
+
+import util
+from fanout import split_target
+from history import HistoryManager
+from manifest import read_manifest, ManifestException, ManifestEntry
+from preflight import check_scripts
+
+RUN = 'RUN'
+RERUN = 'RERUN'
+SKIP = 'SKIP'
+ERROR = 'ERROR'
+
+_SQL_RUN = re.compile(r'^\s*(sql_run|sql_run_batch)\s+([^\s;]+)')
+_DBUSER = re.compile(r'''^\s*dbuser=["']?([\w$]+)''')
+
+
+class FileInfo:
+    def __init__(self, file, digest=None, size=0, statements=0, problem=''):
+        self.file = file
+        self.digest = digest
+        self.size = size
+        self.statements = statements
+        self.problem = problem
+
+
+class PlanStep:
+    '''One script of the release on one target.'''
+    def __init__(self, order, sql_file, user, action, files=None, problem=''):
+        self.order = order
+        self.sql_file = sql_file
+        self.user = user
+        self.action = action
+        self.files = files or [] # (file, status) in the order they run
+        self.problem = problem
+        self.statements = 0
+        self.size = 0
+
+    def to_dict(self):
+        return dict(order=self.order, script=self.sql_file, user=self.user, action=self.action,
+                    files=[dict(file=f, status=s) for f, s in self.files],
+                    statements=self.statements, bytes=self.size, problem=self.problem)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Show what a release would run on every target, '
+                                     'from the execution records, without connecting anywhere.')
+    parser.add_argument('release',
+                        help='A directory of .sql files, a push script or a manifest.')
+    parser.add_argument('-t', '--target', dest='targets', action='append', default=[],
+                        metavar='db[@host]', help='A database to plan for. Can be repeated.')
+    parser.add_argument('--targets-file', metavar='FILE',
+                        help='File with one db[@host] target per line.')
+    parser.add_argument('-u', '--user', default='',
+                        help='The user running the scripts, for those of a directory and those '
+                        'a push script or manifest runs before choosing one.')
+    parser.add_argument('-c', '--cd', dest='cddir', metavar='DIR',
+                        help='Directory the scripts, and the record directory, are relative to, '
+                        'like -c of db_release_common.sh. Default is the release directory, or '
+                        'the one the push script or manifest is in.')
+    parser.add_argument('-D', '--dbms', metavar='DBMS', default='oracle',
+                        help='Name of the DBMS, for the include syntax. Default is \'oracle\'.')
+    parser.add_argument('-r', '--record', dest='recdir', default='complete',
+                        help='Directory of the execution records. Default is \'complete\'')
+    parser.add_argument('--history-backend', choices=HistoryManager.BACKENDS, default='FS',
+                        help='How the execution records are kept, FS (the default) or SQLITE.')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='How many processes hash the files. Default is one per core.')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the plan to FILE as JSON.')
+    args = parser.parse_args(argv)
+    if args.targets_file:
+        with open(args.targets_file) as file:
+            args.targets.extend([l.strip() for l in file if l.strip() and not l.startswith('#')])
+    return args
+
+def release_dir_entries(recdir, user, dbms):
+    '''The top level .sql files under the current directory, in name
+    order. The directories the records are in are not looked into.'''
+    recdir = os.path.normpath(recdir)
+    files = []
+    for dir, subdirs, names in os.walk('.'):
+        dir = os.path.normpath(dir)
+        subdirs[:] = sorted([d for d in subdirs
+                             if (recdir + os.sep).find(os.path.normpath(os.path.join(dir, d)) + os.sep) != 0])
+        files += [os.path.normpath(os.path.join(dir, n)) for n in names if n.endswith('.sql')]
+    included = set()
+    for file in files:
+        try:
+            included.update(util.subscript_graph(file, dbms)[file])
+        except (IOError, util.IncludeCycleException):
+            pass # reported when the script is planned
+    return [ManifestEntry(f, user=user) for f in sorted(files) if f not in included]
+
+def push_script_entries(push_script, user):
+    '''The scripts run by the sql_run and sql_run_batch calls of a push
+    script. Returns None if it has none.'''
+    entries = []
+    found = False
+    with open(push_script) as file:
+        for line in file:
+            match = _DBUSER.match(line)
+            if match:
+                user = match.group(1)
+                continue
+            match = _SQL_RUN.match(line)
+            if not match:
+                continue
+            found = True
+            if match.group(1) == 'sql_run':
+                entries.append(ManifestEntry(match.group(2), user=user))
+            else:
+                entries += read_manifest(match.group(2), user, '')
+    return found and entries or None
+
+def read_release(args):
+    '''Change to the directory the scripts are relative to and return the
+    ManifestEntries of the release.'''
+    release = os.path.abspath(args.release)
+    is_dir = os.path.isdir(release)
+    os.chdir(args.cddir or (is_dir and release or os.path.dirname(release)))
+    if is_dir:
+        return release_dir_entries(args.recdir, args.user, args.dbms)
+    if release.endswith('.sql'):
+        return [ManifestEntry(os.path.relpath(release), user=args.user)]
+    entries = push_script_entries(release, args.user)
+    if entries is None:
+        entries = read_manifest(release, args.user, '')
+    return entries
+
+def measure(job):
+    '''Digest, size and statement count of a file. Runs in the pool.'''
+    file, dbms = job
+    try:
+        with open(file, 'r') as f:
+            statements = len(util.split_script(f.read(), dbms))
+        return FileInfo(file, util.file_digest(file), os.path.getsize(file), statements)
+    except (IOError, OSError), e:
+        return FileInfo(file, problem=str(e))
+
+def measure_all(files, dbms, jobs):
+    '''Returns a dictionary of file -> FileInfo.'''
+    work = [(file, dbms) for file in files]
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        try:
+            infos = pool.map(measure, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        infos = map(measure, work)
+    return dict([(info.file, info) for info in infos])
+
+def plan_target(args, database, entries, scripts, infos):
+    '''Returns the PlanSteps of the release on one database.'''
+    digests = dict([(f, info.digest) for f, info in infos.items() if info.digest])
+    steps = []
+    for order, entry in enumerate(entries):
+        check = scripts[entry.sql_file]
+        if check.problem:
+            steps.append(PlanStep(order + 1, entry.sql_file, entry.user, ERROR, problem=check.problem))
+            continue
+        try:
+            hist = HistoryManager(entry.sql_file, database, entry.user,
+                                  backend=args.history_backend, path=args.recdir)
+            hist.add_digests(digests)
+            files = hist.file_statuses([entry.sql_file] + check.subs)
+        except Exception, e:
+            steps.append(PlanStep(order + 1, entry.sql_file, entry.user, ERROR, problem=str(e)))
+            continue
+        statuses = set([status for f, status in files])
+        if statuses == set([HistoryManager.NO_DIFF]):
+            action = SKIP
+        elif statuses == set([HistoryManager.NEW]):
+            action = RUN
+        else:
+            action = RERUN
+        step = PlanStep(order + 1, entry.sql_file, entry.user, action, files)
+        if action != SKIP:
+            step.statements = sum([infos[f].statements for f, s in files])
+            step.size = sum([infos[f].size for f, s in files])
+        steps.append(step)
+    return steps
+
+def report(plans, databases, elapsed):
+    '''Returns the text of the plan and the number of scripts that could
+    not be planned.'''
+    lines = []
+    errors = 0
+    for database in databases:
+        steps = plans[database]
+        count = dict([(a, len([s for s in steps if s.action == a])) for a in (RUN, RERUN, SKIP, ERROR)])
+        errors += count[ERROR]
+        lines += ['', '## %s: %d to run, %d to run again, %d to skip, %d errors'
+                  % (database, count[RUN], count[RERUN], count[SKIP], count[ERROR]),
+                  '%4s  %-6s %-40s %-12s %5s %7s %9s' % ('#', 'ACTION', 'SCRIPT', 'USER', 'FILES', 'STMTS', 'KB')]
+        for step in steps:
+            if step.action == ERROR:
+                lines.append('%4d  %-6s %-40s %-12s %s' % (step.order, step.action, step.sql_file,
+                                                           step.user, step.problem))
+            elif step.action == SKIP:
+                lines.append('%4d  %-6s %-40s %-12s %5d' % (step.order, step.action, step.sql_file,
+                                                            step.user, len(step.files)))
+            else:
+                lines.append('%4d  %-6s %-40s %-12s %5d %7d %9.1f' % (step.order, step.action, step.sql_file,
+                                                                     step.user, len(step.files), step.statements,
+                                                                     step.size / 1024.0))
+                # the subscripts in the order they are included, the main script first
+                lines += ['%12s %-7s %s' % ('', status, file) for file, status in step.files]
+        todo = [s for s in steps if s.action in (RUN, RERUN)]
+        lines.append('Work on %s: %d scripts, %d files, %d statements, %.1f KB' %
+                     (database, len(todo), sum([len(s.files) for s in todo]),
+                      sum([s.statements for s in todo]), sum([s.size for s in todo]) / 1024.0))
+    lines.append('')
+    lines.append('%d scripts on %d targets planned in %.1f secs: %d errors' %
+                 (len(plans and plans.values()[0] or []), len(databases), elapsed, errors))
+    return '\n'.join(lines), errors
+
+def main(argv):
+    args = parse_args(argv[1:])
+    if not args.targets:
+        print 'No targets given, use -t or --targets-file.'
+        sys.exit(1)
+    start = time.time()
+    json_file = args.json and os.path.abspath(args.json)
+    try:
+        entries = read_release(args)
+    except (IOError, OSError, ManifestException), e:
+        print 'Could not read the release %s: %s' % (args.release, e)
+        sys.exit(1)
+
+    scripts = check_scripts(entries, args.dbms)
+    files = set(scripts)
+    for check in scripts.values():
+        files.update(check.subs or [])
+    infos = measure_all(sorted(files), args.dbms, args.jobs)
+
+    databases = [split_target(t)[0] for t in args.targets]
+    plans = dict([(database, plan_target(args, database, entries, scripts, infos)) for database in databases])
+    text, errors = report(plans, databases, time.time() - start)
+    print text
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(dict(release=args.release, dbms=args.dbms, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           targets=dict([(d, [s.to_dict() for s in plans[d]]) for d in databases])),
+                      f, indent=1, sort_keys=True)
+    sys.exit(errors and 1 or 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
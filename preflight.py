@@ -0,0 +1,240 @@
+'''Check a release before pushing it: every script and subscript exists
+and the includes do not loop, what the history says about every script on
+every target, and that every target accepts the credentials.
+
+    preflight.py -b -t db1@host1 -t db2@host2 user password release.manifest
+
+The include graphs are resolved once, the history of all the targets is
+read in bulk and the logins are tried on all the targets at the same
+time. One report covers it all, the exit code is 0 only if nothing is
+wrong.'''
+import sys
+import time
+import logging
+import argparse
+import threading
+import Queue
+
+import dbif
+import sql_user
+import util
+from fanout import split_target, target_log_file
+from history import HistoryManager
+from manifest import read_manifest, ManifestException, ManifestEntry
+
+OK = 'OK'
+FAIL = 'FAIL'
+
+
+class ScriptCheck:
+    def __init__(self, sql_file, subs=None, problem=''):
+        self.sql_file = sql_file
+        self.subs = subs
+        self.problem = problem
+
+
+class LoginCheck:
+    def __init__(self, target, user, status, elapsed=0.0, errors=None):
+        self.target = target
+        self.user = user
+        self.status = status
+        self.elapsed = elapsed
+        self.errors = errors or []
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Check a script, or a manifest of scripts, '
+                                     'against many servers without running anything.')
+    parser.add_argument('username')
+    parser.add_argument('password')
+    parser.add_argument('sql_file')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='sql_file is a manifest listing the scripts to check.')
+    parser.add_argument('-t', '--target', dest='targets', action='append', default=[],
+                        metavar='db[@host]', help='A database to check. Can be repeated.')
+    parser.add_argument('--targets-file', metavar='FILE',
+                        help='File with one db[@host] target per line.')
+    parser.add_argument('-D', '--dbms', metavar='DBMS', default='oracle',
+                        help='Name of the DBMS that you are connecting to. Default is \'oracle\'.')
+    parser.add_argument('--backend', choices=dbif.BACKENDS, default='pexpect',
+                        help='Connect through the command line client or a DB-API driver.')
+    parser.add_argument('-r', '--record', dest='recdir', default='complete',
+                        help='Directory of the execution records. Default is \'complete\'')
+    parser.add_argument('--history-backend', choices=HistoryManager.BACKENDS, default='FS',
+                        help='How the execution records are kept, FS (the default) or SQLITE.')
+    parser.add_argument('-j', '--jobs', type=int, default=16,
+                        help='How many logins to try at the same time. Default is 16.')
+    parser.add_argument('--no-login', action='store_true',
+                        help='Only check the scripts and the history, do not connect.')
+    args = parser.parse_args(argv)
+    if args.targets_file:
+        with open(args.targets_file) as file:
+            args.targets.extend([l.strip() for l in file if l.strip() and not l.startswith('#')])
+    return args
+
+def check_scripts(entries, dbms):
+    '''Resolve the include graph of every distinct script once. Returns a
+    dictionary of script -> ScriptCheck.'''
+    checks = {}
+    for entry in entries:
+        if entry.sql_file in checks:
+            continue
+        if not util.file_exists(entry.sql_file):
+            checks[entry.sql_file] = ScriptCheck(entry.sql_file, problem='does not exist')
+            continue
+        try:
+            checks[entry.sql_file] = ScriptCheck(entry.sql_file, util.find_subscripts(entry.sql_file, dbms))
+        except IOError, e:
+            checks[entry.sql_file] = ScriptCheck(entry.sql_file, problem='missing subscript %s' % (e.filename,))
+        except util.IncludeCycleException, e:
+            checks[entry.sql_file] = ScriptCheck(entry.sql_file, problem=e.value)
+    return checks
+
+def check_history(args, entries, scripts, databases):
+    '''Returns a dictionary of (script, user, database) -> NEW, NO_DIFF,
+    DIFF, or the error that prevented the check.'''
+    statuses = {}
+    for database in databases:
+        for entry in entries:
+            key = (entry.sql_file, entry.user, database)
+            check = scripts[entry.sql_file]
+            if key in statuses or check.problem:
+                continue
+            try:
+                hist = HistoryManager(entry.sql_file, database, entry.user,
+                                      backend=args.history_backend, path=args.recdir)
+                statuses[key] = hist.status(entry.sql_file, check.subs)
+            except Exception, e:
+                statuses[key] = 'ERROR: %s' % (e,)
+    return statuses
+
+def probe(args, target, user, password):
+    '''Log in to the target and out again. Returns a LoginCheck.'''
+    database, host = split_target(target)
+    logger = logging.getLogger('preflight.' + target)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    db = dbif.create_interface(args.dbms, logger, None, args.backend)
+    db.PXP_LOGFILE = target_log_file(db.PXP_LOGFILE, '%s.%s' % (user, target))
+    start = time.time()
+    try:
+        if not db.connect(user, password, database, host):
+            return LoginCheck(target, user, FAIL, time.time() - start, db.dequeue_errors())
+        return LoginCheck(target, user, OK, time.time() - start)
+    except Exception, e:
+        return LoginCheck(target, user, FAIL, time.time() - start, [str(e)])
+    finally:
+        if db.connected():
+            db.exit()
+        else:
+            # a failed login leaves the client running
+            db.close()
+
+def probe_all(args, credentials):
+    '''Try every (user, password) on every target, at most args.jobs at
+    a time. Returns the LoginChecks in target order.'''
+    todo = Queue.Queue()
+    jobs = [(target, user, password) for target in args.targets for user, password in credentials]
+    for i, job in enumerate(jobs):
+        todo.put((i, job))
+    results = [None] * len(jobs)
+
+    def worker():
+        while True:
+            try:
+                i, (target, user, password) = todo.get_nowait()
+            except Queue.Empty:
+                return
+            results[i] = probe(args, target, user, password)
+
+    workers = [threading.Thread(target=worker) for i in range(max(1, min(args.jobs, len(jobs))))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
+
+def report(entries, scripts, statuses, logins, databases, elapsed):
+    '''Returns the text of the report and the number of problems in it.'''
+    problems = 0
+    lines = ['', '## Scripts', '%-40s %5s  %s' % ('SCRIPT', 'SUBS', 'RESULT')]
+    for sql_file in sorted(scripts):
+        check = scripts[sql_file]
+        if check.problem:
+            problems += 1
+            lines.append('%-40s %5s  FAIL: %s' % (sql_file, '-', check.problem))
+        else:
+            lines.append('%-40s %5d  OK' % (sql_file, len(check.subs)))
+
+    widths = [max(len(database), len(HistoryManager.NO_DIFF)) for database in databases]
+    lines += ['', '## History', '%-40s %-12s  %s' % ('SCRIPT', 'USER', '  '.join(
+        [database.ljust(width) for database, width in zip(databases, widths)]))]
+    rows = []
+    for entry in entries:
+        if (entry.sql_file, entry.user) in rows or scripts[entry.sql_file].problem:
+            continue
+        rows.append((entry.sql_file, entry.user))
+        cells = []
+        for database, width in zip(databases, widths):
+            status = statuses[(entry.sql_file, entry.user, database)]
+            if status.startswith('ERROR'):
+                problems += 1
+                status = 'ERROR'
+            cells.append(status.ljust(width))
+        lines.append('%-40s %-12s  %s' % (entry.sql_file, entry.user, '  '.join(cells)))
+    lines += ['%s: %s' % (key, status) for key, status in sorted(statuses.items())
+              if status.startswith('ERROR')]
+
+    if logins is not None:
+        lines += ['', '## Logins', '%-30s %-12s %-6s %7s  %s' % ('TARGET', 'USER', 'RESULT', 'SECONDS', 'ERRORS')]
+        for login in logins:
+            if login.status != OK:
+                problems += 1
+            lines.append('%-30s %-12s %-6s %7.1f  %s' % (login.target, login.user, login.status,
+                                                          login.elapsed, ' | '.join(login.errors)))
+    lines.append('')
+    lines.append('%d scripts, %d targets checked in %.1f secs: %d problems' %
+                 (len(scripts), len(databases), elapsed, problems))
+    return '\n'.join(lines), problems
+
+def main(argv):
+    args = parse_args(argv[1:])
+    if not args.targets:
+        print 'No targets given, use -t or --targets-file.'
+        sys.exit(sql_user.EXIT_FAIL)
+    start = time.time()
+    if args.batch:
+        try:
+            entries = read_manifest(args.sql_file, args.username, args.password)
+        except (IOError, ManifestException), e:
+            print 'Could not read the manifest %s: %s' % (args.sql_file, e)
+            sys.exit(sql_user.EXIT_FAIL)
+    else:
+        entries = [ManifestEntry(args.sql_file, '', args.username, args.password, 0)]
+
+    logins = None
+    if not args.no_login:
+        # the logins take longest, they run while the files are checked
+        credentials = []
+        for entry in entries:
+            if (entry.user, entry.password) not in credentials:
+                credentials.append((entry.user, entry.password))
+        logins = []
+        login_thread = threading.Thread(target=lambda: logins.extend(probe_all(args, credentials)))
+        login_thread.start()
+
+    databases = [split_target(t)[0] for t in args.targets]
+    scripts = check_scripts(entries, args.dbms)
+    statuses = check_history(args, entries, scripts, databases)
+    if not args.no_login:
+        login_thread.join()
+
+    text, problems = report(entries, scripts, statuses, logins, databases, time.time() - start)
+    print text
+    if problems:
+        sys.exit(sql_user.EXIT_FAIL)
+    sys.exit(sql_user.EXIT_NORMAL)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
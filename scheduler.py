@@ -0,0 +1,124 @@
+import sys
+import threading
+
+from manifest import ManifestException
+
+
+class Scheduler:
+    '''Runs the scripts of a manifest on several threads at once, in an
+    order that respects their dependencies. Script B waits for script A if:
+
+    - the manifest says "depends B A", or
+    - A comes first in the manifest and the two share a file (the same
+      script or a common subscript).
+
+    Everything else may run at the same time.'''
+    def __init__(self, entries, subs):
+        '''entries is the list of ManifestEntry objects, subs maps each
+        script to the list of its subscripts.'''
+        self.entries = entries
+        self.depends = [set() for e in entries]
+
+        files = [set([e.sql_file] + list(subs[e.sql_file])) for e in entries]
+        for j, entry in enumerate(entries):
+            for i in range(j):
+                if files[i] & files[j]:
+                    self.depends[j].add(i)
+            for i, other in enumerate(entries):
+                if i != j and other.sql_file in entry.depends:
+                    self.depends[j].add(i)
+        self._check_cycles()
+
+    def _check_cycles(self):
+        done = set()
+        left = set(range(len(self.entries)))
+        while left:
+            ready = [i for i in left if self.depends[i] <= done]
+            if not ready:
+                names = ', '.join(sorted(set([self.entries[i].sql_file for i in left])))
+                raise ManifestException('The dependencies of these scripts form a cycle: ' + names)
+            done.update(ready)
+            left.difference_update(ready)
+
+    def run(self, run_fn, jobs=1):
+        '''Call run_fn(entry) for every entry, on up to jobs threads. run_fn
+        returns an exit code, anything but 0 is a failure. After the first
+        failure no more scripts are started, the ones running are waited
+        for, and the exit code of the failure is returned. Exceptions
+        raised by run_fn are re-raised once all the threads are done.'''
+        if jobs <= 1:
+            for entry in self._sequential_order():
+                code = run_fn(entry)
+                if code != 0:
+                    return code
+            return 0
+
+        cond = threading.Condition()
+        state = dict(pending=set(range(len(self.entries))), done=set(),
+                     running=0, code=0, exc_info=None)
+
+        def next_ready():
+            for i in sorted(state['pending']):
+                if self.depends[i] <= state['done']:
+                    return i
+            return None
+
+        def worker():
+            while True:
+                cond.acquire()
+                try:
+                    while True:
+                        if state['code'] or not state['pending']:
+                            return
+                        i = next_ready()
+                        if i is not None:
+                            break
+                        cond.wait()
+                    state['pending'].remove(i)
+                    state['running'] += 1
+                finally:
+                    cond.release()
+
+                try:
+                    code = run_fn(self.entries[i])
+                except Exception:
+                    code = 1
+                    if not state['exc_info']:
+                        state['exc_info'] = sys.exc_info()
+
+                cond.acquire()
+                try:
+                    state['running'] -= 1
+                    if code == 0:
+                        state['done'].add(i)
+                    elif not state['code']:
+                        state['code'] = code
+                    cond.notifyAll()
+                finally:
+                    cond.release()
+
+        threads = [threading.Thread(target=worker) for n in range(min(jobs, len(self.entries)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.isAlive():
+                t.join(0.5) # a plain join cannot be interrupted with ^C
+
+        if state['exc_info']:
+            exc = state['exc_info']
+            raise exc[0], exc[1], exc[2]
+        return state['code']
+
+    def _sequential_order(self):
+        '''Manifest order, except that a script never comes before the
+        scripts it depends on.'''
+        order = []
+        done = set()
+        left = range(len(self.entries))
+        while left:
+            i = [i for i in left if self.depends[i] <= done][0]
+            left.remove(i)
+            done.add(i)
+            order.append(self.entries[i])
+        return order
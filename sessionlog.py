@@ -0,0 +1,165 @@
+'''The raw transcript of a client session, what pexpect writes to the
+logfile of the child.
+
+pexpect writes and flushes every chunk it reads or sends, which for a data
+load is a small write for every piece of output. A SessionLog keeps the
+chunks in memory and writes them buffer_size bytes at a time. Every run
+gets files of its own, named after the configured file with the time and
+the pid of the run, so the next run does not overwrite them:
+
+    ora_client.log -> ora_client.20140312-101500.4242.log
+
+A session that logs in again during the same run appends to the file of
+the run. With max_bytes the log goes on in ora_client.<run>.1.log,
+.2.log and so on every max_bytes bytes, with compress the files are
+gzipped as they are written and end in .log.gz, and with keep only the
+keep newest files of all the runs are left.
+
+The buffer is written out when it is full, by sync() and by close(). The
+logs still open when the process exits are closed then, also when it is
+killed with SIGTERM, as the trap of db_release_common.sh does.'''
+import os
+import re
+import time
+import glob
+import atexit
+import signal
+
+BUFFER_SIZE = 1024 * 1024
+KEEP = 10
+RUN = '%s.%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+_open_logs = []
+
+
+class SessionLogPolicy:
+    '''How the raw logs of the sessions are written.'''
+    def __init__(self, max_bytes=0, compress=False, keep=KEEP, buffer_size=BUFFER_SIZE):
+        self.max_bytes = max_bytes # 0 for never going on in a new file
+        self.compress = compress
+        self.keep = keep # 0 to keep every file
+        self.buffer_size = buffer_size
+
+    def open(self, path):
+        return SessionLog(path, self)
+
+
+class SessionLog:
+    def __init__(self, path, policy=None):
+        self.policy = policy or SessionLogPolicy()
+        self._root, self._ext = os.path.splitext(path)
+        self._ext = self._ext or '.log'
+        self.part = 0
+        self.written = 0 # bytes logged, in all the parts
+        self._part_bytes = 0
+        self._pending = []
+        self._pending_size = 0
+        self._file = None
+        self.name = None
+        # a session logging in again goes on in the last part of the run
+        for run, part in [self._run_part(f) for f in self.files()]:
+            if run == RUN:
+                self.part = max(self.part, part)
+        self._open()
+        _open_logs.append(self)
+
+    def write(self, data):
+        if self._file is None:
+            return
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self.written += len(data)
+        if self._pending_size >= self.policy.buffer_size:
+            self.sync()
+
+    def flush(self):
+        '''pexpect flushes after every write, the buffer is written when it
+        is full instead. See sync.'''
+        pass
+
+    def sync(self):
+        '''Write out what is buffered.'''
+        if not self._pending or self._file is None:
+            return
+        data = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        max_bytes = self.policy.max_bytes
+        while data:
+            room = len(data)
+            if max_bytes:
+                room = max(0, min(room, max_bytes - self._part_bytes))
+            self._file.write(data[:room])
+            self._part_bytes += len(data[:room])
+            data = data[room:]
+            if max_bytes and self._part_bytes >= max_bytes:
+                self._file.close()
+                self.part += 1
+                self._open()
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+        if self in _open_logs:
+            _open_logs.remove(self)
+
+    def files(self):
+        '''The files of the session log and of the earlier runs, oldest
+        first.'''
+        files = [f for f in glob.glob(self._root + '.*') if self._run_part(f)]
+        return sorted(files, key=lambda f: (os.path.getmtime(f), f))
+
+    def _run_part(self, file):
+        '''The run and the part of one of the files, None if it is not one.'''
+        match = re.match(re.escape(os.path.basename(self._root)) + r'\.(\d{8}-\d{6}\.\d+)(?:\.(\d+))?'
+                         + re.escape(self._ext) + r'(\.gz)?$', os.path.basename(file))
+        return match and (match.group(1), int(match.group(2) or 0)) or None
+
+    def _part_name(self, part):
+        name = '%s.%s%s%s' % (self._root, RUN, part and '.%d' % part or '', self._ext)
+        return self.policy.compress and name + '.gz' or name
+
+    def _open(self):
+        self.name = self._part_name(self.part)
+        if self.policy.compress:
+            import gzip
+            self._file = gzip.open(self.name, 'ab')
+            self._part_bytes = 0
+        else:
+            self._file = open(self.name, 'ab')
+            self._part_bytes = os.path.getsize(self.name)
+        self._prune()
+
+    def _prune(self):
+        '''Remove the oldest files past the keep newest.'''
+        if not self.policy.keep:
+            return
+        files = [f for f in self.files() if os.path.abspath(f) != os.path.abspath(self.name)]
+        for f in files[:max(0, len(files) - self.policy.keep + 1)]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass # removed by another run
+
+
+def _close_all():
+    for log in list(_open_logs):
+        log.close()
+
+def _terminated(signum, frame):
+    '''atexit does not run when SIGTERM kills the process: close the logs,
+    then die of the signal as without the handler.'''
+    _close_all()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+atexit.register(_close_all)
+if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    try:
+        signal.signal(signal.SIGTERM, _terminated)
+    except ValueError:
+        pass # not imported by the main thread, which alone can handle signals
@@ -0,0 +1,231 @@
+'''Drives many dbif sessions from one thread.
+
+The *_async methods of the dbif interfaces are coroutines: generators that
+yield what they wait for, an Expect or a Read on their client, another
+coroutine to run to its end, or a Return with their result. A SessionLoop
+runs any number of them at once, waiting on all the clients with one
+select:
+
+    loop = SessionLoop()
+    tasks = [loop.spawn(check(db), timeout=30) for db in sessions]
+    loop.run()
+    print [t.result() for t in tasks]
+
+where check is a coroutine of your own:
+
+    def check(db):
+        connected = yield db.connect_async(user, passwd, dbname)
+        if connected:
+            yield db.exec_cmd_async('select 1 from dual;')
+            yield db.exit_async()
+        yield Return(connected)
+
+run_blocking() runs one coroutine to its end on the calling thread, that is
+how the blocking methods share code with the async ones. There is no
+asyncio in Python 2, this is the same idea on plain generators.'''
+import time
+import select
+
+import pexpect
+
+
+class Expect:
+    '''Wait until the output of the child matches one of the patterns, as
+    pexpect's expect does. The coroutine gets the index of the pattern, or
+    pexpect.TIMEOUT or EOF raised if they are not among the patterns.
+    searchwindowsize is that of expect.'''
+    def __init__(self, child, patterns, timeout=None, searchwindowsize=None):
+        self.child = child
+        self.patterns = patterns
+        self.timeout = timeout
+        self.searchwindowsize = searchwindowsize
+
+
+class Read:
+    '''Wait for output of the child, as its read_nonblocking does. The
+    coroutine gets the output or pexpect.TIMEOUT or EOF raised.'''
+    def __init__(self, child, size, timeout=None):
+        self.child = child
+        self.size = size
+        self.timeout = timeout
+
+
+class Return:
+    '''The result of a coroutine, yielded as its last step.'''
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Cancelled(Exception):
+    '''Raised in a coroutine at the point it waits when its task is
+    cancelled or runs out of time. The command the session was waiting
+    for may still be running: exit the session, or read up to its prompt.'''
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+    def __repr__(self):
+        return self.__str__()
+
+
+def run_blocking(coroutine):
+    '''Run the coroutine to its end and return its result.'''
+    task = Task(coroutine)
+    task.step()
+    while not task.done:
+        wait = task.wait
+        try:
+            if isinstance(wait, Expect):
+                value = wait.child.expect(wait.patterns, timeout=wait.timeout,
+                                          searchwindowsize=wait.searchwindowsize)
+            else:
+                value = wait.child.read_nonblocking(wait.size, wait.timeout)
+        except Exception, e:
+            task.step(error=e)
+        else:
+            task.step(value)
+    return task.result()
+
+
+class Task:
+    '''A coroutine and the coroutines it is running, innermost last.'''
+    def __init__(self, coroutine, timeout=None):
+        self.stack = [coroutine]
+        self.deadline = timeout is not None and time.time() + timeout or None
+        self.wait = None # the Expect or Read it waits on
+        self.wait_deadline = None
+        self.fresh = False # whether the wait started after the last poll
+        self.done = False
+        self._result = None
+        self._error = None
+        self._compiled = None
+
+    def step(self, value=None, error=None):
+        '''Resume the coroutine with a value or an exception, and run it up
+        to its next wait.'''
+        self.wait = None
+        while self.stack:
+            try:
+                if error is not None:
+                    thrown, error = error, None
+                    request = self.stack[-1].throw(thrown)
+                else:
+                    request = self.stack[-1].send(value)
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Exception, e:
+                self.stack.pop()
+                error = e
+                continue
+            if isinstance(request, Return):
+                self.stack[-1].close()
+                self.stack.pop()
+                value = request.value
+            elif isinstance(request, (Expect, Read)):
+                self.wait = request
+                self.fresh = True
+                self.wait_deadline = request.timeout is not None and time.time() + request.timeout or None
+                self._compiled = None
+                return
+            else: # a coroutine called by this one
+                self.stack.append(request)
+                value = None
+        self.done = True
+        self._result = value
+        self._error = error
+
+    def cancel(self, reason='cancelled'):
+        '''Raise Cancelled in the coroutine where it waits.'''
+        if not self.done:
+            self.step(error=Cancelled(reason))
+
+    def result(self):
+        '''The result of the coroutine, or the exception it ended with raised.'''
+        if not self.done:
+            raise ValueError('The task has not finished')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        return self._error
+
+    def poll(self):
+        '''Go on if what the task waits for is there. Returns False if it
+        still has to wait.'''
+        wait = self.wait
+        self.fresh = False
+        try:
+            if isinstance(wait, Expect):
+                if self._compiled is None:
+                    # the loop does the timing out, not pexpect
+                    self._compiled = wait.child.compile_pattern_list(
+                        [p for p in wait.patterns if p is not pexpect.TIMEOUT])
+                value = wait.child.expect_list(self._compiled, timeout=0,
+                                               searchwindowsize=wait.searchwindowsize)
+                if pexpect.TIMEOUT in wait.patterns and value >= wait.patterns.index(pexpect.TIMEOUT):
+                    value += 1
+            else:
+                value = wait.child.read_nonblocking(wait.size, 0)
+        except pexpect.TIMEOUT:
+            return False
+        except Exception, e:
+            self.step(error=e)
+            return True
+        self.step(value)
+        return True
+
+    def expire(self, now):
+        '''Time the task out if one of its deadlines has passed.'''
+        if self.deadline and now >= self.deadline:
+            self.cancel('timed out')
+        elif self.wait_deadline and now >= self.wait_deadline:
+            if isinstance(self.wait, Expect) and pexpect.TIMEOUT in self.wait.patterns:
+                self.step(self.wait.patterns.index(pexpect.TIMEOUT))
+            else:
+                self.step(error=pexpect.TIMEOUT('Timeout exceeded.'))
+
+    def next_deadline(self):
+        deadlines = [d for d in (self.deadline, self.wait_deadline) if d]
+        return deadlines and min(deadlines) or None
+
+
+class SessionLoop:
+    '''Runs tasks until all of them are done.'''
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine, timeout=None):
+        '''Start running the coroutine, for at most timeout secs. Returns
+        its Task.'''
+        task = Task(coroutine, timeout)
+        task.step()
+        self.tasks.append(task)
+        return task
+
+    def run(self, timeout=None):
+        '''Run until every task is done, or timeout secs have passed. Returns
+        the tasks that are not done.'''
+        end = timeout is not None and time.time() + timeout or None
+        while True:
+            self.tasks = [t for t in self.tasks if not t.done]
+            if not self.tasks or end and time.time() >= end:
+                return self.tasks
+            # what a new wait is for may already be in the buffer of the child
+            if [t for t in self.tasks if t.fresh and t.poll()]:
+                continue
+            deadlines = [d for d in [t.next_deadline() for t in self.tasks] + [end] if d]
+            wait = deadlines and max(0, min(deadlines) - time.time()) or None
+            fds = dict([(t.wait.child.child_fd, t) for t in self.tasks])
+            try:
+                readable = select.select(fds.keys(), [], [], wait)[0]
+            except select.error:
+                readable = []
+            for fd in readable:
+                fds[fd].poll()
+            now = time.time()
+            for task in self.tasks:
+                if not task.done:
+                    task.expire(now)
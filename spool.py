@@ -0,0 +1,203 @@
+'''Keeps the output of a script on disk for --show to review it.
+
+The interface writes the output to an OutputSpool as it arrives, instead of
+it piling up in pexpect's buffer. The spool indexes the offsets where the
+output of every statement starts and where every error line is, and the
+review pages through the file, jumps to the errors and statements and
+searches it through a memory map, so a script printing gigabytes costs
+disk, not memory:
+
+    spool = OutputSpool()
+    db.spool = spool
+    db.exec_sql_file(sql_file, stream=True)
+    db.spool = None
+    review(spool, ask, write)
+
+Scripts run one statement at a time (--profile, the DB-API backends) say
+where every statement starts. For a script run by the client the output
+of a statement is taken to start after a blank line, which is how the
+clients separate the results of the statements.'''
+import mmap
+import array
+import tempfile
+
+PAGE_LINES = 40
+
+
+class OutputSpool:
+    def __init__(self, dir=None):
+        self.file = tempfile.TemporaryFile(prefix='sql_user_spool.', dir=dir)
+        self.size = 0
+        self.statements = array.array('L') # offsets where the output of a statement starts
+        self.errors = array.array('L') # offsets of the error lines
+        self._marked = False # whether the interface says where the statements start
+        self._new_statement = True
+        self._line_start = True
+        self._map = None
+
+    def statement(self):
+        '''The output written next is that of a new statement.'''
+        self._marked = True
+        self._new_statement = True
+
+    def write(self, text, errors=()):
+        '''Append output. errors are the lines of text that are errors.'''
+        if not text or self._map is not None:
+            return
+        errors = set([e.rstrip('\r\n') for e in errors])
+        offset = self.size
+        for line in text.splitlines(True):
+            if self._line_start:
+                content = line.rstrip('\r\n')
+                if not content.strip():
+                    if not self._marked:
+                        self._new_statement = True
+                else:
+                    if self._new_statement:
+                        self.statements.append(offset)
+                        self._new_statement = False
+                    if content in errors:
+                        self.errors.append(offset)
+            self._line_start = line.endswith('\n')
+            offset += len(line)
+        self.file.write(text)
+        self.size = offset
+
+    def map(self):
+        '''A read only memory map of the output. Nothing can be written
+        after this.'''
+        if self._map is None:
+            self.file.flush()
+            self._map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.file.close()
+
+
+class Pager:
+    '''A position in a spool and ways to move it.'''
+    def __init__(self, spool, page_lines=PAGE_LINES):
+        self.spool = spool
+        self.page_lines = page_lines
+        self.map = spool.map()
+        self.pos = 0
+        self.end = 0 # where the page shown last ends
+
+    def page(self, pos=None):
+        '''The lines of the page starting at the line of pos, by default
+        the one after the last page.'''
+        if pos is None:
+            pos = self.end
+        self.pos = self._line_start(min(pos, self.spool.size))
+        end = self.pos
+        for i in range(self.page_lines):
+            if end >= self.spool.size:
+                break
+            newline = self.map.find('\n', end)
+            end = newline < 0 and self.spool.size or newline + 1
+        self.end = end
+        text = self.map[self.pos:end]
+        if text.endswith('\n'):
+            text = text[:-1]
+        return text.split('\n')
+
+    def back(self):
+        '''The page before the last one shown.'''
+        pos = self.pos
+        for i in range(self.page_lines):
+            if pos <= 0:
+                break
+            pos = self._line_start(pos - 1)
+        return self.page(pos)
+
+    def next_in(self, offsets, forward=True):
+        '''The page at the next, or previous, of the offsets from the page
+        shown last. None if there is none.'''
+        if forward:
+            i = _bisect(offsets, self.pos + 1)
+            return i < len(offsets) and self.page(offsets[i]) or None
+        i = _bisect(offsets, self.pos)
+        return i and self.page(offsets[i - 1]) or None
+
+    def search(self, text):
+        '''The page at the next line having text after the top of the page
+        shown last, wrapping around. None if no line has it.'''
+        found = self.map.find(text, self._line_end(self.pos))
+        if found < 0:
+            found = self.map.find(text)
+        return found >= 0 and self.page(found) or None
+
+    def status(self):
+        return '-- %d%% of %d bytes, %d statements, errors %d of %d so far --' % (
+            100 * self.end / max(self.spool.size, 1), self.spool.size, len(self.spool.statements),
+            _bisect(self.spool.errors, self.end), len(self.spool.errors))
+
+    def _line_start(self, pos):
+        return self.map.rfind('\n', 0, pos) + 1
+
+    def _line_end(self, pos):
+        newline = self.map.find('\n', pos)
+        return newline < 0 and self.spool.size or newline + 1
+
+
+def _bisect(offsets, pos):
+    '''How many of the sorted offsets are before pos.'''
+    low, high = 0, len(offsets)
+    while low < high:
+        middle = (low + high) // 2
+        if offsets[middle] < pos:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+REVIEW_HELP = '''Enter: next page, b: previous page, g/G: first/last page,
+e/E: next/previous error, s/S: next/previous statement,
+/text: search, n: search again, q: done reviewing'''
+
+def review(spool, ask, write, page_lines=PAGE_LINES):
+    '''Let the user page through the spooled output. ask(prompt) returns
+    the command the user typed, None when the input timed out, and write
+    shows lines. Returns when the user is done.'''
+    if not spool.size:
+        return
+    pager = Pager(spool, page_lines)
+    write(pager.page(0))
+    searched = None
+    while True:
+        write([pager.status()])
+        command = ask(': ')
+        if command is None or command.strip() == 'q':
+            return
+        command = command.rstrip('\n')
+        if command.startswith('/') and len(command) > 1:
+            searched = command[1:]
+            command = 'n'
+        key = command.strip()
+        if key == '':
+            lines = pager.end < spool.size and pager.page() or None
+        elif key == 'b':
+            lines = pager.back()
+        elif key == 'g':
+            lines = pager.page(0)
+        elif key == 'G':
+            pager.pos = spool.size
+            lines = pager.back()
+        elif key in ('e', 'E'):
+            lines = pager.next_in(spool.errors, key == 'e')
+        elif key in ('s', 'S'):
+            lines = pager.next_in(spool.statements, key == 's')
+        elif key == 'n' and searched:
+            lines = pager.search(searched)
+        else:
+            write(REVIEW_HELP.split('\n'))
+            continue
+        if lines is None:
+            write(['(nothing there)'])
+        else:
+            write(lines)
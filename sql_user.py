@@ -1,10 +1,26 @@
+import time
+IMPORT_START = time.time() # before the imports, so that they are timed too
+
 import sys
+import fastskip
+if __name__ == '__main__' and fastskip.skip(sys.argv[1:]):
+    sys.exit(0) # EXIT_NORMAL, nothing changed since the last run
+
+import os
 import argparse
+import pexpect
 import logging
 from datetime import datetime
 
 import dbif
+import metrics
+import logpipe
+import spool
+import sessionlog
+import bulkload
 from history import HistoryManager
+from manifest import read_manifest, ManifestException
+from scheduler import Scheduler
 import util
 
 
@@ -12,40 +28,75 @@ EXIT_NORMAL = 0 # when program is done exit with this
 EXIT_FAIL = 1 # when a critical error occured
 EXIT_LOGIN = 13 # could not login
 
-def setup_logging(log_file, verbosity=logging.ERROR):
+run_metrics = metrics.RunMetrics() # replaced by main() with one that knows the run
+log_writer = None # the logpipe.LogWriter doing the log I/O with --log-queue
+console_handler = None # test_run turns it up to DEBUG
+console_plain_handler = None # --show keeps the client output off the console
+
+def setup_logging(log_file, verbosity=logging.ERROR, queue=False, log_format='text'):
     '''Creates four loggers: 'all', 'plain', 'file', 'console'.
 
     'all' - formatted output to console and file
     'plain' - unformatted to console and file
     'file', 'console' - formatted to individual outputs
+
+    With queue the I/O is done by a background thread, see logpipe. With
+    log_format 'json' the file gets one JSON event per line instead.
     '''
+    global log_writer, console_handler, console_plain_handler
     plain_format = logging.Formatter('%(message)s')
+    log_stream = open(log_file, 'a')
 
-    filelog = logging.FileHandler(log_file, 'a')
+    filelog = logging.StreamHandler(log_stream)
     filelog.setLevel(logging.DEBUG)
-    filelog_format = logging.Formatter('@[ %(asctime)s ]>[ %(name)s ]: %(message)s', '%m-%d-%Y %H:%M')
-    filelog.setFormatter(filelog_format)
+    if log_format == 'json':
+        filelog.setFormatter(logpipe.JsonFormatter())
+        filelog_plain = filelog
+    else:
+        filelog.setFormatter(logpipe.LineFormatter(fastskip.LOG_FORMAT, fastskip.LOG_DATE_FORMAT))
+        filelog_plain = logging.StreamHandler(log_stream)
+        filelog_plain.setLevel(logging.DEBUG)
+        filelog_plain.setFormatter(plain_format)
 
     console = logging.StreamHandler()
     console.setLevel(verbosity)
-    console_format = logging.Formatter('SQLUSER: %(message)s')
+    console_format = logpipe.LineFormatter(fastskip.CONSOLE_FORMAT)
     console.setFormatter(console_format)
 
     console_plain = logging.StreamHandler()
     console_plain.setLevel(verbosity)
     console_plain.setFormatter(plain_format)
+    console_handler = console
+    console_plain_handler = console_plain
+
+    targets = {'all': [console, filelog],
+               'plain': [filelog_plain, console_plain],
+               'file': [filelog],
+               'console': [console]}
+    if queue:
+        log_writer = logpipe.LogWriter()
+        log_writer.start()
+    context = logpipe.ContextFilter(run_metrics)
+    logging.getLogger('').setLevel(logging.DEBUG)
+    for name, handlers in targets.items():
+        logger = logging.getLogger(name)
+        logger.addFilter(context)
+        if queue:
+            logger.addHandler(logpipe.QueueHandler(log_writer, handlers))
+        else:
+            for handler in handlers:
+                logger.addHandler(handler)
 
-    filelog_plain = logging.FileHandler(log_file, 'a')
-    filelog_plain.setLevel(logging.DEBUG)
-    filelog_plain.setFormatter(plain_format)
+def flush_logging():
+    '''Wait for the log writer to catch up, before asking the user.'''
+    if log_writer:
+        log_writer.flush()
 
-    logging.getLogger('').setLevel(logging.DEBUG)
-    logging.getLogger('all').addHandler(console)
-    logging.getLogger('all').addHandler(filelog)
-    logging.getLogger('plain').addHandler(filelog_plain)
-    logging.getLogger('plain').addHandler(console_plain)
-    logging.getLogger('file').addHandler(filelog)
-    logging.getLogger('console').addHandler(console)
+def stop_logging():
+    global log_writer
+    if log_writer:
+        log_writer.stop()
+        log_writer = None
 
 def log_(logger, msg, level):
     '''Log to a specified logger. Break strings into lines. Accepts lists.'''
@@ -55,8 +106,9 @@ def log_(logger, msg, level):
         elif type(msg) is list:
             lines = msg
 
-        for line in lines:
-            logger.log(level, line)
+        # one record, the formatters treat the lines as records of their own
+        if lines:
+            logger.log(level, '\n'.join(lines), extra={'split_lines': True})
     else:
         logger.log(level, msg)
 
@@ -89,6 +141,82 @@ def log_script_changes(diff, sub_diff):
             log_plain(sub[1])
 
 
+def phase(name, **tags):
+    '''Context manager timing a phase of the run.'''
+    return run_metrics.phase(name, **tags)
+
+def start_metrics(args, started):
+    '''Start measuring the run. started is when main() was entered.'''
+    global run_metrics
+    process_start = metrics.process_start_time()
+    run_metrics = metrics.RunMetrics(start=process_start or IMPORT_START)
+    run_metrics.info.update(dbms=args.dbms, database=args.database, user=args.username,
+                            sql_file=args.sql_file, host=args.host, backend=args.backend,
+                            batch=args.batch, jobs=args.jobs, exit_code=None)
+    if process_start:
+        run_metrics.add_phase('startup', process_start, IMPORT_START)
+    run_metrics.add_phase('imports', IMPORT_START, started)
+    run_metrics.add_phase('parse_args', started, time.time())
+
+def load_metrics_hooks(args):
+    for spec in args.metrics_hook:
+        try:
+            metrics.load_hook(spec)
+        except Exception, e:
+            log('ERROR: Could not load the metrics hook %s: %s' % (spec, e), logging.ERROR)
+
+def finish_metrics(args):
+    '''Write the metrics file and call the hooks. Failing to do so is
+    logged, it does not fail the run.'''
+    if not args.metrics and not metrics._hooks:
+        return
+    try:
+        errors = metrics.emit(run_metrics, args.metrics)
+    except (IOError, OSError), e:
+        errors = [e]
+    for e in errors:
+        log('WARNING: Could not deliver the run metrics: ' + str(e), logging.ERROR)
+
+def open_history(args, sql_file, user):
+    '''The execution record of the script for the user on args.database.'''
+    return HistoryManager(sql_file, args.database, user, backend=args.history_backend,
+                          path=args.recdir)
+
+def ask_user(args, options):
+    '''Ask the user to pick one of the options. Returns None without
+    asking when --no-input was given, same as when the input times out.'''
+    if args.no_input:
+        log('Not asking for user input due to --no-input')
+        return None
+    flush_logging()
+    return util.query_user(options, args.timeout)
+
+def review_output(args, output):
+    '''Let the user page through the spooled output of a script.'''
+    log_file('# Output of the script: %d bytes, %d statements, %d errors'
+             % (output.size, len(output.statements), len(output.errors)))
+    if args.no_input or not output.size:
+        return
+    flush_logging()
+    print '# Review the output of the script, h for help:'
+    spool.review(output, lambda prompt: util.read_line(prompt, args.timeout),
+                 lambda lines: sys.stdout.write('\n'.join(lines) + '\n'))
+
+def load_subscripts(sql_file, dbms):
+    '''Find all the subscripts of the script. Returns None and logs
+    the reason if some are missing or they include each other.'''
+    try:
+        with phase('subscripts', file=sql_file):
+            return util.find_subscripts(sql_file, dbms)
+    except IOError, e:
+        log('ERROR: One of the subscripts does not exist. Opening it threw and exception: ', logging.ERROR)
+        log(e, logging.ERROR)
+    except util.IncludeCycleException, e:
+        log('ERROR: The subscripts include each other in a cycle: ', logging.ERROR)
+        log(e, logging.ERROR)
+    return None
+
+
 def parse_args(args):
     '''Run argparse on args and return the result.'''
     parser = argparse.ArgumentParser(description='Run a SQL script file on a server')
@@ -107,10 +235,30 @@ def parse_args(args):
                         const=logging.DEBUG, help='Show lots of output.')
     parser.add_argument('-D', '--dbms', metavar='DBMS', default='oracle',
                         help='Name of the DBMS that you are connecting to. Default is \'oracle\'.')
+    parser.add_argument('--backend', choices=dbif.BACKENDS, default='pexpect',
+                        help='Run scripts through the command line client (pexpect, the default) ' \
+                        'or through a Python DB-API driver (dbapi). sqlite always uses dbapi.')
+    parser.add_argument('--transport', choices=dbif.TRANSPORTS, default=dbif.PTY,
+                        help='Spawn the client on a pseudo-terminal (pty, the default) or on pipes, ' \
+                        'in its batch mode (pipe): no prompts, echo or redrawing to read through, ' \
+                        'which makes every command cheaper. --manual always uses a pty.')
     parser.add_argument('-l', '--log', dest='logfile', default='sql_out.log',
                         help='Allows to specify the log file; the default is \'sql_out.txt\'')
+    parser.add_argument('--rawlog', metavar='FILE', default=None,
+                        help='Where to write the raw client session, default depends on the DBMS. ' \
+                        'Every run writes files of its own, named after FILE with the time and pid of the run.')
+    parser.add_argument('--rawlog-max-size', metavar='MB', type=int, default=0,
+                        help='Go on in a new raw log file every MB megabytes. Default is never.')
+    parser.add_argument('--rawlog-gzip', action='store_true',
+                        help='Compress the raw log files as they are written.')
+    parser.add_argument('--rawlog-keep', metavar='N', type=int, default=sessionlog.KEEP,
+                        help='Remove the oldest raw log files, of this and earlier runs, past the N ' \
+                        'newest. 0 keeps all of them. Default is %d.' % (sessionlog.KEEP,))
     parser.add_argument('-r', '--record', dest='recdir', default='complete',
                         help='Specify the directory for execution records. Default is \'complete\'')
+    parser.add_argument('--history-backend', choices=HistoryManager.BACKENDS, default='FS',
+                        help='Keep execution records as files (FS, the default) or in ' \
+                        'a single SQLite file in the record directory (SQLITE).')
     parser.add_argument('-d', '--diag', dest='test_run', action='store_true',
                         help='Does a diagnostic check on the script and all ' \
                         'scripts it calls instead of running the script.')
@@ -121,7 +269,9 @@ def parse_args(args):
                         help='Ignore execution record.')
     parser.add_argument('-s', '--show', action='store_true',
                         help='Show SQL*Plus output from running the script and ' \
-                        'ask for confirmation before continuing.')
+                        'ask for confirmation before continuing. The output is kept in a ' \
+                        'temporary file as it arrives, to be paged, searched and have its ' \
+                        'errors jumped to. Implies --stream.')
     parser.add_argument('-n', '--noquery', action='store_true',
                         help='Automatically execute files that are new or have changed, ' \
                         'but skip completed non-chaged files')
@@ -129,12 +279,59 @@ def parse_args(args):
                         help='Connect to a specific host.')
     parser.add_argument('-T', '--timeout', metavar='T', type=int, default=30,
                         help='User input timeout, default to 30 secs.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Treat sql_file as a manifest listing the scripts to run, ' \
+                        'and run all of them reusing one client session per user.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='With --batch, run up to this many independent scripts ' \
+                        'at the same time, each on its own session.')
+    parser.add_argument('--no-input', action='store_true',
+                        help='Never ask the user anything, behave as if the question timed out.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Log and scan the script output as it arrives instead of ' \
+                        'holding all of it in memory. Use for scripts with huge outputs.')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='Stop the script at its first error, roll back and fail, ' \
+                        'instead of running it to the end. Implies --stream.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Commit and checkpoint every subscript as it completes, and ' \
+                        'skip the ones an earlier, failed, run completed. Never asks questions ' \
+                        'about errors, it rolls back the failed subscript and fails.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Run the script one statement at a time and report the slowest ' \
+                        'statements, also in the --metrics file. Ignores --stream.')
+    parser.add_argument('--profile-top', metavar='N', type=int, default=20,
+                        help='How many statements the profile reports. Default is 20.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Load scripts of only INSERTs of literals, of --bulk-min-size or more, ' \
+                        'through the bulk load of the client instead of running them: \\copy of psql, ' \
+                        'COPY of vsql, LOAD DATA LOCAL INFILE of mysql, INSERT ALL batches for oracle.')
+    parser.add_argument('--bulk-min-size', metavar='MB', type=int, default=10,
+                        help='The size from which --bulk loads a script. Default is 10.')
+    parser.add_argument('--bulk-file', metavar='FILE', dest='bulk_files', action='append', default=[],
+                        help='Load this script through the bulk load of the client, whatever its ' \
+                        'size. Can be repeated.')
+    parser.add_argument('--broker', metavar='SOCKET', default=None,
+                        help='Get the session from the broker.py listening on SOCKET, and ' \
+                        'give it back when done. Connects directly if no broker answers. ' \
+                        'Not used with --batch, which keeps its own sessions.')
+    parser.add_argument('--log-queue', action='store_true',
+                        help='Write the log from a background thread, so that logging ' \
+                        'never holds up reading the client output.')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                        help='Format of the log file: text (the default) or json, one ' \
+                        'event per line with run id, file, phase, level and message.')
+    parser.add_argument('--metrics', metavar='FILE', default=None,
+                        help='Write the timing of every phase of the run and output ' \
+                        'counters to FILE as JSON.')
+    parser.add_argument('--metrics-hook', metavar='MODULE:FUNCTION', action='append', default=[],
+                        help='Call FUNCTION from MODULE with the run metrics when the run ' \
+                        'is over. Can be repeated.')
     return parser.parse_args(args)
 
 def test_run(args):
         errors = False
-        for handler in logging.getLogger('console').handlers:
-            handler.setLevel(logging.DEBUG)
+        console_handler.setLevel(logging.DEBUG)
         log('## Doing a test run. ##')
 
         if not util.file_exists(args.sql_file):
@@ -147,19 +344,15 @@ def test_run(args):
 
         # make sure all subscripts exist
         log('## Looking for subscripts')
-        try:
-            subs = util.find_subscripts(args.sql_file, args.dbms)
-        except IOError, e:
-            errors = True
-            log('ERROR: One of the subscripts does not exist. Opening it threw and exception: ', logging.ERROR)
-            log(e, logging.ERROR)
+        subs = load_subscripts(args.sql_file, args.dbms)
+        if subs is None:
             sys.exit(EXIT_FAIL)
 
         log('Found %d subscripts' % (len(subs),))
 
         #####
         # Check execution history and subscripts
-        hist = HistoryManager(args.sql_file, args.database, args.username, path=args.recdir)
+        hist = open_history(args, args.sql_file, args.username)
         log('\n## Checking execution record ##')
         status = hist.status(args.sql_file, subs)
         if status == HistoryManager.DIFF:
@@ -176,7 +369,10 @@ def test_run(args):
         # Try connecting to DB
         try:
             log('\n## Trying to connect to db ##')
-            db = dbif.create_interface(args.dbms, logger=logging.getLogger('plain'))
+            db = dbif.create_interface(args.dbms, logger=logging.getLogger('plain'), rawlog=args.rawlog,
+                                       backend=args.backend)
+            db.rawlog_policy = rawlog_policy(args)
+            db.transport = args.transport
             if not db.connect(args.username, args.password, args.database, args.host):
                 errors = True
                 log('Was not able to connect to DB with these credentials: '
@@ -199,10 +395,409 @@ def test_run(args):
         return errors
 
 
+def check_history(args, hist, sql_file, subs):
+    '''Look at the execution record of the script and its subscripts and
+    ask the user what to do if they have changed. Returns None if the script
+    should be executed, otherwise the code the script run should end with.'''
+    log('## Checking execution record ##')
+    with phase('history_status', file=sql_file):
+        status = hist.status(sql_file, subs)
+    if status == HistoryManager.DIFF:
+        log('# Some of the files have changed since last run.')
+        with phase('history_diff', file=sql_file):
+            diff = hist.diff(sql_file)
+            sub_diff = hist.diff_all(subs)
+        log_script_changes(diff, sub_diff)
+
+        if not args.noquery:
+            log_console('Should we execute the script ' + sql_file + ' again?', logging.CRITICAL)
+            choice = ask_user(args, 'yn')
+            if choice == 'y':
+                log('# Re-running the script ' + sql_file + ' per user request.')
+            elif choice == 'n':
+                log('# Skipping the script ' + sql_file + ' per user request.')
+                return EXIT_NORMAL
+            else:
+                log('Failed to get user input. Exiting.')
+                return EXIT_FAIL
+        else:
+            log('Not querying user due to -n or --noquery')
+    elif status == HistoryManager.NO_DIFF:
+        log('# The main script and subscripts have not changed since last run. Exiting.', logging.CRITICAL)
+        return EXIT_NORMAL
+    elif status == HistoryManager.NEW:
+        log('# First time running this SQL file. Proceed normally.')
+    return None
+
+def run_pieces(db, hist, args, sql_file, extra=''):
+    '''Run the script piece by piece for --resume. Every subscript it
+    includes is a piece of its own, and so are the statements of the
+    script itself between two subscripts. A piece is committed and
+    checkpointed when it completes, and skipped if a checkpoint says it
+    already did. Scripts that include nothing are run by the client as a
+    whole. Returns True if everything ran without errors.'''
+    with open(sql_file, 'r') as file:
+        statements = util.split_script(file.read(), args.dbms)
+    includes = [util.match_subscript(stmt + '\n', args.dbms) for lineno, stmt in statements]
+    if not [sub for sub in includes if sub]:
+        not_EOF = db.exec_sql_file(sql_file, extra, stream=args.stream, fail_fast=args.fail_fast)
+        return log_piece_errors(db, sql_file) and not_EOF
+
+    if extra:
+        db.define_args(extra)
+    own = [] # the statements of the script since the last subscript
+    for (lineno, stmt), sub in zip(statements, includes):
+        if not sub:
+            own.append((lineno, stmt))
+            continue
+        if not run_own_piece(db, hist, args, sql_file, own):
+            return False
+        own = []
+        if hist.checkpointed(sub):
+            log('# Skipping ' + sub + ', it was completed by an earlier run.')
+        else:
+            log('# Running ' + sub)
+            if not run_pieces(db, hist, args, sub):
+                return False
+            db.commit()
+            hist.checkpoint(sub)
+            log('# Checkpoint: ' + sub + ' completed and commited.')
+    return run_own_piece(db, hist, args, sql_file, own)
+
+def run_own_piece(db, hist, args, sql_file, statements):
+    '''Run statements of the script itself as a piece, see run_pieces. The
+    client commands of a piece that is skipped still run, they set up
+    the session for the pieces after it.'''
+    if not statements:
+        return True
+    first = statements[0][0]
+    skip = hist.checkpointed(sql_file, first)
+    if skip:
+        log('# Skipping the statements of %s from line %d, they were completed by an earlier run.'
+            % (sql_file, first))
+    for lineno, stmt in statements:
+        if skip and not util.client_command(stmt, args.dbms):
+            continue
+        db.exec_cmd(stmt)
+        if not log_piece_errors(db, '%s:%d' % (sql_file, lineno)):
+            return False
+    if not skip:
+        db.commit()
+        hist.checkpoint(sql_file, first)
+        log('# Checkpoint: %s from line %d completed and commited.' % (sql_file, first))
+    return True
+
+def log_piece_errors(db, where):
+    '''Log the errors of the last piece. Returns True if there were none.'''
+    errors = db.dequeue_errors()
+    if errors:
+        log('Errors were encountered in ' + where + ':', logging.CRITICAL)
+        log_plain(errors, level=logging.ERROR)
+    return not errors
+
+def resume_script(db, hist, args, sql_file, extra, subs):
+    '''Run the script with --resume, see run_pieces. Returns the exit code.'''
+    str_time = datetime.today().strftime('[%H:%M:%S]')
+    log('\n%s Running file: %s' % (str_time, sql_file), logging.CRITICAL)
+    done = [sub for sub in subs if hist.checkpointed(sub)]
+    if done:
+        log('# Resuming: %d of %d subscripts were completed by earlier runs.' % (len(done), len(subs)),
+            logging.CRITICAL)
+    try:
+        ok = run_pieces(db, hist, args, sql_file, extra)
+    except pexpect.EOF:
+        log('Reached end of file (EOF). The client exited.', logging.ERROR)
+        ok = False
+    if not ok:
+        log('# Rolling back the failed piece. The completed pieces stay commited, ' \
+            'run again with --resume to continue after them.', logging.CRITICAL)
+        if db.connected():
+            db.rollback()
+        return EXIT_FAIL
+    db.commit()
+    log('# Recording history')
+    with phase('history_record', file=sql_file):
+        hist.record(sql_file)
+        hist.record(subs)
+        hist.clear_checkpoints()
+    log('# Execution of script ' + sql_file + ' completed. Changes commited.')
+    return EXIT_NORMAL
+
+def prepare_bulk_load(args, sql_file):
+    '''A bulkload.BulkLoad of the script if it is to be loaded through the
+    bulk load of the client, see --bulk and --bulk-file.'''
+    told = os.path.normpath(sql_file) in [os.path.normpath(f) for f in args.bulk_files]
+    if not (args.bulk or told) or args.profile:
+        return None
+    if args.backend != 'pexpect' or args.dbms not in bulkload.DIALECTS:
+        log('# No bulk load through the %s %s backend, running %s as a script.'
+            % (args.dbms, args.backend, sql_file))
+        return None
+    with phase('bulk_prepare', file=sql_file):
+        loader = bulkload.prepare(sql_file, args.dbms, not told and args.bulk_min_size * 1024 * 1024 or 0)
+    if told and not loader:
+        log('# %s is not only INSERTs of literals, running it as a script.' % (sql_file,))
+    return loader
+
+def run_script(db, hist, args, sql_file, extra, subs):
+    '''Run the script through a connected interface, commit or roll back,
+    and record it in the history. Returns the exit code.'''
+    if args.resume:
+        return resume_script(db, hist, args, sql_file, extra, subs)
+    # check if client exited while executing the script
+    str_time = datetime.today().strftime('[%H:%M:%S]')
+    log('\n%s Running file: %s' % (str_time, sql_file), logging.CRITICAL)
+    profile = args.profile and metrics.StatementProfile() or None
+    output = args.show and spool.OutputSpool() or None
+    db.spool = output
+    if output:
+        # the output goes to the log file, the console gets it through the review
+        console_level = console_plain_handler.level
+        console_plain_handler.setLevel(logging.CRITICAL + 1)
+    loader = prepare_bulk_load(args, sql_file)
+    try:
+        if loader:
+            log('# Loading %d rows into %d tables through the bulk load of the client.'
+                % (loader.rows, len(loader.segments)), logging.CRITICAL)
+            with phase('bulk_load', file=sql_file, rows=loader.rows):
+                not_EOF = loader.load(db, args.fail_fast)
+        else:
+            not_EOF = db.exec_sql_file(sql_file, extra, stream=args.stream or args.show,
+                                       fail_fast=args.fail_fast, profile=profile)
+    finally:
+        db.spool = None
+        if output:
+            flush_logging()
+            console_plain_handler.setLevel(console_level)
+        if loader:
+            loader.close()
+    if profile:
+        log('## Slowest statements of ' + sql_file + ':', logging.CRITICAL)
+        log_plain(profile.report(args.profile_top), logging.CRITICAL)
+        run_metrics.statements.extend(profile.ranked(args.profile_top))
+    if args.fail_fast and db.failure():
+        log('# Fail fast: the script was stopped at its first error:', logging.CRITICAL)
+        log_plain(db.failure(), level=logging.ERROR)
+        if db.connected():
+            log('# Rolling back the changes.')
+            db.rollback()
+        else:
+            log('# The client exited, the database rolls back the changes of the lost session.')
+        return EXIT_FAIL
+    if not not_EOF:
+        log('Reached end of file (EOF). This probably means the script exited on its own.')
+        errors = loader and loader.errors or db.dequeue_errors()
+
+        if errors:
+            log('Also, errors were encountered: ', logging.ERROR)
+            log_plain(errors, level=logging.ERROR)
+
+        log_console('# Unexpected EOF. You can rollback and quit with failure(f), '
+                     + 'or continue with push and not rollback (p)', logging.CRITICAL)
+        choice = ask_user(args, 'pf')
+        if choice == 'p':
+            log('# Rolling back the changes.')
+            if db.connected():
+                db.rollback()
+            return EXIT_FAIL
+        elif choice == 'f':
+            log('# User wants things as is, so not rolling back.')
+            return EXIT_NORMAL
+        else:
+            log('# Failed to get user input. Exiting.')
+            db.rollback()
+            return EXIT_FAIL
+
+    do_record = True
+    errors = loader and loader.errors or db.dequeue_errors()
+    if args.show or errors:
+        if errors:
+            log('Errors were encountered during execution: ', logging.CRITICAL)
+            log_plain(errors, level=logging.ERROR)
+            log('Errors were encountered during execution: ')
+
+        if args.show:
+            log('--show mode was specified, so you can review the output and do any of the following: ')
+            review_output(args, output)
+            output.close()
+
+        log_console('You can: \n' +
+                    '(c) continue execution, but do not record as completed\n' +
+                    '(i) continue , record as completed\n' +
+                    #'(t) switch to manual control of the DB client\n' +
+                    #'(q) rollback, exit with failure, but record execution as completed\n' +
+                    '(x) rollback and exit with failure', logging.CRITICAL)
+        choice = ask_user(args, 'cix')
+        if choice == 'c':
+            log('# Continuing, not recording.')
+            do_record = False
+        elif choice == 'i':
+            log('# Continuing normally.')
+#        elif choice == 't':
+#            log('# Switching to manual control of the client')
+#            log('  Press ESC to return to automation and complete the push')
+#            alive = db.attach()
+#            if alive:
+#                log('Manual control relinquished, returning to automation.')
+#            else:
+#                log('Child process exited/killed by user action')
+#                return EXIT_NORMAL
+#        elif choice == 'q':
+#            log('# Rolling back the changes, assuming failure, recording as complete.')
+#            if db.connected():
+#                db.rollback()
+#            hist.record(sql_file)
+#            hist.record(subs)
+#            return EXIT_FAIL
+        elif choice == 'x':
+            log('# Rolling back the changes, assuming failure, not recording.')
+            if db.connected():
+                db.rollback()
+            return EXIT_FAIL
+        else:
+            log('Failed to get user input. Exiting.')
+            db.rollback()
+            return EXIT_FAIL
+    db.commit()
+    if do_record:
+        log('# Recording history')
+        with phase('history_record', file=sql_file):
+            hist.record(sql_file)
+            hist.record(subs)
+            hist.clear_checkpoints()
+    log('# Execution of script ' + sql_file + ' completed. Changes commited.')
+    return EXIT_NORMAL
+
+def log_login_failure(user, database, errors):
+    log('Was not able to connect to DB with these credentials: '
+        'user=%s, pass=%s, db=%s' % (user, '------', database), logging.ERROR)
+    if errors:
+        log('Errors encountered: ', logging.ERROR)
+        log_plain(errors, level=logging.ERROR)
+
+def run_entry(args, pool, entry, subs):
+    '''Check the history of one manifest entry and run it on a session
+    from the pool. Returns the exit code.'''
+    log('\n### SQL_USER.PY: dbname=' + args.database + ' user=' \
+            + entry.user + ' sqlfile=' + entry.sql_file + ' host=' + args.host + ' ###')
+    hist = open_history(args, entry.sql_file, entry.user)
+    if not args.ignore_history:
+        code = check_history(args, hist, entry.sql_file, subs)
+        if code is not None:
+            return code
+    else:
+        log('## Ignoring execution record due to an -i or --ignore flag')
+
+    db = pool.acquire(entry.user, entry.password, args.database, args.host)
+    if not db:
+        log_login_failure(entry.user, args.database, pool.last_errors())
+        return EXIT_LOGIN
+    try:
+        code = run_script(db, hist, args, entry.sql_file, entry.args, subs)
+    except Exception, e:
+        log('Exception raised.')
+        log(e)
+        if db.connected():
+            db.rollback()
+            db.exit()
+        raise
+    pool.release(db)
+    return code
+
+def run_batch(args):
+    '''Run every script listed in the manifest args.sql_file, keeping one
+    client session open per (user, database, host). With --jobs scripts
+    that do not depend on each other run in parallel on separate sessions.
+    Stops at the first script that does not finish normally and returns
+    its exit code.'''
+    try:
+        entries = read_manifest(args.sql_file, args.username, args.password)
+    except (IOError, ManifestException), e:
+        log('ERROR: Could not read the manifest ' + args.sql_file + ': ', logging.ERROR)
+        log(e, logging.ERROR)
+        return EXIT_FAIL
+    log('## Batch mode: %d scripts in %s' % (len(entries), args.sql_file))
+
+    subs = {}
+    for entry in entries:
+        if entry.sql_file not in subs:
+            subs[entry.sql_file] = load_subscripts(entry.sql_file, args.dbms)
+            if subs[entry.sql_file] is None:
+                return EXIT_FAIL
+    try:
+        sched = Scheduler(entries, subs)
+    except ManifestException, e:
+        log('ERROR: ' + str(e), logging.ERROR)
+        return EXIT_FAIL
+
+    if args.jobs > 1:
+        log('## Running up to %d scripts in parallel, not asking any questions.' % (args.jobs,))
+        args.no_input = True
+
+    def run_fn(entry):
+        with phase('entry', file=entry.sql_file):
+            return run_entry(args, pool, entry, subs[entry.sql_file])
+
+    pool = dbif.SessionPool(args.dbms, logging.getLogger('plain'), args.rawlog, args.backend,
+                            metrics=run_metrics, rawlog_policy=rawlog_policy(args),
+                            transport=args.transport)
+    try:
+        code = sched.run(run_fn, args.jobs)
+        if code == EXIT_NORMAL:
+            log('## Batch completed: %d scripts.' % (len(entries),))
+        return code
+    finally:
+        pool.close()
+
+
 def main(argv):
     '''Where magick happens.'''
+    started = time.time()
     args = parse_args(argv[1:])
-    setup_logging(args.logfile, args.log_level)
+    start_metrics(args, started)
+    setup_logging(args.logfile, args.log_level, args.log_queue, args.log_format)
+    load_metrics_hooks(args)
+    try:
+        run(args)
+    except SystemExit, e:
+        run_metrics.info['exit_code'] = e.code
+        raise
+    except Exception, e:
+        run_metrics.info['exit_code'] = EXIT_FAIL
+        run_metrics.info['exception'] = repr(e)
+        raise
+    finally:
+        finish_metrics(args)
+        stop_logging()
+
+def rawlog_policy(args):
+    '''How the raw client logs are written, see sessionlog.'''
+    return sessionlog.SessionLogPolicy(args.rawlog_max_size * 1024 * 1024, args.rawlog_gzip,
+                                       args.rawlog_keep)
+
+def open_interface(args, logger):
+    '''The interface to run the script through: a session of the broker if
+    one is running, otherwise one of our own.'''
+    if args.broker:
+        if dbif.BrokerInterface.available(args.broker):
+            db = dbif.BrokerInterface(args.broker, args.dbms, logger, args.rawlog, args.backend)
+            db.transport = args.transport
+            return db
+        log('## No session broker at %s, connecting directly.' % (args.broker,))
+    db = dbif.create_interface(args.dbms, logger, args.rawlog, args.backend)
+    db.rawlog_policy = rawlog_policy(args)
+    db.transport = args.transport
+    return db
+
+def run(args):
+    '''Run the script, or the manifest, as args say. Always exits.'''
+    if args.batch:
+        if args.jobs > 1 and args.show:
+            log('ERROR: --show cannot be used with --jobs, nobody could review the outputs.', logging.ERROR)
+            sys.exit(EXIT_FAIL)
+        sys.exit(run_batch(args))
+        # EXIT
+
     log('\n### SQL_USER.PY: dbname=' + args.database + ' user=' \
             + args.username + ' sqlfile=' + args.sql_file + ' host=' + args.host + ' ###')
     #log('### Arguments: ' + ' '.join(argv[1:]))
@@ -213,11 +808,8 @@ def main(argv):
         sys.exit(EXIT_FAIL)
 
     # make sure all subscripts exist
-    try:
-        subs = util.find_subscripts(args.sql_file, args.dbms)
-    except IOError, e:
-        log('ERROR: One of the subscripts does not exist. Opening it threw and exception: ', logging.ERROR)
-        log(e, logging.ERROR)
+    subs = load_subscripts(args.sql_file, args.dbms)
+    if subs is None:
         sys.exit(EXIT_FAIL)
 
 
@@ -242,135 +834,29 @@ def main(argv):
             # EXIT
 
     # setup history
-    hist = HistoryManager(args.sql_file, args.database, args.username, path=args.recdir)
+    hist = open_history(args, args.sql_file, args.username)
 
     #### Check history
     if not args.ignore_history:
-        log('## Checking execution record ##')
-        status = hist.status(args.sql_file, subs)
-        if status == HistoryManager.DIFF:
-            log('# Some of the files have changed since last run.')
-            diff = hist.diff(args.sql_file)
-            sub_diff = hist.diff_all(subs)
-            log_script_changes(diff, sub_diff)
-
-            if not args.noquery:
-                log_console('Should we execute the script ' + args.sql_file + ' again?', logging.CRITICAL)
-                choice = util.query_user('yn', args.timeout)
-                if choice == 'y':
-                    log('# Re-running the script ' + args.sql_file + ' per user request.')
-                elif choice == 'n':
-                    log('# Skipping the script ' + args.sql_file + ' per user request.')
-                    sys.exit(EXIT_NORMAL) # EXIT
-                else:
-                    log('Failed to get user input. Exiting.')
-                    sys.exit(EXIT_FAIL) # EXIT
-            else:
-                log('Not querying user due to -n or --noquery')
-        elif status == HistoryManager.NO_DIFF:
-            log('# The main script and subscripts have not changed since last run. Exiting.', logging.CRITICAL)
-            sys.exit(EXIT_NORMAL) # EXIT
-        elif status == HistoryManager.NEW:
-            log('# First time running this SQL file. Proceed normally.')
+        code = check_history(args, hist, args.sql_file, subs)
+        if code is not None:
+            sys.exit(code) # EXIT
     else:
         log('## Ignoring execution record due to an -i or --ignore flag')
 
 
     ### Run the DB client
+    db = None
     try:
-        db = dbif.create_interface(args.dbms, logging.getLogger('plain'))
+        db = open_interface(args, logging.getLogger('plain'))
+        db.metrics = run_metrics
         if not db.connect(args.username, args.password, args.database, args.host):
-            log('Was not able to connect to DB with these credentials: '
-                'user=%s, pass=%s, db=%s' % (args.username, '------', args.database), logging.ERROR)
-            errors = db.dequeue_errors()
-            if errors:
-                log('Errors encountered: ', logging.ERROR)
-                log_plain(errors, level=logging.ERROR)
+            log_login_failure(args.username, args.database, db.dequeue_errors())
             sys.exit(EXIT_LOGIN)
             # EXIT
 
-        # check if client exited while executing the script
-        str_time = datetime.today().strftime('[%H:%M:%S]')
-        log('\n%s Running file: %s' % (str_time, args.sql_file), logging.CRITICAL)
-        not_EOF = db.exec_sql_file(args.sql_file, args.extra)
-        if not not_EOF:
-            log('Reached end of file (EOF). This probably means the script exited on its own.')
-            errors = db.dequeue_errors()
-
-            if errors:
-                log('Also, errors were encountered: ', logging.ERROR)
-                log_plain(errors, level=logging.ERROR)
-
-            log_console('# Unexpected EOF. You can rollback and quit with failure(f), '
-                         + 'or continue with push and not rollback (p)', logging.CRITICAL)
-            choice = util.query_user('pf', args.timeout)
-            if choice == 'p':
-                log('# Rolling back the changes.')
-                if db.connected():
-                    db.rollback()
-                sys.exit(EXIT_FAIL) # EXIT
-            elif choice == 'f':
-                log('# User wants things as is, so not rolling back.')
-                sys.exit(EXIT_NORMAL) # EXIT
-            else:
-                log('# Failed to get user input. Exiting.')
-                db.rollback()
-                sys.exit(EXIT_FAIL) # EXIT
-
-        do_record = True
-        errors = db.dequeue_errors()
-        if args.show or errors:
-            if errors:
-                log('Errors were encountered during execution: ', logging.CRITICAL)
-                log_plain(errors, level=logging.ERROR)
-                log('Errors were encountered during execution: ')
-
-            if args.show:
-                log('--show mode was specified, so you can review the output and do any of the following: ')
-
-            log_console('You can: \n' +
-                        '(c) continue execution, but do not record as completed\n' +
-                        '(i) continue , record as completed\n' +
-                        #'(t) switch to manual control of the DB client\n' +
-                        #'(q) rollback, exit with failure, but record execution as completed\n' +
-                        '(x) rollback and exit with failure', logging.CRITICAL)
-            choice = util.query_user('cix', args.timeout)
-            if choice == 'c':
-                log('# Continuing, not recording.')
-                do_record = False
-            elif choice == 'i':
-                log('# Continuing normally.')
-#            elif choice == 't':
-#                log('# Switching to manual control of the client')
-#                log('  Press ESC to return to automation and complete the push')
-#                alive = db.attach()
-#                if alive:
-#                    log('Manual control relinquished, returning to automation.')
-#                else:
-#                    log('Child process exited/killed by user action')
-#                    sys.exit(EXIT_NORMAL) # EXIT
-#            elif choice == 'q':
-#                log('# Rolling back the changes, assuming failure, recording as complete.')
-#                if db.connected():
-#                    db.rollback()
-#                hist.record(args.sql_file)
-#                hist.record(subs)
-#                sys.exit(EXIT_FAIL) # EXIT
-            elif choice == 'x':
-                log('# Rolling back the changes, assuming failure, not recording.')
-                if db.connected():
-                    db.rollback()
-                sys.exit(EXIT_FAIL) # EXIT
-            else:
-                log('Failed to get user input. Exiting.')
-                db.rollback()
-                sys.exit(EXIT_FAIL) # EXIT
-        db.commit()
-        if do_record:
-            log('# Recording history')
-            hist.record(args.sql_file)
-            hist.record(subs)
-        log('# Execution of script ' + args.sql_file + ' completed. Changes commited.')
+        code = run_script(db, hist, args, args.sql_file, args.extra, subs)
+        sys.exit(code) # EXIT
     except Exception, e:
         log('Exception raised.')
         log(e)
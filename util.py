@@ -1,12 +1,29 @@
 import re
 import os
 import sys
+import hashlib
 from select import select
-from functools import partial
 
 def file_exists(file):
     return os.path.exists(file) or os.path.exists(file + '.sql')
 
+def script_file(file):
+    '''The file a script name stands for: the clients add .sql to a name
+    that does not exist as it is.'''
+    if not os.path.exists(file) and os.path.exists(file + '.sql'):
+        return file + '.sql'
+    return file
+
+def file_digest(file, chunk_size=1 << 16):
+    '''Return the hex SHA-1 digest of the file contents.'''
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunk_size)
+    return digest.hexdigest()
+
 def query_user(options, timeout=30):
     prompt = '[' + '/'.join(list(options)) + ']: '
     while True:
@@ -22,32 +39,274 @@ def query_user(options, timeout=30):
         else:
             return None
 
+def read_line(prompt, timeout=30):
+    '''Ask for a line of input. Returns it without the newline, or None
+    if the input timed out or ended.'''
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    rlist, _, _ = select([sys.stdin], [], [], timeout)
+    if not rlist:
+        print
+        return None
+    line = sys.stdin.readline()
+    if not line:
+        return None
+    return line.rstrip('\n')
+
+class IncludeCycleException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+    def __repr__(self):
+        return self.__str__()
+
+# (comment pattern, subscript pattern) for every dialect
+_SUB_PATTERNS = {
+    'oracle': (re.compile(r'^-- '), re.compile(r'@([\w/.-]*);?\s+(--)?')),
+    'vertica': (re.compile('^-- '), re.compile(r'\\i ([\w/.-]*)')),
+    'postgresql': (re.compile('^-- '), re.compile(r'\\i ([\w/.-]*)')),
+    'mysql': (re.compile('(^-- )|(^#)'), re.compile(r'\\. ([\w/.-]*)')),
+    'sqlite': (re.compile('^-- '), re.compile(r'\.read ([\w/.-]*)')),
+}
+
+# (path, syntax) -> (mtime, size, direct subscripts)
+_parse_cache = {}
+
 def find_subscripts(sql_file, syntax):
     '''Recursively goes through the script and all its dependencies
-    and returns a list of all subscripts. Throw IOError if a file is missing.'''
+    and returns a list of all subscripts, each listed once in the order
+    they are first included. Throw IOError if a file is missing and
+    IncludeCycleException if the scripts include each other.'''
+    graph = subscript_graph(sql_file, syntax)
     result = []
-    if syntax == 'oracle':
-        match_fn = partial(_sub_match, comment_pat=r'^-- ', sub_pat='@([\w/.-]*);?\s+(--)?')
-    elif syntax == 'vertica' \
-        or syntax == 'postgresql':
-        match_fn = partial(_sub_match, comment_pat='^-- ', sub_pat=r'\\i ([\w/.-]*)')
-    elif syntax == 'mysql':
-        match_fn = partial(_sub_match, comment_pat='(^-- )|(^#)', sub_pat=r'\\. ([\w/.-]*)')
+    seen = set([sql_file])
+    def visit(file):
+        for sub in graph[file]:
+            if sub not in seen:
+                seen.add(sub)
+                result.append(sub)
+                visit(sub)
+    visit(sql_file)
+    return result
+
+def subscript_graph(sql_file, syntax):
+    '''Returns the include graph of the script as a dictionary mapping
+    every file to the list of subscripts it includes directly. Every
+    file is parsed once, and the parsed files are cached until they change.'''
+    graph = {}
+    path = []
+    def visit(file):
+        if file in path:
+            cycle = path[path.index(file):] + [file]
+            raise IncludeCycleException('Scripts include each other: ' + ' -> '.join(cycle))
+        if file in graph:
+            return
+        path.append(file)
+        graph[file] = _direct_subscripts(file, syntax)
+        for sub in graph[file]:
+            visit(sub)
+        path.pop()
+    visit(sql_file)
+    return graph
+
+def _direct_subscripts(sql_file, syntax):
+    '''Returns the subscripts included by the file itself.'''
+    try:
+        stat = os.stat(sql_file)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, sql_file)
+    key = (os.path.abspath(sql_file), syntax)
+    cached = _parse_cache.get(key)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
 
+    result = []
     with open(sql_file, 'r') as file:
-        lines = file.readlines()
-        subs = (match_fn(line) for line in lines if match_fn(line))
-        for sub in subs:
-            if not os.path.exists(sub) and os.path.exists(sub + '.sql'):
-                sub = sub + '.sql'
-            result.append(sub)
-            result.extend(find_subscripts(sub, syntax)) # recurse into the subscript
+        for line in file:
+            sub = match_subscript(line, syntax)
+            if sub:
+                result.append(sub)
+    _parse_cache[key] = (stat.st_mtime, stat.st_size, result)
     return result
 
-def _sub_match(line, comment_pat='', sub_pat=''):
-    comment = re.compile(comment_pat)
-    sub = re.compile(sub_pat)
-    if not comment.match(line) and sub.match(line):
-        return sub.match(line).group(1)
-    return None
+def match_subscript(line, syntax):
+    '''If the line includes a subscript return its file name, else None.'''
+    comment, sub_pat = _SUB_PATTERNS[syntax]
+    if comment.match(line):
+        return None
+    match = sub_pat.match(line)
+    if not match:
+        return None
+    return script_file(match.group(1))
+
+def split_statements(text):
+    '''Split SQL text into statements on the semicolons that are not inside
+    quotes or comments. The semicolons are dropped, and so are empty statements.'''
+    statements = []
+    start = 0
+    for end in _delimiter_positions(text):
+        statements.append(text[start:end])
+        start = end + 1
+    statements.append(text[start:])
+    return [s.strip() for s in statements if s.strip()]
+
+_DOLLAR_QUOTE = re.compile(r'\$(\w*)\$')
+
+def _delimiter_positions(text, delimiter=';', quotes='\'"', dollar_quotes=False):
+    '''Offsets of the delimiters in text that are not inside quotes or comments.'''
+    return _scan_delimiters(text, None, delimiter, quotes, dollar_quotes)[0]
+
+def _scan_delimiters(text, closing, delimiter, quotes, dollar_quotes):
+    '''_delimiter_positions of a piece of text that starts inside a quote or
+    comment if closing, what ends it, is not None. Returns the offsets and
+    the closing of the quote or comment the piece ends in, for the scan of
+    the text that comes next. Pieces are split at line breaks: no
+    delimiter, quote or comment mark has one.'''
+    positions = []
+    i = 0
+    n = len(text)
+    while i < n:
+        if closing is not None:
+            end = text.find(closing, i)
+            if end == -1:
+                break
+            if closing in quotes and text[end + 1:end + 2] == closing: # '' is an escaped quote
+                i = end + 2
+                continue
+            i = end + len(closing)
+            closing = None
+            continue
+        c = text[i]
+        if c in quotes:
+            closing = c
+            i += 1
+        elif dollar_quotes and c == '$' and _DOLLAR_QUOTE.match(text, i):
+            closing = _DOLLAR_QUOTE.match(text, i).group(0)
+            i += len(closing)
+        elif text.startswith('--', i):
+            closing = '\n'
+            i += 2
+        elif text.startswith('/*', i):
+            closing = '*/'
+            i += 2
+        elif text.startswith(delimiter, i):
+            positions.append(i)
+            i += len(delimiter)
+        else:
+            i += 1
+    return positions, closing
+
+# lines the clients run as commands of their own, without a terminator
+_CLIENT_COMMANDS = {
+    'oracle': re.compile(r'(?i)\s*(@|(rem|remark|set|prompt|define|undefine|whenever|spool|show|'
+                         r'exec|execute|host|column|col|break|compute|ttitle|btitle|variable|var|'
+                         r'print|pause|accept|timing)\b)(?!\s+(transaction|role|constraints?)\b)'),
+    'vertica': re.compile(r'\s*\\'),
+    'postgresql': re.compile(r'\s*\\'),
+    'mysql': re.compile(r'(?i)\s*(\\|(source|delimiter|use|charset|warnings|nowarning)\b)'),
+    'sqlite': re.compile(r'\s*\.'),
+}
+_PLSQL_BLOCK = re.compile(r'(?i)\s*(create(\s+or\s+replace)?(\s+(editionable|noneditionable))?'
+                          r'\s+(procedure|function|package|trigger|type)\b|declare\b|begin\b)')
+
+def client_command(line, syntax):
+    '''True if the line is a command of the client itself, like SQL*Plus
+    SET or a psql \\ meta-command, see split_script.'''
+    return _CLIENT_COMMANDS[syntax].match(line) is not None
+
+# the client commands that only print something or include a script
+_STATELESS_COMMANDS = {
+    'oracle': re.compile(r'(?i)\s*(@|(rem|remark|prompt|show|print|pause)\b)'),
+    'vertica': re.compile(r'\s*\\(echo|qecho|warn|i|ir|include|include_relative)\b'),
+    'postgresql': re.compile(r'\s*\\(echo|qecho|warn|i|ir|include|include_relative)\b'),
+    'mysql': re.compile(r'(?i)\s*(\\\.|source\b)'),
+    'sqlite': re.compile(r'\s*\.(print|read|show)\b'),
+}
+# SQL changing the session rather than the data
+_SESSION_STATEMENTS = re.compile(r'(?i)\s*(set\s+(?!(transaction|local)\b)|alter\s+session\b|pragma\b|attach\b)')
+
+def sets_session_state(stmt, syntax):
+    '''True if the statement, or client command, can leave something
+    behind in the session for the statements after it: most client
+    commands (SQL*Plus SET and DEFINE, psql \\set, the mysql DELIMITER)
+    and the SQL SET of session variables, which outlive the transaction.'''
+    if client_command(stmt, syntax):
+        return _STATELESS_COMMANDS[syntax].match(stmt) is None
+    return _SESSION_STATEMENTS.match(stmt) is not None
+
+def split_script(text, syntax):
+    '''Split a script into the statements and client commands a client
+    would run, as (line number, text) tuples in the form to send them one
+    at a time: SQL ends with its terminator, the ; or the DELIMITER of
+    mysql, PL/SQL blocks with a "/" line. Client commands (SQL*Plus SET,
+    psql \\ meta-commands, ...) are one line each. Comments between
+    statements are dropped.'''
+    commands = _CLIENT_COMMANDS[syntax]
+    quotes = syntax == 'mysql' and '\'"`' or '\'"'
+    dollar_quotes = syntax == 'postgresql'
+    delimiter = ';'
+    statements = []
+    lines = []
+    start = 0
+    block = False
+    # the scan of the statement so far: its delimiters, its size and the
+    # quote or comment it ends in, so every line is scanned once
+    ends = []
+    size = 0
+    closing = None
+
+    def add(first, stmt):
+        if syntax == 'oracle' and not block:
+            # a blank line ends a SQL statement in sqlplus
+            stmt = '\n'.join([l for l in stmt.split('\n') if l.strip()])
+        statements.append((first, stmt))
+
+    for lineno, line in enumerate(text.split('\n')):
+        lineno += 1
+        line = line.rstrip('\r')
+        stripped = line.strip()
+        if not lines:
+            if not stripped or stripped.startswith('--') or syntax == 'mysql' and stripped.startswith('#'):
+                continue
+            if syntax == 'oracle' and stripped == '/':
+                continue
+            if commands.match(line):
+                statements.append((lineno, stripped))
+                match = re.match(r'(?i)delimiter\s+(\S+)', stripped)
+                if syntax == 'mysql' and match:
+                    delimiter = match.group(1)
+                continue
+            start = lineno
+            block = syntax == 'oracle' and _PLSQL_BLOCK.match(line) is not None
+            ends, size, closing = [], 0, None
+        elif syntax == 'oracle' and stripped == '/':
+            add(start, '\n'.join(lines).strip() + '\n/')
+            lines = []
+            continue
+        lines.append(line)
+        if block:
+            continue
 
+        piece = len(lines) > 1 and '\n' + line or line
+        found, closing = _scan_delimiters(piece, closing, delimiter, quotes, dollar_quotes)
+        ends.extend([size + end for end in found])
+        size += len(piece)
+        if not found:
+            # what follows an earlier delimiter does not end the statement either
+            continue
+        rest = piece[found[-1] + len(delimiter):].strip()
+        if rest and not rest.startswith('--'):
+            continue
+        buffer = '\n'.join(lines)
+        begin = 0
+        for end in ends:
+            stmt = buffer[begin:end + len(delimiter)]
+            if stmt[:-len(delimiter)].strip():
+                first = start + buffer.count('\n', 0, begin + len(stmt) - len(stmt.lstrip()))
+                add(first, stmt.strip())
+            begin = end + len(delimiter)
+        lines = []
+    if lines and '\n'.join(lines).strip():
+        add(start, '\n'.join(lines).strip())
+    return statements